@@ -1,4 +1,11 @@
 from django.contrib import admin
-from .models import UploadedPDF
+from .models import UploadedPDF, IngestJob
 
 admin.site.register(UploadedPDF)
+
+
+@admin.register(IngestJob)
+class IngestJobAdmin(admin.ModelAdmin):
+    list_display = ('original_name', 'status', 'attempts', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    search_fields = ('original_name',)
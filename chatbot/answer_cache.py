@@ -0,0 +1,186 @@
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+
+from config import metrics
+
+# -----------------------------
+# 回答キャッシュ
+# -----------------------------
+# 「ごみの日」「避難所」などの同じ質問に、毎回 ChromaDB 検索 + Gemini 生成をしないためのキャッシュ。
+# 1. 正規化した質問の完全一致（lookup_exact。埋め込みの計算より前に確認する）
+# 2. 質問の埋め込みのコサイン類似度がしきい値以上（lookup_similar）
+# の順にヒットを判定する。
+# エントリは ChromaDB の別コレクションに保存するため、複数プロセスで共有される。
+# 資料と同じく自治体ごとにコレクションを分け、その自治体の資料が更新されたら全エントリを削除する。
+# 共通コレクションの資料は全自治体の回答に使われるため、更新されたら全自治体のエントリを削除する。
+CACHE_COLLECTION_NAME = "answer_cache"
+
+_collections = {}
+_collection_lock = threading.Lock()
+
+_EVENTS = ("exact_hits", "semantic_hits", "misses", "stores", "invalidations")
+_events = metrics.counter("chatbot_answer_cache_events", "Answer cache lookups, stores and invalidations.", ["event"])
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def is_enabled():
+    return _setting("CHATBOT_ANSWER_CACHE_ENABLED", True)
+
+
+def _incr(key):
+    _events.inc(event=key)
+
+
+def get_stats():
+    """ヒット・ミスの回数（このプロセス内の累計）"""
+    stats = {key: _events.value(event=key) for key in _EVENTS}
+    lookups = stats["exact_hits"] + stats["semantic_hits"] + stats["misses"]
+    stats["hit_rate"] = (stats["exact_hits"] + stats["semantic_hits"]) / lookups if lookups else 0.0
+    return stats
+
+
+def _get_collection(municipality_id=None):
+    collection = _collections.get(municipality_id)
+    if collection is None:
+        with _collection_lock:
+            collection = _collections.get(municipality_id)
+            if collection is None:
+                from .utils import embedding_model_id, get_chroma_client
+                client = get_chroma_client()
+                name = CACHE_COLLECTION_NAME if municipality_id is None else f"{CACHE_COLLECTION_NAME}_m{municipality_id}"
+                metadata = {"hnsw:space": "cosine", "embedding_model": embedding_model_id()}
+                collection = client.get_or_create_collection(name=name, metadata=metadata)
+                # 埋め込みモデルが変わった場合、古い質問ベクトルとは比較できないので作り直す
+                if (collection.metadata or {}).get("embedding_model") != metadata["embedding_model"]:
+                    try:
+                        client.delete_collection(name)
+                    except Exception:
+                        pass  # 他のプロセスが先に作り直した
+                    collection = client.get_or_create_collection(name=name, metadata=metadata)
+                _collections[municipality_id] = collection
+    return collection
+
+
+def reset():
+    with _collection_lock:
+        _collections.clear()
+
+
+# 質問の末尾・途中にある記号や空白は意味を変えないため取り除く
+_IGNORED_CHARS = re.compile(r"[\s。、．，,.!?！？「」『』（）()・…ー〜~]+")
+
+
+def normalize_question(question):
+    text = unicodedata.normalize("NFKC", question).lower()
+    return _IGNORED_CHARS.sub("", text)
+
+
+def _entry_id(normalized):
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def lookup_exact(question, municipality_id=None):
+    """
+    正規化した質問が完全一致する回答を返す（なければ None）
+    質問の埋め込みを使わないので、ヒットした場合は埋め込みの計算を省ける
+    """
+    if not is_enabled():
+        return None
+
+    with metrics.timer("answer_cache_lookup", match="exact") as fields:
+        collection = _get_collection(municipality_id)
+        exact = collection.get(ids=[_entry_id(normalize_question(question))], include=["metadatas"])
+        answer = None
+        if exact["ids"] and exact["metadatas"][0].get("expires_at", 0) > time.time():
+            answer = exact["metadatas"][0]["answer"]
+        fields["result"] = "exact_hits" if answer is not None else "no_exact"
+    if answer is not None:
+        _incr("exact_hits")
+        print(f"[INFO] Answer cache hit (exact): {question}")
+    return answer
+
+
+def lookup_similar(question, query_embedding, municipality_id=None):
+    """
+    質問の埋め込みのコサイン類似度がしきい値以上の回答を返す（なければ None）
+    lookup_exact で見つからなかった場合に呼ぶ（ここでのミスをキャッシュミスとして数える）
+    """
+    if not is_enabled():
+        return None
+
+    with metrics.timer("answer_cache_lookup", match="semantic") as fields:
+        answer, fields["result"] = _lookup_similar(question, query_embedding, municipality_id)
+    return answer
+
+
+def _lookup_similar(question, query_embedding, municipality_id):
+    """戻り値: (回答 or None, "semantic_hits" / "misses")"""
+    collection = _get_collection(municipality_id)
+    if collection.count() > 0:
+        results = collection.query(
+            query_embeddings=[query_embedding],
+            n_results=1,
+            where={"expires_at": {"$gt": time.time()}},
+            include=["metadatas", "distances", "documents"],
+        )
+        if results["ids"][0]:
+            # コサイン距離 = 1 - コサイン類似度
+            similarity = 1.0 - results["distances"][0][0]
+            if similarity >= _setting("CHATBOT_ANSWER_CACHE_SIMILARITY", 0.92):
+                _incr("semantic_hits")
+                print(f"[INFO] Answer cache hit (semantic {similarity:.3f}): {question} ≈ {results['documents'][0][0]}")
+                return results["metadatas"][0][0]["answer"], "semantic_hits"
+
+    _incr("misses")
+    return None, "misses"
+
+
+def store(question, query_embedding, answer, municipality_id=None):
+    if not is_enabled():
+        return
+
+    collection = _get_collection(municipality_id)
+    now = time.time()
+    normalized = normalize_question(question)
+
+    collection.upsert(
+        ids=[_entry_id(normalized)],
+        documents=[normalized],
+        embeddings=[query_embedding],
+        metadatas=[{
+            "answer": answer,
+            "created_at": now,
+            "expires_at": now + _setting("CHATBOT_ANSWER_CACHE_TTL", 6 * 60 * 60),
+        }],
+    )
+    # 期限切れのエントリを掃除しておく（インデックスが肥大化しないように）
+    collection.delete(where={"expires_at": {"$lte": now}})
+    _incr("stores")
+
+
+def invalidate(municipality_id=None):
+    """資料が更新されたときに、その自治体の全エントリを削除する"""
+    collection = _get_collection(municipality_id)
+    collection.delete(where={"created_at": {"$gte": 0}})
+    _incr("invalidations")
+    print("[INFO] Answer cache invalidated.")
+
+
+def invalidate_all():
+    """共通の資料が更新されたときに、全自治体のエントリを削除する"""
+    from .utils import get_chroma_client
+
+    for collection in get_chroma_client().list_collections():
+        name = collection.name
+        if name == CACHE_COLLECTION_NAME:
+            invalidate(None)
+        elif name.startswith(f"{CACHE_COLLECTION_NAME}_m") and name[len(CACHE_COLLECTION_NAME) + 2:].isdigit():
+            invalidate(int(name[len(CACHE_COLLECTION_NAME) + 2:]))
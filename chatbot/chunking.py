@@ -0,0 +1,147 @@
+import re
+import threading
+
+from django.conf import settings
+
+# -----------------------------
+# トークン数の計測
+# -----------------------------
+# tiktoken のエンコーディングは初回にダウンロードが必要なため、
+# 取得できない環境では文字種からの概算にフォールバックする
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    print(f"[WARN] tiktoken is unavailable, estimating token counts: {e}")
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # 概算: 日本語などの非ASCII文字は1文字≒1トークン、ASCIIは4文字≒1トークン
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+# -----------------------------
+# 文分割
+# -----------------------------
+# 句点・感嘆符・疑問符（全角/半角）と改行で区切る。閉じ括弧は前の文に含める
+SENTENCE_END = re.compile(r"[。．！？!?]+[」』）)】]*|\n+")
+
+
+def split_sentences(text):
+    """テキストを文に分割し、(開始位置, 終了位置) のリストを返す"""
+    spans = []
+    start = 0
+    for m in SENTENCE_END.finditer(text):
+        end = m.end()
+        if text[start:end].strip():
+            spans.append((start, end))
+        start = end
+    if text[start:].strip():
+        spans.append((start, len(text)))
+    return spans
+
+
+def _split_long_span(text, start, end, max_tokens, overlap_tokens=0):
+    """
+    1文がチャンクサイズを超える場合は、文字数で強制的に分割する
+    - 句点のない表・箇条書きでも文脈が途切れないよう、断片の末尾 overlap_tokens 程度を次の断片に重複させる
+    """
+    spans = []
+    pos = start
+    while pos < end:
+        # まずは概算の文字数で切り、トークン数が収まるまで縮める
+        step = max(1, min(end - pos, max_tokens))
+        while step > 1 and count_tokens(text[pos:pos + step]) > max_tokens:
+            step = max(1, step * 3 // 4)
+        spans.append((pos, pos + step))
+        if pos + step >= end:
+            break
+        # 重複は断片より短くする（必ず1文字以上進める）
+        overlap = min(overlap_tokens, step - 1)
+        while overlap > 0 and count_tokens(text[pos + step - overlap:pos + step]) > overlap_tokens:
+            overlap = overlap * 3 // 4
+        pos += step - overlap
+    return spans
+
+
+# -----------------------------
+# チャンク分割
+# -----------------------------
+def chunking_settings():
+    return {
+        "chunk_tokens": getattr(settings, "CHATBOT_CHUNK_TOKENS", 400),
+        "overlap_tokens": getattr(settings, "CHATBOT_CHUNK_OVERLAP_TOKENS", 50),
+    }
+
+
+def chunking_signature():
+    """チャンク設定を表す文字列（設定変更時に再チャンクが必要か判定するためにメタデータに保存する）"""
+    conf = chunking_settings()
+    return f"{conf['chunk_tokens']}/{conf['overlap_tokens']}"
+
+
+def chunk_text(text, chunk_tokens=None, overlap_tokens=None):
+    """
+    テキストを文単位でまとめて、指定トークン数以下のチャンクに分割する
+    - 隣り合うチャンクは末尾の文を overlap_tokens 程度重複させる（句点がなく強制分割した文は文字単位で重複させる）
+    戻り値: [{"text": チャンク本文, "start": 開始文字位置, "end": 終了文字位置}, ...]
+    """
+    conf = chunking_settings()
+    chunk_tokens = chunk_tokens or conf["chunk_tokens"]
+    overlap_tokens = conf["overlap_tokens"] if overlap_tokens is None else overlap_tokens
+
+    sentences = []
+    for start, end in split_sentences(text):
+        tokens = count_tokens(text[start:end])
+        if tokens > chunk_tokens:
+            for s, e in _split_long_span(text, start, end, chunk_tokens, overlap_tokens):
+                sentences.append((s, e, count_tokens(text[s:e])))
+        else:
+            sentences.append((start, end, tokens))
+
+    chunks = []
+    i = 0
+    while i < len(sentences):
+        # チャンクサイズに収まるまで文を詰める
+        j = i
+        total = 0
+        while j < len(sentences) and (j == i or total + sentences[j][2] <= chunk_tokens):
+            total += sentences[j][2]
+            j += 1
+
+        start, end = sentences[i][0], sentences[j - 1][1]
+        # 先頭の空白・改行はオフセットごと取り除く
+        body = text[start:end]
+        stripped = body.lstrip()
+        start += len(body) - len(stripped)
+        chunks.append({"text": text[start:end].rstrip(), "start": start, "end": start + len(stripped.rstrip())})
+
+        if j >= len(sentences):
+            break
+
+        # 次のチャンクは末尾の文をいくつか重複させて開始する（必ず1文以上進める）
+        back = j
+        overlap = 0
+        while back - 1 > i and overlap + sentences[back - 1][2] <= overlap_tokens:
+            back -= 1
+            overlap += sentences[back][2]
+        i = back
+
+    return chunks
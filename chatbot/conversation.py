@@ -0,0 +1,284 @@
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import llm
+from .chunking import count_tokens
+from .models import ChatSession, ChatTurn
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# 会話セッション（複数回のやり取り）
+# -----------------------------
+# - 直近のやり取りは CHATBOT_HISTORY_TOKEN_BUDGET トークンまでそのままプロンプトに入れる（超えた古い分は入れない）
+# - それより古いやり取りは LLM で要約し、CHATBOT_SUMMARY_TOKEN_BUDGET トークン以内の summary にまとめる
+#   → 会話が長く続いてもプロンプトの大きさは一定に保たれる
+# - 「それはいつですか」のような質問は、履歴を使って単独で意味が通じる質問に書き換えてから検索する
+# - 要約は回答を返した後にバックグラウンドのスレッドで行う（応答を待たせず、同時実行数の枠も使わない）
+# 検索用の質問の書き換えは、同期版（ストリーミングAPI用）と非同期版（chat_api 用）の両方を用意する。
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _truncate_tokens(text, budget):
+    """トークン数が budget 以内になるよう、先頭（古い側）を削る"""
+    if count_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high) // 2
+        if count_tokens(text[mid:]) <= budget:
+            high = mid
+        else:
+            low = mid + 1
+    return text[low:]
+
+
+# -----------------------------
+# セッション・履歴（DB）
+# -----------------------------
+def get_or_create_session(session_id, user):
+    """
+    session_id のセッションを返す（なければ新しく作る）
+    他の利用者のセッションIDが送られてきた場合も新しいセッションにする
+    """
+    user = user if user is not None and user.is_authenticated else None
+    try:
+        session_id = uuid.UUID(str(session_id)) if session_id else None
+    except ValueError:
+        session_id = None
+    if session_id:
+        session = ChatSession.objects.filter(pk=session_id, user=user).first()
+        if session is not None:
+            return session
+
+    purge_expired_sessions()
+    return ChatSession.objects.create(user=user, municipality_id=user.municipality_id if user else None)
+
+
+def purge_expired_sessions():
+    ttl = _setting("CHATBOT_CHAT_SESSION_TTL", 24 * 60 * 60)
+    ChatSession.objects.filter(updated_at__lt=timezone.now() - timedelta(seconds=ttl)).delete()
+
+
+def load_history(session):
+    """
+    プロンプトに入れる履歴: {"summary": 要約, "turns": [(質問, 回答), ...]}（古い順）
+    最初の質問（履歴なし）の場合は None
+    - 要約されていないやり取りは、新しい方から CHATBOT_HISTORY_TOKEN_BUDGET トークンまでにする
+      （要約はバックグラウンドで行うため、要約中・要約に失敗した場合もプロンプトが大きくなり続けないように）
+    """
+    budget = _setting("CHATBOT_HISTORY_TOKEN_BUDGET", 800)
+    turns, used = [], 0
+    for turn in ChatTurn.objects.filter(session=session, summarized=False).order_by("-created_at", "-id"):
+        if used + turn.tokens > budget:
+            break
+        used += turn.tokens
+        turns.append((turn.question, turn.answer))
+    history = {
+        "summary": session.summary,
+        "turns": turns[::-1],
+    }
+    return history if history["summary"] or history["turns"] else None
+
+
+def record_turn(session, question, search_query, answer):
+    """
+    やり取りを保存し、予算を超えた古いやり取り（要約が必要なもの）を返す
+    要約は compact / compact_in_background で行う
+    """
+    ChatTurn.objects.create(
+        session=session,
+        question=question,
+        search_query=search_query,
+        answer=answer,
+        tokens=count_tokens(question) + count_tokens(answer),
+    )
+    session.save(update_fields=["updated_at"])
+
+    budget = _setting("CHATBOT_HISTORY_TOKEN_BUDGET", 800)
+    turns = list(ChatTurn.objects.filter(session=session, summarized=False).order_by("-created_at", "-id"))
+    if sum(t.tokens for t in turns) <= budget:
+        return []
+
+    # 毎回要約しなくて済むよう、予算の半分まで空ける
+    keep, used = 0, 0
+    for turn in turns:
+        if used + turn.tokens > budget // 2:
+            break
+        used += turn.tokens
+        keep += 1
+    return list(reversed(turns[keep:]))
+
+
+# -----------------------------
+# 要約（ローリングサマリー）
+# -----------------------------
+def build_summary_prompt(summary, turns):
+    budget = _setting("CHATBOT_SUMMARY_TOKEN_BUDGET", 400)
+    lines = "\n".join(f"住民: {t.question}\n職員: {t.answer}" for t in turns)
+    return f"""
+以下は自治体の窓口での住民とのやり取りです。これまでの要約に新しいやり取りを加えて、要約を更新してください。
+- 住民が知りたいこと、話題になっている地区・施設・手続き・日付などの固有名詞は必ず残してください
+- 回答の細かい文面は省略してかまいません
+- 要約は{budget}トークン程度以内で、要約文のみを出力してください
+
+【これまでの要約】
+{summary or "（なし）"}
+
+【新しいやり取り】
+{lines}
+"""
+
+
+def _fallback_summary(summary, turns):
+    """要約に失敗した場合は、質問の一覧を要約の代わりにする（回答は省く）"""
+    questions = "\n".join(f"- {t.question}" for t in turns)
+    return f"{summary}\n{questions}".strip()
+
+
+def apply_summary(session, turns, text):
+    text = _truncate_tokens(text.strip(), _setting("CHATBOT_SUMMARY_TOKEN_BUDGET", 400))
+    with transaction.atomic():
+        ChatSession.objects.filter(pk=session.pk).update(summary=text)
+        ChatTurn.objects.filter(pk__in=[t.pk for t in turns]).update(summarized=True)
+    session.summary = text
+
+
+def compact(session, turns):
+    if not turns:
+        return
+    try:
+        text = llm.generate(build_summary_prompt(session.summary, turns))
+    except Exception as e:
+        logger.error(f"History summarization failed: {e}")
+        text = _fallback_summary(session.summary, turns)
+    apply_summary(session, turns, text)
+
+
+# 要約用のスレッドプール（最初に使うときに作る）
+_compact_executor = None
+_compact_lock = threading.Lock()
+# 要約中のセッションID（同じセッションの要約を重ねて実行しない）
+_compacting = set()
+
+
+def _get_compact_executor():
+    global _compact_executor
+    if _compact_executor is None:
+        with _compact_lock:
+            if _compact_executor is None:
+                _compact_executor = ThreadPoolExecutor(
+                    max_workers=_setting("CHATBOT_COMPACT_WORKERS", 2), thread_name_prefix="chat-compact"
+                )
+    return _compact_executor
+
+
+def _compact_and_close(session, turns):
+    try:
+        compact(session, turns)
+    except Exception as e:
+        logger.error(f"History summarization failed: {e}")
+    finally:
+        with _compact_lock:
+            _compacting.discard(session.pk)
+        close_old_connections()
+
+
+def compact_in_background(session, turns):
+    """
+    回答を返した後に、バックグラウンドのスレッドで要約する
+    同じセッションを要約中の場合は何もしない（要約されなかったやり取りは、次のやり取りの後に改めて要約される）
+    """
+    if not turns:
+        return
+    with _compact_lock:
+        if session.pk in _compacting:
+            return
+        _compacting.add(session.pk)
+    _get_compact_executor().submit(_compact_and_close, session, turns)
+
+
+# -----------------------------
+# 検索用の質問の書き換え
+# -----------------------------
+def format_history(history):
+    """プロンプトに入れる形式の履歴（履歴がなければ空文字）"""
+    if not history:
+        return ""
+    parts = []
+    if history.get("summary"):
+        parts.append(f"（これまでの要約）\n{history['summary']}")
+    for question, answer in history.get("turns", []):
+        parts.append(f"住民: {question}\n職員: {answer}")
+    return "\n\n".join(parts)
+
+
+def build_rewrite_prompt(history, question):
+    return f"""
+以下は自治体の窓口での住民とのやり取りです。会話の流れを踏まえて、最後の質問を、それだけで意味が通じる検索用の質問文に書き換えてください。
+- 「それ」「そこ」などの指示語は、指している内容に置き換えてください
+- 書き換えが不要な場合は、そのまま出力してください
+- 書き換えた質問文のみを1行で出力してください
+
+【これまでの会話】
+{format_history(history)}
+
+【最後の質問】
+{question}
+"""
+
+
+def _clean_rewrite(text, question, history):
+    lines = (text or "").strip().splitlines()
+    rewritten = lines[0].strip() if lines else ""
+    # 書き換え結果が空・長すぎる場合は、直前の質問とつなげたものを使う
+    if not rewritten or len(rewritten) > max(200, len(question) * 4):
+        return _concat_query(history, question)
+    return rewritten
+
+
+def _concat_query(history, question):
+    turns = history.get("turns") or []
+    if turns:
+        return f"{turns[-1][0]} {question}"
+    return question
+
+
+def rewrite_query(history, question):
+    """
+    履歴を踏まえた検索用の質問を返す（履歴がなければそのまま）
+    CHATBOT_QUERY_REWRITE: "llm"（LLMで書き換え）/ "concat"（直前の質問とつなげる）/ "off"
+    """
+    mode = _setting("CHATBOT_QUERY_REWRITE", "llm")
+    if mode == "off" or not history:
+        return question
+    if mode == "concat":
+        return _concat_query(history, question)
+    try:
+        return _clean_rewrite(llm.generate(build_rewrite_prompt(history, question)), question, history)
+    except Exception as e:
+        logger.error(f"Query rewrite failed: {e}")
+        return _concat_query(history, question)
+
+
+async def arewrite_query(history, question):
+    mode = _setting("CHATBOT_QUERY_REWRITE", "llm")
+    if mode == "off" or not history:
+        return question
+    if mode == "concat":
+        return _concat_query(history, question)
+    try:
+        return _clean_rewrite(await llm.agenerate(build_rewrite_prompt(history, question)), question, history)
+    except Exception as e:
+        logger.error(f"Query rewrite failed: {e}")
+        return _concat_query(history, question)
@@ -0,0 +1,257 @@
+import hashlib
+import math
+import sqlite3
+import threading
+from array import array
+from pathlib import Path
+
+from django.conf import settings
+
+from config import metrics
+
+# -----------------------------
+# 埋め込みキャッシュ（SQLite）
+# -----------------------------
+# キーは (モデルID, テキストのSHA-256)。
+# ヘッダー・申請様式などの同一テキストや、再インデックス時に同じベクトルを再計算しないために使う
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS embeddings ("
+                        " model_id TEXT NOT NULL,"
+                        " text_hash TEXT NOT NULL,"
+                        " vector BLOB NOT NULL,"
+                        " PRIMARY KEY (model_id, text_hash))"
+                    )
+                    conn.commit()
+                    self._initialized = True
+        return conn
+
+    def get_many(self, model_id, hashes):
+        """ハッシュ → ベクトル(list[float]) の辞書を返す（見つかったものだけ）"""
+        conn = self._connect()
+        found = {}
+        hashes = list(hashes)
+        # SQLite のバインド変数上限を避けるため分割して問い合わせる
+        for i in range(0, len(hashes), 500):
+            part = hashes[i:i + 500]
+            placeholders = ",".join("?" * len(part))
+            rows = conn.execute(
+                f"SELECT text_hash, vector FROM embeddings WHERE model_id = ? AND text_hash IN ({placeholders})",
+                [model_id, *part],
+            )
+            for h, blob in rows:
+                found[h] = array("f", blob).tolist()
+        return found
+
+    def put_many(self, model_id, items):
+        """items: [(ハッシュ, ベクトル), ...]"""
+        conn = self._connect()
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (model_id, text_hash, vector) VALUES (?, ?, ?)",
+            [(model_id, h, array("f", [float(x) for x in vec]).tobytes()) for h, vec in items],
+        )
+        conn.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache(
+                    getattr(settings, "CHATBOT_EMBEDDING_CACHE_PATH", settings.BASE_DIR / "embedding_cache.sqlite3")
+                )
+    return _cache
+
+
+def reset_embedding_cache():
+    """キャッシュの保存先を切り替えたとき用（ベンチマーク等）"""
+    global _cache
+    with _cache_lock:
+        _cache = None
+
+
+# -----------------------------
+# 埋め込みモデル
+# -----------------------------
+class HashingEmbeddingFunction:
+    """
+    文字バイグラムの特徴ハッシュによる埋め込み
+    ネットワーク・モデルファイル不要で決定的に動くため、オフラインのベンチマーク・検証用に使う
+    （検索精度は実運用向けではない）
+    """
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def _embed(self, text):
+        vec = [0.0] * self.dim
+        for i in range(max(1, len(text) - 1)):
+            gram = text[i:i + 2].encode("utf-8")
+            h = int.from_bytes(hashlib.blake2b(gram, digest_size=8).digest(), "little")
+            vec[h % self.dim] += 1.0 if (h >> 63) else -1.0
+        norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+        return [v / norm for v in vec]
+
+    def __call__(self, input):
+        return [self._embed(text) for text in input]
+
+
+class SentenceTransformerEmbeddingFunction:
+    """
+    ローカルに保存した sentence-transformers モデルによる埋め込み（日本語対応の多言語モデル用）
+    - backend="torch": PyTorch で実行。quantize=True なら Linear 層を int8 に動的量子化する
+    - backend="onnx":  ONNX Runtime で実行。onnx_file に量子化済みのファイル（例: onnx/model_qint8_avx2.onnx）を指定できる
+    モデルはネットワークから取得せず、model_path のファイルのみを使う
+    """
+
+    def __init__(self, model_path, backend="torch", quantize=False, onnx_file=None, batch_size=32, threads=None):
+        from sentence_transformers import SentenceTransformer
+
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+
+        kwargs = {"device": "cpu", "local_files_only": True}
+        if backend == "onnx":
+            kwargs["backend"] = "onnx"
+            if onnx_file:
+                kwargs["model_kwargs"] = {"file_name": onnx_file}
+        self.model = SentenceTransformer(str(model_path), **kwargs)
+
+        if backend == "torch" and quantize:
+            import torch
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        self.batch_size = batch_size
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def __call__(self, input):
+        vectors = self.model.encode(
+            list(input),
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return vectors.tolist()
+
+
+def _sentence_transformer_options():
+    model_path = getattr(settings, "CHATBOT_EMBEDDING_MODEL_PATH", None)
+    if not model_path:
+        raise ValueError("CHATBOT_EMBEDDING_MODEL_PATH is not set")
+    return {
+        "model_path": model_path,
+        "backend": getattr(settings, "CHATBOT_EMBEDDING_BACKEND", "torch"),
+        "quantize": getattr(settings, "CHATBOT_EMBEDDING_QUANTIZE", False),
+        "onnx_file": getattr(settings, "CHATBOT_EMBEDDING_ONNX_FILE", None),
+    }
+
+
+def model_id_for(provider):
+    """
+    CHATBOT_EMBEDDING_PROVIDER に対応するモデルID（モデルを読み込まずに求める）
+    埋め込みキャッシュのキーと、コレクションに記録するモデル名に使う
+    （量子化などでベクトルが変わる設定は別のIDになる）
+    """
+    if provider == "default":
+        return "chroma-default/all-MiniLM-L6-v2"
+    if provider == "hashing":
+        return f"hashing-bigram-{HashingEmbeddingFunction().dim}"
+    if provider == "sentence-transformers":
+        options = _sentence_transformer_options()
+        variant = options["backend"]
+        if options["backend"] == "torch" and options["quantize"]:
+            variant += "-int8"
+        if options["backend"] == "onnx" and options["onnx_file"]:
+            variant += "-" + Path(options["onnx_file"]).stem
+        return f"st/{Path(options['model_path']).name}/{variant}"
+    raise ValueError(f"Unknown embedding provider: {provider}")
+
+
+def create_embedding_function(provider):
+    """CHATBOT_EMBEDDING_PROVIDER に対応する (埋め込み関数, モデルID) を返す"""
+    model_id = model_id_for(provider)
+    if provider == "default":
+        from chromadb.utils import embedding_functions
+        return embedding_functions.DefaultEmbeddingFunction(), model_id
+    if provider == "hashing":
+        return HashingEmbeddingFunction(), model_id
+    return SentenceTransformerEmbeddingFunction(
+        **_sentence_transformer_options(),
+        batch_size=getattr(settings, "CHATBOT_EMBEDDING_BATCH_SIZE", 32),
+        threads=getattr(settings, "CHATBOT_EMBEDDING_THREADS", None),
+    ), model_id
+
+
+# -----------------------------
+# バッチ埋め込み
+# -----------------------------
+_cache_lookups = metrics.counter(
+    "chatbot_embedding_cache_lookups", "Texts whose embedding was found in the cache or computed.", ["result"]
+)
+_batch_size_hist = metrics.histogram(
+    "chatbot_embedding_batch_size", "Number of texts per embedding batch.", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+
+def embed_texts(texts, embedding_function, model_id, batch_size=None, use_cache=True):
+    """
+    テキストのリストを埋め込みベクトルのリストに変換する
+    - キャッシュ済みのテキストは再計算しない
+    - 同じテキストが複数回出てきても1回だけ計算する
+    - 未計算のテキストは batch_size 件ずつ埋め込む（メモリ使用量を一定に保つ）
+    """
+    batch_size = batch_size or getattr(settings, "CHATBOT_EMBEDDING_BATCH_SIZE", 32)
+    hashes = [text_hash(t) for t in texts]
+
+    vectors = {}
+    if use_cache:
+        vectors = get_embedding_cache().get_many(model_id, set(hashes))
+
+    missing = {}
+    for h, t in zip(hashes, texts):
+        if h not in vectors and h not in missing:
+            missing[h] = t
+
+    if missing:
+        missing_hashes = list(missing)
+        for i in range(0, len(missing_hashes), batch_size):
+            batch_hashes = missing_hashes[i:i + batch_size]
+            _batch_size_hist.observe(len(batch_hashes))
+            with metrics.timer("embedding", model=model_id, texts=len(batch_hashes)):
+                batch_vectors = embedding_function([missing[h] for h in batch_hashes])
+            computed = [(h, [float(x) for x in vec]) for h, vec in zip(batch_hashes, batch_vectors)]
+            vectors.update(computed)
+            if use_cache:
+                get_embedding_cache().put_many(model_id, computed)
+
+    _cache_lookups.inc(len(texts) - len(missing), result="cached")
+    _cache_lookups.inc(len(missing), result="computed")
+    print(f"[INFO] Embedded {len(texts)} texts ({len(texts) - len(missing)} cached, {len(missing)} computed).")
+    return [vectors[h] for h in hashes]
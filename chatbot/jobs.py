@@ -0,0 +1,210 @@
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from config import metrics
+
+from .models import IngestJob
+
+logger = logging.getLogger(__name__)
+
+_job_results = metrics.counter("chatbot_ingest_jobs", "Ingest job attempts by resulting status.", ["status"])
+
+# -----------------------------
+# 設定値（settings.py で上書き可能）
+# -----------------------------
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# -----------------------------
+# ジョブ登録
+# -----------------------------
+def enqueue_pdf(pdf_path, original_name, municipality_id=None):
+    """
+    取り込みジョブを登録して即座に返す
+    実際の抽出・登録はワーカースレッド（または run_ingest_worker コマンド）が行う
+    """
+    job = IngestJob.objects.create(
+        pdf_path=str(pdf_path),
+        original_name=original_name,
+        municipality_id=municipality_id,
+        max_attempts=_setting("CHATBOT_INGEST_MAX_ATTEMPTS", 3),
+    )
+    # コミット後にワーカーを起こす（未コミットのジョブを取りに行かないように）
+    transaction.on_commit(notify_workers)
+    return job
+
+
+def retry_job(job):
+    """失敗したジョブを再度キューに戻す（試行回数はリセット）"""
+    job.status = IngestJob.STATUS_PENDING
+    job.attempts = 0
+    job.run_after = None
+    job.locked_at = None
+    job.finished_at = None
+    job.save(update_fields=["status", "attempts", "run_after", "locked_at", "finished_at", "updated_at"])
+    transaction.on_commit(notify_workers)
+    return job
+
+
+def job_to_dict(job):
+    return {
+        "job_id": job.pk,
+        "filename": job.original_name,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "error": job.last_error,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+# -----------------------------
+# ジョブ取得・実行
+# -----------------------------
+def claim_next_job():
+    """
+    実行可能なジョブを1件ロックして取得する
+    - SELECT ... FOR UPDATE SKIP LOCKED で複数ワーカー・複数プロセス間の重複取得を防ぐ
+    - ロック時刻が古い「処理中」ジョブは、ワーカーが落ちたものとみなして回収する
+    """
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=_setting("CHATBOT_INGEST_LOCK_TIMEOUT", 30 * 60))
+
+    with transaction.atomic():
+        job = (
+            IngestJob.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=IngestJob.STATUS_PENDING, run_after__isnull=True)
+                | Q(status=IngestJob.STATUS_PENDING, run_after__lte=now)
+                | Q(status=IngestJob.STATUS_RUNNING, locked_at__lt=stale_before)
+            )
+            .order_by("created_at")
+            .first()
+        )
+        if job is None:
+            return None
+
+        job.status = IngestJob.STATUS_RUNNING
+        job.attempts += 1
+        job.locked_at = now
+        job.save(update_fields=["status", "attempts", "locked_at", "updated_at"])
+
+    return job
+
+
+def run_job(job):
+    """ジョブを1件実行し、結果（完了・リトライ待ち・失敗）を保存する"""
+    from .utils import process_pdf_and_update_index
+
+    print(f"[INFO] Ingest job {job.pk} started: {job.original_name} (attempt {job.attempts}/{job.max_attempts})")
+
+    try:
+        with metrics.timer("ingest", job=job.pk, attempt=job.attempts) as fields:
+            fields.update(process_pdf_and_update_index(
+                job.pdf_path, municipality_id=job.municipality_id, source_name=job.original_name
+            ))
+    except Exception as e:
+        logger.error(f"Ingest job {job.pk} failed: {e}")
+        job.last_error = str(e)
+        job.locked_at = None
+
+        if job.attempts >= job.max_attempts:
+            job.status = IngestJob.STATUS_FAILED
+            job.finished_at = timezone.now()
+        else:
+            # 指数バックオフで再試行
+            backoff = _setting("CHATBOT_INGEST_RETRY_BACKOFF", 30) * (2 ** (job.attempts - 1))
+            job.status = IngestJob.STATUS_PENDING
+            job.run_after = timezone.now() + timedelta(seconds=backoff)
+    else:
+        job.status = IngestJob.STATUS_DONE
+        job.last_error = ""
+        job.locked_at = None
+        job.finished_at = timezone.now()
+        print(f"[INFO] Ingest job {job.pk} finished: {job.original_name}")
+
+    job.save()
+    _job_results.inc(status=job.status)
+    return job
+
+
+# -----------------------------
+# ワーカープール（プロセス内スレッド）
+# -----------------------------
+class IngestWorkerPool:
+    def __init__(self, num_workers, poll_interval):
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self._run, name=f"ingest-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def notify(self):
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wakeup.set()
+        for t in self._threads:
+            t.join(timeout)
+
+    def join(self):
+        for t in self._threads:
+            t.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = claim_next_job()
+                if job is None:
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+                    continue
+                run_job(job)
+            except Exception as e:
+                logger.error(f"Ingest worker error: {e}")
+                self._stop.wait(self.poll_interval)
+            finally:
+                close_old_connections()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def start_workers(num_workers=None):
+    """ワーカープールを起動する（起動済みならそれを返す）"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = IngestWorkerPool(
+                num_workers=num_workers or _setting("CHATBOT_INGEST_WORKERS", 2),
+                poll_interval=_setting("CHATBOT_INGEST_POLL_INTERVAL", 5),
+            )
+            _pool.start()
+        return _pool
+
+
+def ensure_workers_started():
+    """CHATBOT_INGEST_AUTOSTART が有効なら、Webプロセス内でワーカーを起動する"""
+    if _setting("CHATBOT_INGEST_AUTOSTART", True):
+        start_workers()
+
+
+def notify_workers():
+    if _pool is not None:
+        _pool.notify()
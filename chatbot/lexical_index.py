@@ -0,0 +1,173 @@
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+from django.conf import settings
+
+# -----------------------------
+# 語彙検索インデックス（SQLite FTS5）
+# -----------------------------
+# 英語向けの埋め込みモデルでは、地名・固有名詞・様式番号などの完全一致が拾えないため、
+# 文字 n-gram の全文検索インデックスを pdf_collection と並べて管理する。
+# - 日本語（漢字・かな）は文字バイグラム、英数字は単語単位でトークン化して FTS5 に登録する
+# - ランキングは FTS5 の bm25()
+# - ID は pdf_collection と同じものを使い、登録・削除も同じタイミングで行う
+
+# 英数字の連続、または日本語文字（漢字・ひらがな・カタカナ）の連続
+_TOKEN_RUNS = re.compile(r"[0-9a-z]+|[぀-ヿ㐀-䶿一-鿿豈-﫿々〆ヵヶ]+")
+# 1つの質問から作る検索語の上限（長い質問でも検索時間を一定に保つ）
+MAX_QUERY_TERMS = 64
+
+
+def ngram_tokens(text):
+    """検索用トークン列（日本語は文字バイグラム、英数字は単語）"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for run in _TOKEN_RUNS.findall(text):
+        if run.isascii():
+            tokens.append(run)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def _match_expression(query):
+    terms = list(dict.fromkeys(ngram_tokens(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    return " OR ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+
+class LexicalIndex:
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(
+                        """
+                        CREATE TABLE IF NOT EXISTS docs (
+                            id INTEGER PRIMARY KEY,
+                            doc_id TEXT NOT NULL UNIQUE,
+                            source TEXT
+                        );
+                        CREATE INDEX IF NOT EXISTS docs_source ON docs (source);
+                        CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(tokens, tokenize = 'unicode61');
+                        """
+                    )
+                    conn.commit()
+                    self._initialized = True
+        return conn
+
+    def _delete_rows(self, conn, doc_ids):
+        for i in range(0, len(doc_ids), 500):
+            part = doc_ids[i:i + 500]
+            placeholders = ",".join("?" * len(part))
+            rowids = [r[0] for r in conn.execute(f"SELECT id FROM docs WHERE doc_id IN ({placeholders})", part)]
+            if rowids:
+                marks = ",".join("?" * len(rowids))
+                conn.execute(f"DELETE FROM chunks WHERE rowid IN ({marks})", rowids)
+                conn.execute(f"DELETE FROM docs WHERE id IN ({marks})", rowids)
+
+    def upsert(self, doc_ids, texts, metadatas):
+        conn = self._connect()
+        with conn:
+            self._delete_rows(conn, list(doc_ids))
+            for doc_id, text, meta in zip(doc_ids, texts, metadatas):
+                cur = conn.execute(
+                    "INSERT INTO docs (doc_id, source) VALUES (?, ?)",
+                    (doc_id, (meta or {}).get("source")),
+                )
+                conn.execute(
+                    "INSERT INTO chunks (rowid, tokens) VALUES (?, ?)",
+                    (cur.lastrowid, " ".join(ngram_tokens(text))),
+                )
+
+    def delete(self, doc_ids):
+        conn = self._connect()
+        with conn:
+            self._delete_rows(conn, list(doc_ids))
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM chunks")
+            conn.execute("DELETE FROM docs")
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def search(self, query, limit=30):
+        """bm25 の高い順に [(ID, スコア), ...] を返す"""
+        expression = _match_expression(query)
+        if expression is None:
+            return []
+
+        started = time.perf_counter()
+        rows = self._connect().execute(
+            "SELECT docs.doc_id, bm25(chunks) AS score FROM chunks"
+            " JOIN docs ON docs.id = chunks.rowid"
+            " WHERE chunks MATCH ? ORDER BY score LIMIT ?",
+            (expression, limit),
+        ).fetchall()
+        print(f"[INFO] Lexical search: {len(rows)} hits in {(time.perf_counter() - started) * 1000:.1f}ms")
+        # bm25() は小さいほど関連が高い（負の値）ので符号を反転する
+        return [(doc_id, -score) for doc_id, score in rows]
+
+
+_indexes = {}
+_index_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, "CHATBOT_HYBRID_SEARCH", True)
+
+
+def index_path(municipality_id=None):
+    """自治体ごとに別ファイルに分ける（検索対象がその自治体の資料だけになる）"""
+    path = Path(getattr(settings, "CHATBOT_LEXICAL_INDEX_PATH", settings.BASE_DIR / "lexical_index.sqlite3"))
+    if municipality_id is None:
+        return path
+    return path.with_name(f"{path.stem}_m{municipality_id}{path.suffix}")
+
+
+def get_lexical_index(municipality_id=None):
+    index = _indexes.get(municipality_id)
+    if index is None:
+        with _index_lock:
+            index = _indexes.get(municipality_id)
+            if index is None:
+                index = LexicalIndex(index_path(municipality_id))
+                _indexes[municipality_id] = index
+    return index
+
+
+def reset_lexical_indexes():
+    with _index_lock:
+        _indexes.clear()
+
+
+def rebuild_from_collection(collection, municipality_id=None, batch_size=500):
+    """ChromaDB のコレクションの内容から語彙インデックスを作り直す（既存データの移行用）"""
+    index = get_lexical_index(municipality_id)
+    index.clear()
+    total = collection.count()
+    for offset in range(0, total, batch_size):
+        page = collection.get(limit=batch_size, offset=offset, include=["documents", "metadatas"])
+        index.upsert(page["ids"], page["documents"], page["metadatas"])
+    return index.count()
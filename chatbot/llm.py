@@ -0,0 +1,356 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from config import metrics
+
+# -----------------------------
+# LLM バックエンド
+# -----------------------------
+# 生成処理は settings.CHATBOT_LLM_BACKEND で選んだバックエンドに委ねる。
+#   "gemini": Gemini API（本番）
+#   "fake":   APIを呼ばずに定型文を返す偽モデル（画面確認・負荷試験用）
+#   その他:   LLMBackend を継承したクラスのドット区切りパス
+# 呼び出し側は generate / stream / agenerate を使う。
+# 同じプロンプトの生成が実行中なら新たに生成せず、その結果を共有する（シングルフライト）。
+SYSTEM_INSTRUCTION = "あなたは自治体の親切な窓口担当AIです。提供された「参考資料」の内容のみに基づいて回答してください。"
+
+FAKE_TEXT = (
+    "これはテスト用の回答です。"
+    "実際の回答は Gemini が参考資料に基づいて生成します。"
+    "詳細は市役所の担当課までお問い合わせください。"
+)
+
+
+class LLMBackend:
+    """バックエンドの共通インターフェース（テキストを受け取りテキストを返す）"""
+
+    name = "base"
+
+    def generate(self, prompt):
+        raise NotImplementedError
+
+    def stream(self, prompt):
+        """生成されたテキストを断片ごとに yield する（既定では一括生成して1回で返す）"""
+        yield self.generate(prompt)
+
+    async def agenerate(self, prompt):
+        """既定ではスレッドで generate を実行する"""
+        return await asyncio.to_thread(self.generate, prompt)
+
+
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+
+    def __init__(self, model_name=None, system_instruction=SYSTEM_INSTRUCTION):
+        import google.generativeai as genai
+
+        # 環境変数からAPIキーを取得
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            raise ValueError("GEMINI_API_KEY environment variable is not set")
+
+        genai.configure(api_key=api_key)
+
+        # ※ system_instruction を設定することで、キャラ付けとガードレールを強化
+        self.model = genai.GenerativeModel(
+            model_name=model_name or getattr(settings, "CHATBOT_GEMINI_MODEL", "gemini-2.0-flash"),
+            system_instruction=system_instruction,
+        )
+
+    def generate(self, prompt):
+        return self.model.generate_content(prompt).text
+
+    def stream(self, prompt):
+        for chunk in self.model.generate_content(prompt, stream=True):
+            text = chunk.text
+            if text:
+                yield text
+
+    async def agenerate(self, prompt):
+        response = await self.model.generate_content_async(prompt)
+        return response.text
+
+
+class FakeBackend(LLMBackend):
+    """定型文を chunk_chars 文字ずつ、delay 秒間隔で返す"""
+
+    name = "fake"
+
+    def __init__(self, text=None, chunk_chars=8, delay=None):
+        self.text = text or getattr(settings, "CHATBOT_FAKE_LLM_TEXT", None) or FAKE_TEXT
+        self.chunk_chars = chunk_chars
+        self.delay = getattr(settings, "CHATBOT_FAKE_LLM_DELAY", 0.05) if delay is None else delay
+
+    def _total_delay(self):
+        # 全体の生成時間はストリーミング時と同じにする
+        return self.delay * ((len(self.text) + self.chunk_chars - 1) // self.chunk_chars)
+
+    def generate(self, prompt):
+        time.sleep(self._total_delay())
+        return self.text
+
+    def stream(self, prompt):
+        for i in range(0, len(self.text), self.chunk_chars):
+            time.sleep(self.delay)
+            yield self.text[i:i + self.chunk_chars]
+
+    async def agenerate(self, prompt):
+        await asyncio.sleep(self._total_delay())
+        return self.text
+
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "fake": FakeBackend,
+}
+
+
+def create_backend(name):
+    backend_class = BACKENDS.get(name)
+    if backend_class is None:
+        try:
+            backend_class = import_string(name)
+        except ImportError:
+            raise ValueError(f"Unknown LLM backend: {name}")
+    return backend_class()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """設定されたバックエンド（初回呼び出し時に生成）"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend(getattr(settings, "CHATBOT_LLM_BACKEND", "gemini"))
+    return _backend
+
+
+def reset_backend():
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+# -----------------------------
+# シングルフライト（同一プロンプトの生成をまとめる）
+# -----------------------------
+# 緊急情報の発表直後などに同じ質問が集中すると、検索結果もプロンプトも同一になる。
+# 実行中の生成があればそれに相乗りし、1回の生成結果を全員に返す。
+# （相乗りするのは実行中の間だけ。完了後の再利用は回答キャッシュの役割）
+_calls = metrics.counter(
+    "chatbot_llm_calls", "LLM calls that ran a generation (leaders) or shared one in flight (coalesced).", ["role"]
+)
+
+
+def _incr(key):
+    _calls.inc(role=key)
+
+
+def get_stats():
+    """生成回数と相乗りした回数（このプロセス内の累計）"""
+    return {key: _calls.value(role=key) for key in ("leaders", "coalesced")}
+
+
+def is_coalescing_enabled():
+    return getattr(settings, "CHATBOT_LLM_COALESCE", True)
+
+
+def prompt_key(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.done = False
+        self.error = None
+
+
+class SingleFlight:
+    """
+    スレッド間のシングルフライト
+    - do:     最初の呼び出し（リーダー）だけが fn を実行し、同時に来た呼び出しはその結果を待つ
+    - stream: リーダーが生成した断片を、相乗りした呼び出しにも順に流す
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def _join(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = _Call()
+            return call, True
+
+    def _finish(self, key, call, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        with call.cond:
+            call.error = error
+            call.done = True
+            call.cond.notify_all()
+
+    def do(self, key, fn):
+        call, leader = self._join(key)
+        if not leader:
+            _incr("coalesced")
+            with call.cond:
+                call.cond.wait_for(lambda: call.done)
+            if call.error is not None:
+                raise call.error
+            return call.chunks[0]
+
+        _incr("leaders")
+        try:
+            result = fn()
+        except Exception as e:
+            self._finish(key, call, e)
+            raise
+        call.chunks.append(result)
+        self._finish(key, call)
+        return result
+
+    def stream(self, key, fn):
+        call, leader = self._join(key)
+        if not leader:
+            _incr("coalesced")
+            yield from self._follow(call)
+            return
+
+        _incr("leaders")
+        error = None
+        try:
+            for chunk in fn():
+                with call.cond:
+                    call.chunks.append(chunk)
+                    call.cond.notify_all()
+                yield chunk
+        except GeneratorExit:
+            # リーダーの接続が切れた場合、相乗り側には途中までの回答を完成品として渡さない
+            error = RuntimeError("Shared generation was cancelled")
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._finish(key, call, error)
+
+    def _follow(self, call):
+        sent = 0
+        while True:
+            with call.cond:
+                call.cond.wait_for(lambda: call.done or len(call.chunks) > sent)
+                pending = call.chunks[sent:]
+                done = call.done
+            sent += len(pending)
+            yield from pending
+            if done:
+                if call.error is not None:
+                    raise call.error
+                return
+
+
+class AsyncSingleFlight:
+    """
+    非同期版のシングルフライト（プロセス全体で共有する）
+    WSGI・runserver ではリクエストごとにイベントループが違うため、結果はスレッドセーフな
+    concurrent.futures.Future で共有し、相乗りした側は自分のループで待つ
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    async def do(self, key, fn):
+        with self._lock:
+            shared = self._calls.get(key)
+            leader = shared is None
+            if leader:
+                shared = self._calls[key] = concurrent.futures.Future()
+
+        if not leader:
+            _incr("coalesced")
+            # 相乗りした側がキャンセルされても、共有中の生成は止めない
+            return await asyncio.shield(asyncio.wrap_future(shared))
+
+        _incr("leaders")
+        try:
+            result = await fn()
+        except BaseException as e:
+            shared.set_exception(e if isinstance(e, Exception) else RuntimeError("Shared generation was cancelled"))
+            raise
+        else:
+            shared.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+
+_flight = SingleFlight()
+_async_flight = AsyncSingleFlight()
+
+
+# -----------------------------
+# 処理時間の計測
+# -----------------------------
+# 計測するのは実際にバックエンドを呼んだ分だけ（相乗りした呼び出しは含めない）
+def _timed_generate(backend, prompt):
+    with metrics.timer("llm", backend=backend.name, mode="generate"):
+        return backend.generate(prompt)
+
+
+def _timed_stream(backend, prompt):
+    """全体の時間（llm）に加えて、最初の断片が届くまでの時間（llm_first_token）を記録する"""
+    started = time.perf_counter()
+    first = True
+    with metrics.timer("llm", backend=backend.name, mode="stream"):
+        for chunk in backend.stream(prompt):
+            if first:
+                metrics.observe_stage("llm_first_token", time.perf_counter() - started, backend=backend.name)
+                first = False
+            yield chunk
+
+
+async def _timed_agenerate(backend, prompt):
+    with metrics.timer("llm", backend=backend.name, mode="async"):
+        return await backend.agenerate(prompt)
+
+
+# -----------------------------
+# 呼び出し口
+# -----------------------------
+def generate(prompt):
+    backend = get_backend()
+    if not is_coalescing_enabled():
+        return _timed_generate(backend, prompt)
+    return _flight.do(prompt_key(prompt), lambda: _timed_generate(backend, prompt))
+
+
+def stream(prompt):
+    backend = get_backend()
+    if not is_coalescing_enabled():
+        return _timed_stream(backend, prompt)
+    return _flight.stream(prompt_key(prompt), lambda: _timed_stream(backend, prompt))
+
+
+async def agenerate(prompt):
+    backend = await asyncio.to_thread(get_backend)
+    if not is_coalescing_enabled():
+        return await _timed_agenerate(backend, prompt)
+    return await _async_flight.do(prompt_key(prompt), lambda: _timed_agenerate(backend, prompt))
@@ -0,0 +1,60 @@
+import json
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# 新しいPythonプロセスで Django を起動し、chatbot.views の読み込みまでの時間を計測する
+# eager: 読み込み直後に warm_up() を実行（以前の「インポート時に全初期化」と同等のコスト）
+STARTUP_SCRIPT = """
+import json, os, time
+started = time.perf_counter()
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+import django
+django.setup()
+import chatbot.views
+imported = time.perf_counter()
+if {eager!r}:
+    from chatbot.utils import warm_up
+    warm_up(include_llm={include_llm!r})
+finished = time.perf_counter()
+print("__RESULT__" + json.dumps({{"import": imported - started, "total": finished - started}}))
+"""
+
+
+class Command(BaseCommand):
+    help = "チャットボットの起動時間を計測する（遅延初期化 vs 起動時に全初期化）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5, help="各モードの試行回数")
+        parser.add_argument("--include-llm", action="store_true", help="eager モードで Gemini クライアントも初期化する")
+
+    def _run_once(self, eager, include_llm):
+        script = STARTUP_SCRIPT.format(eager=eager, include_llm=include_llm)
+        proc = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+        )
+        for line in proc.stdout.splitlines():
+            if line.startswith("__RESULT__"):
+                return json.loads(line[len("__RESULT__"):])
+        raise RuntimeError(f"startup failed:\n{proc.stderr}")
+
+    def handle(self, *args, **options):
+        results = {}
+        for label, eager in (("lazy (after)", False), ("eager (before)", True)):
+            # 1回目はOSのファイルキャッシュの影響が大きいため捨てる
+            self._run_once(eager, options["include_llm"])
+            runs = [self._run_once(eager, options["include_llm"]) for _ in range(options["runs"])]
+            results[label] = {
+                "import_median": statistics.median(r["import"] for r in runs),
+                "total_median": statistics.median(r["total"] for r in runs),
+            }
+
+        self.stdout.write(f"{'mode':<16}{'import (s)':>12}{'ready (s)':>12}")
+        for label, r in results.items():
+            self.stdout.write(f"{label:<16}{r['import_median']:>12.3f}{r['total_median']:>12.3f}")
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+# 使い方（例）:
+#   CHATBOT_LLM_BACKEND=fake CHATBOT_RATE_LIMIT_ENABLED=0 uvicorn config.asgi:application --workers 1
+#   python manage.py chat_loadtest --url http://127.0.0.1:8000/chatbot/api/ --concurrency 1,8,32,128
+# 同時接続数ごとのスループットとレイテンシを表示し、ワーカー1つあたりの伸び方を確認する
+# 全リクエストが同じIPから送られるため、サーバーはレート制限を無効（CHATBOT_RATE_LIMIT_ENABLED=0）にして起動する。
+# 有効のままだと大半が 429 になり、チャット処理ではなくレート制限を測ることになる（429 は別に数えて警告する）。
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+class Command(BaseCommand):
+    help = (
+        "chat_api に同時リクエストを送り、同時接続数ごとのスループットとレイテンシを計測する"
+        "（1つのIPから送るため、サーバーは CHATBOT_RATE_LIMIT_ENABLED=0 でレート制限を無効にして起動すること）"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000/chatbot/api/")
+        parser.add_argument("--concurrency", default="1,8,32,128", help="カンマ区切りの同時接続数")
+        parser.add_argument("--requests", type=int, default=200, help="各段階で送るリクエスト数")
+        parser.add_argument("--question", default="ごみの出し方について教えてください")
+        parser.add_argument(
+            "--same-question", action="store_true",
+            help="全リクエストで同じ質問を送る（既定では回答キャッシュに当たらないよう番号を付ける）",
+        )
+        parser.add_argument("--timeout", type=float, default=120.0)
+        parser.add_argument("--output", help="結果をJSONで保存するパス")
+
+    async def _run_level(self, client, url, concurrency, total, question, same_question):
+        latencies = []
+        errors = 0
+        rate_limited = 0
+        counter = iter(range(total))
+
+        async def worker():
+            nonlocal errors, rate_limited
+            for i in counter:
+                q = question if same_question else f"{question} ({i})"
+                started = time.perf_counter()
+                try:
+                    res = await client.post(url, json={"question": q})
+                    if res.status_code == 429:
+                        rate_limited += 1
+                        continue
+                    if res.status_code != 200:
+                        errors += 1
+                        continue
+                except Exception:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+        return {
+            "concurrency": concurrency,
+            "requests": total,
+            "errors": errors,
+            "rate_limited": rate_limited,
+            "elapsed": elapsed,
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "mean": statistics.mean(latencies) if latencies else 0.0,
+        }
+
+    async def _run(self, options, levels):
+        import httpx
+
+        limits = httpx.Limits(max_connections=max(levels), max_keepalive_connections=max(levels))
+        async with httpx.AsyncClient(timeout=options["timeout"], limits=limits) as client:
+            results = []
+            for level in levels:
+                result = await self._run_level(
+                    client, options["url"], level, options["requests"],
+                    options["question"], options["same_question"],
+                )
+                results.append(result)
+                self.stdout.write(
+                    f"{level:>6} {result['throughput']:>10.1f} {result['p50'] * 1000:>9.0f} "
+                    f"{result['p95'] * 1000:>9.0f} {result['errors']:>7} {result['rate_limited']:>7}"
+                )
+            return results
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(x) for x in options["concurrency"].split(",") if x.strip()]
+        except ValueError:
+            raise CommandError("--concurrency はカンマ区切りの整数で指定してください")
+
+        self.stdout.write(f"{'conc':>6} {'req/s':>10} {'p50(ms)':>9} {'p95(ms)':>9} {'errors':>7} {'429':>7}")
+        results = asyncio.run(self._run(options, levels))
+        if any(r["rate_limited"] for r in results):
+            self.stdout.write(self.style.WARNING(
+                "Some requests were rate limited (429); the numbers above include the rate limiter. "
+                "Restart the server with CHATBOT_RATE_LIMIT_ENABLED=0 to measure the chat pipeline."
+            ))
+
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                json.dump({"url": options["url"], "results": results}, f, ensure_ascii=False, indent=2)
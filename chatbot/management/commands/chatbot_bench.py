@@ -0,0 +1,295 @@
+import contextlib
+import io
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+# -----------------------------
+# RAG パイプラインのオフラインベンチマーク
+# -----------------------------
+# 使い方（例）:
+#   python manage.py chatbot_bench --pages 20 --sizes 100,1000,5000
+#   python manage.py chatbot_bench --compare bench_results/前回の結果.json
+# - 合成PDF（テキストPDF・画像のみのPDF）を生成し、各段階の処理時間を計測する
+# - ChromaDB・語彙インデックス・埋め込みキャッシュは一時ディレクトリに作るため、本番データには触れない
+# - LLM は偽モデル、埋め込みは既定で特徴ハッシュを使うので、ネットワークなしで動く
+# - 結果はJSONで保存し、コミット間で比較できる
+
+PLACES = ["名瀬", "住用", "笠利", "朝日町", "港町", "幸町", "浦上", "小湊", "赤羽", "王子"]
+FACILITIES = ["小学校", "公民館", "体育館", "市役所", "支所", "集会所", "図書館", "保健センター"]
+TOPICS = [
+    "燃えるごみは{day}曜日の朝8時までに指定の袋で出してください",
+    "資源ごみの回収は{day}曜日です",
+    "{facility}は指定緊急避難場所に指定されています",
+    "転入届は{facility}の窓口で受け付けています",
+    "粗大ごみは事前に電話で申し込みが必要です（様式第{num}号）",
+    "台風接近時は{facility}を避難所として開設します",
+    "{facility}の開館時間は午前9時から午後5時までです",
+]
+DAYS = ["月", "火", "水", "木", "金", "土"]
+QUESTIONS = [
+    "{place}のごみの日はいつですか",
+    "{place}の避難所を教えてください",
+    "{facility}の開館時間は？",
+    "粗大ごみの申し込み方法を教えてください",
+    "転入届はどこで出せますか",
+]
+
+
+def _sentence(rng):
+    return rng.choice(PLACES) + "地区では、" + rng.choice(TOPICS).format(
+        day=rng.choice(DAYS), facility=rng.choice(FACILITIES), num=rng.randint(1, 30)
+    ) + "。"
+
+
+def _chunk_text(rng, sentences=8):
+    return "".join(_sentence(rng) for _ in range(sentences))
+
+
+def _question(rng):
+    return rng.choice(QUESTIONS).format(place=rng.choice(PLACES), facility=rng.choice(FACILITIES))
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+
+    def pick(p):
+        return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+    return {"p50": pick(50), "p95": pick(95), "p99": pick(99)}
+
+
+def _max_rss_mb():
+    # Linux では KB 単位（プロセス開始からの最大値）
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def make_pdf(path, rng, pages, image_only=False):
+    """合成PDFを作る。image_only=True の場合は各ページを画像化してテキスト層を持たないPDFにする"""
+    import fitz
+
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page(width=595, height=842)
+        text = "\n".join(_sentence(rng) for _ in range(25))
+        page.insert_textbox(fitz.Rect(40, 40, 555, 802), text, fontname="japan", fontsize=10)
+
+    if image_only:
+        scanned = fitz.open()
+        for page in doc:
+            pix = page.get_pixmap(dpi=150)
+            new_page = scanned.new_page(width=page.rect.width, height=page.rect.height)
+            new_page.insert_image(new_page.rect, pixmap=pix)
+        doc = scanned
+
+    doc.save(str(path))
+    return path
+
+
+class Command(BaseCommand):
+    help = "チャットボットのRAGパイプラインを合成データでベンチマークする（オフライン）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pages", type=int, default=10, help="合成PDFのページ数")
+        parser.add_argument("--sizes", default="100,1000,5000", help="検索を計測するコーパスサイズ（チャンク数, カンマ区切り）")
+        parser.add_argument("--queries", type=int, default=100, help="各コーパスサイズで実行する質問数")
+        parser.add_argument(
+            "--embedder", default="hashing", choices=["hashing", "default"],
+            help="hashing: オフライン用の特徴ハッシュ / default: ChromaDB 標準モデル（モデルファイルが必要）",
+        )
+        parser.add_argument("--skip-ocr", action="store_true", help="OCR段階を省略する（tesseract がない環境など）")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="結果JSONの保存先（既定: bench_results/<日時>_<コミット>.json）")
+        parser.add_argument("--compare", help="比較対象の結果JSON")
+
+    # -----------------------------
+    # 計測ヘルパー
+    # -----------------------------
+    def _stage(self, results, name, func, units=None, unit_name=None):
+        """func を実行して経過時間・スループット・最大RSSを記録する"""
+        started = time.perf_counter()
+        try:
+            # 各関数の [INFO] ログは計測結果に不要なので捨てる
+            with contextlib.redirect_stdout(io.StringIO()):
+                value = func()
+        except Exception as e:
+            results[name] = {"skipped": str(e)}
+            self.stdout.write(f"  {name:<28} skipped: {e}")
+            return None
+        elapsed = time.perf_counter() - started
+
+        entry = {"seconds": elapsed, "max_rss_mb": _max_rss_mb()}
+        if units is not None:
+            count = units(value) if callable(units) else units
+            entry[unit_name] = count / elapsed if elapsed else 0.0
+        results[name] = entry
+
+        rate = f"{entry[unit_name]:.1f} {unit_name}" if unit_name else ""
+        self.stdout.write(f"  {name:<28} {elapsed:>8.3f}s  {rate:<24} rss={entry['max_rss_mb']:.0f}MB")
+        return value
+
+    # -----------------------------
+    # 実行
+    # -----------------------------
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(x) for x in options["sizes"].split(",") if x.strip()]
+        except ValueError:
+            raise CommandError("--sizes はカンマ区切りの整数で指定してください")
+
+        rng = random.Random(options["seed"])
+        report = {
+            "meta": {
+                "commit": _git_commit(),
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "options": {k: options[k] for k in ("pages", "sizes", "queries", "embedder", "skip_ocr", "seed")},
+            },
+            "stages": {},
+            "corpus": {},
+        }
+
+        with tempfile.TemporaryDirectory(prefix="chatbot_bench_") as tmp:
+            tmp = Path(tmp)
+            overrides = {
+                "CHATBOT_CHROMA_PATH": tmp / "chroma",
+                "CHATBOT_LEXICAL_INDEX_PATH": tmp / "lexical.sqlite3",
+                "CHATBOT_EMBEDDING_CACHE_PATH": tmp / "embedding_cache.sqlite3",
+                "CHATBOT_EMBEDDING_PROVIDER": options["embedder"],
+                "CHATBOT_LLM_BACKEND": "fake",
+                "CHATBOT_FAKE_LLM_DELAY": 0,
+                # 同じ質問が繰り返されても検索を計測できるように回答キャッシュは切る
+                "CHATBOT_ANSWER_CACHE_ENABLED": False,
+                # 取り込みの計測で登録した共通コレクションを検索対象に含めず、指定した件数のコーパスだけを検索する
+                "CHATBOT_SEARCH_SHARED_COLLECTION": False,
+            }
+            with override_settings(**overrides):
+                from chatbot import utils
+
+                utils.reset_clients()
+                try:
+                    self._run(report, rng, tmp, sizes, options)
+                finally:
+                    utils.reset_clients()
+
+        output = options["output"]
+        if not output:
+            out_dir = Path(settings.BASE_DIR) / "bench_results"
+            out_dir.mkdir(exist_ok=True)
+            output = out_dir / f"{datetime.now():%Y%m%d-%H%M%S}_{report['meta']['commit']}.json"
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Results saved to {output}"))
+
+        if options["compare"]:
+            self._compare(report, options["compare"])
+
+    def _run(self, report, rng, tmp, sizes, options):
+        from chatbot import utils
+        from chatbot.embeddings import embed_texts
+        from chatbot.lexical_index import get_lexical_index
+
+        stages = report["stages"]
+        pages = options["pages"]
+
+        self.stdout.write("[ingestion]")
+        text_pdf = make_pdf(tmp / "text.pdf", rng, pages)
+        image_pdf = make_pdf(tmp / "image.pdf", rng, pages, image_only=True)
+
+        self._stage(stages, "extract_text_with_ocr(text)",
+                    lambda: utils.extract_text_with_ocr(str(text_pdf)), pages, "pages/sec")
+        if not options["skip_ocr"]:
+            self._stage(stages, "ocr(image)",
+                        lambda: utils.extract_text_with_ocr(str(image_pdf)), pages, "pages/sec")
+        self._stage(stages, "process_pdf_and_update_index",
+                    lambda: utils.process_pdf_and_update_index(str(text_pdf)), pages, "pages/sec")
+
+        embedder = utils.get_embedding_model()
+        model_id = utils.embedding_model_id()
+
+        for size in sizes:
+            self.stdout.write(f"[corpus {size} chunks]")
+            corpus = report["corpus"][str(size)] = {}
+            texts = [_chunk_text(rng) for _ in range(size)]
+            ids = [f"bench_{size}_{i}" for i in range(size)]
+            metadatas = [{"source": f"bench_{i // 20}.pdf", "page": i % 20 + 1} for i in range(size)]
+
+            vectors = self._stage(corpus, "embedding",
+                                  lambda: embed_texts(texts, embedder, model_id, use_cache=False), size, "chunks/sec")
+            if vectors is None:
+                continue
+
+            # コーパスサイズごとに別の自治体IDとして登録し、検索対象を分ける
+            collection = utils.get_collection(size)
+
+            def add():
+                # ChromaDB の1回あたりの登録件数上限を超えないよう分割する
+                for i in range(0, size, 1000):
+                    collection.add(
+                        ids=ids[i:i + 1000], documents=texts[i:i + 1000],
+                        embeddings=vectors[i:i + 1000], metadatas=metadatas[i:i + 1000],
+                    )
+
+            self._stage(corpus, "collection.add", add, size, "chunks/sec")
+            self._stage(corpus, "lexical_index.upsert",
+                        lambda: get_lexical_index(size).upsert(ids, texts, metadatas), size, "chunks/sec")
+
+            latencies = []
+
+            def ask_all():
+                for _ in range(options["queries"]):
+                    started = time.perf_counter()
+                    utils.ask_gemini(_question(rng), municipality_id=size)
+                    latencies.append(time.perf_counter() - started)
+
+            self._stage(corpus, "ask_gemini", ask_all, options["queries"], "queries/sec")
+            if latencies:
+                corpus["ask_gemini"].update({k: v * 1000 for k, v in _percentiles(latencies).items()})
+                self.stdout.write(
+                    "  query latency (ms)           "
+                    + "  ".join(f"{k}={corpus['ask_gemini'][k]:.1f}" for k in ("p50", "p95", "p99"))
+                )
+
+    def _compare(self, report, path):
+        with open(path, encoding="utf-8") as f:
+            previous = json.load(f)
+
+        self.stdout.write(f"\nCompared with {previous['meta'].get('commit')} ({path}):")
+
+        def rows(current, old, prefix):
+            for name, entry in current.items():
+                before = old.get(name, {})
+                for key in ("seconds", "p50", "p95", "p99", "max_rss_mb"):
+                    if key in entry and key in before and before[key]:
+                        change = (entry[key] - before[key]) / before[key] * 100
+                        self.stdout.write(
+                            f"  {prefix + name:<40} {key:<10} {before[key]:>10.3f} -> {entry[key]:>10.3f} ({change:+.1f}%)"
+                        )
+
+        rows(report["stages"], previous.get("stages", {}), "")
+        for size, entries in report["corpus"].items():
+            rows(entries, previous.get("corpus", {}).get(size, {}), f"[{size}] ")
@@ -0,0 +1,422 @@
+import re
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# -----------------------------
+# ChromaDB の保守・チューニング
+# -----------------------------
+# 使い方（例）:
+#   python manage.py chroma_maintenance stats
+#   python manage.py chroma_maintenance stats --delete-orphans
+#   python manage.py chroma_maintenance prune                 # 削除対象の確認のみ
+#   python manage.py chroma_maintenance prune --apply
+#   python manage.py chroma_maintenance rebuild --municipality 1 --M 32 --construction-ef 200 --search-ef 100
+#   python manage.py chroma_maintenance reembed
+#   python manage.py chroma_maintenance bench --municipality 1 --params 16:100:10,16:100:100,32:200:100
+#   python manage.py chroma_maintenance bench --synthetic 20000 --dim 384
+# - stats:   コレクションごとの件数・ディスク使用量と、どのコレクションにも属さないセグメント（孤立ディレクトリ）を表示する
+# - prune:   元のPDFが残っていない資料のチャンクを削除する（語彙インデックス・回答キャッシュも合わせて更新）
+# - rebuild: HNSW のパラメータを指定してコレクションを作り直す（埋め込みは再計算しない）
+# - reembed: 埋め込みモデルを変えたあと、保存済みのチャンクのテキストから現在のモデルでベクトルを作り直す
+# - bench:   パラメータごとに、総当たり検索に対する再現率と検索時間を比べる
+COLLECTION_PATTERN = re.compile(r"^pdf_collection(?:_m(\d+))?$")
+UUID_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+BATCH_SIZE = 1000
+
+
+def _dir_bytes(path):
+    return sum(p.stat().st_size for p in Path(path).rglob("*") if p.is_file())
+
+
+def _format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+
+
+def _municipality_of(name):
+    match = COLLECTION_PATTERN.match(name)
+    if not match:
+        return False, None
+    return True, int(match.group(1)) if match.group(1) else None
+
+
+def _iter_batches(collection, include):
+    """コレクションの全件を BATCH_SIZE 件ずつ取得する"""
+    offset = 0
+    while True:
+        batch = collection.get(include=include, limit=BATCH_SIZE, offset=offset)
+        if not batch["ids"]:
+            return
+        yield batch
+        offset += len(batch["ids"])
+
+
+def _hnsw_metadata(base, m=None, construction_ef=None, search_ef=None):
+    """既存のメタデータ（HNSW以外）を引き継ぎ、HNSW のパラメータを差し替える"""
+    metadata = {k: v for k, v in (base or {}).items() if not k.startswith("hnsw:")}
+    metadata["hnsw:space"] = "cosine"
+    params = dict(getattr(settings, "CHATBOT_HNSW_PARAMS", {}))
+    for key, value in (("M", m), ("construction_ef", construction_ef), ("search_ef", search_ef)):
+        if value is not None:
+            params[key] = value
+    metadata.update({f"hnsw:{k}": v for k, v in params.items()})
+    return metadata
+
+
+class Command(BaseCommand):
+    help = "ChromaDB のコレクションの状態確認・不要データの削除・HNSWの再構築・再埋め込みとベンチマーク"
+
+    def add_arguments(self, parser):
+        actions = parser.add_subparsers(dest="action", required=True)
+
+        stats = actions.add_parser("stats", help="件数・ディスク使用量・孤立セグメントを表示する")
+        stats.add_argument(
+            "--path", action="append",
+            help="ChromaDB の保存先（複数指定可。省略時は CHATBOT_CHROMA_PATH と vector_db/）",
+        )
+        stats.add_argument("--delete-orphans", action="store_true", help="孤立セグメントのディレクトリを削除する")
+
+        prune = actions.add_parser("prune", help="元のPDFが残っていない資料のチャンクを削除する")
+        prune.add_argument("--municipality", type=int, default=None, help="対象の自治体ID（省略時は全コレクション）")
+        prune.add_argument("--apply", action="store_true", help="実際に削除する（省略時は対象を表示するだけ）")
+
+        rebuild = actions.add_parser("rebuild", help="HNSW のパラメータを指定してコレクションを作り直す")
+        rebuild.add_argument("--municipality", type=int, default=None, help="対象の自治体ID（省略時は共通コレクション）")
+        rebuild.add_argument("--M", dest="m", type=int, help="各ノードの接続数（大きいほど高精度・高メモリ）")
+        rebuild.add_argument("--construction-ef", type=int, help="構築時の探索幅")
+        rebuild.add_argument("--search-ef", type=int, help="検索時の探索幅")
+
+        reembed = actions.add_parser("reembed", help="現在の埋め込みモデルでベクトルを作り直す（モデル変更後に実行）")
+        reembed.add_argument("--municipality", type=int, default=None, help="対象の自治体ID（省略時は全コレクション）")
+        reembed.add_argument("--force", action="store_true", help="同じモデルで作られたコレクションも作り直す")
+
+        bench = actions.add_parser("bench", help="HNSW のパラメータごとに再現率と検索時間を比べる")
+        bench.add_argument("--municipality", type=int, default=None, help="ベクトルを取得する自治体ID（省略時は共通コレクション）")
+        bench.add_argument("--synthetic", type=int, default=0, help="コレクションの代わりに指定件数の合成ベクトルを使う")
+        bench.add_argument("--dim", type=int, default=384, help="合成ベクトルの次元数")
+        bench.add_argument(
+            "--params", default="16:100:10,16:100:50,16:100:100,32:200:100,32:200:200",
+            help="M:construction_ef:search_ef のカンマ区切り",
+        )
+        bench.add_argument("--queries", type=int, default=200, help="質問として使うベクトル数（インデックスからは除外する）")
+        bench.add_argument("--k", type=int, default=10, help="再現率を測る上位件数")
+        bench.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        getattr(self, f"_{options['action']}")(options)
+
+    # -----------------------------
+    # stats
+    # -----------------------------
+    def _stats(self, options):
+        paths = options["path"]
+        if not paths:
+            paths = [str(getattr(settings, "CHATBOT_CHROMA_PATH", "chromadb_store"))]
+            legacy = Path(settings.BASE_DIR) / "vector_db"
+            if legacy.exists() and legacy.resolve() != Path(paths[0]).resolve():
+                paths.append(str(legacy))
+
+        for path in paths:
+            self._store_stats(Path(path), options["delete_orphans"])
+
+    def _store_stats(self, path, delete_orphans):
+        db_path = path / "chroma.sqlite3"
+        if not db_path.exists():
+            self.stdout.write(self.style.WARNING(f"{path}: chroma.sqlite3 not found"))
+            return
+
+        # セグメント情報は公開APIにないため、SQLite を読み取り専用で参照する
+        # （クライアントを開くと保存先に書き込みが発生するため、状態確認では使わない）
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            collections = dict(conn.execute("SELECT id, name FROM collections"))
+            segments = conn.execute("SELECT id, scope, collection FROM segments").fetchall()
+            counts = dict(conn.execute(
+                "SELECT s.collection, COUNT(e.id) FROM segments s"
+                " LEFT JOIN embeddings e ON e.segment_id = s.id"
+                " WHERE s.scope = 'METADATA' GROUP BY s.collection"
+            ))
+        finally:
+            conn.close()
+
+        self.stdout.write(f"{path}  (sqlite {_format_bytes(db_path.stat().st_size)}, total {_format_bytes(_dir_bytes(path))})")
+        vector_segments = {}
+        for segment_id, scope, collection_id in segments:
+            if scope == "VECTOR":
+                vector_segments[segment_id] = collection_id
+
+        for collection_id, name in sorted(collections.items(), key=lambda x: x[1]):
+            count = counts.get(collection_id, 0)
+            seg_bytes = sum(
+                _dir_bytes(path / seg) for seg, coll in vector_segments.items()
+                if coll == collection_id and (path / seg).is_dir()
+            )
+            self.stdout.write(f"  {name:<32} {count:>8} entries  vector index {_format_bytes(seg_bytes)}")
+
+        orphans = [
+            d for d in path.iterdir()
+            if d.is_dir() and UUID_PATTERN.match(d.name) and d.name not in vector_segments
+        ]
+        for orphan in orphans:
+            size = _format_bytes(_dir_bytes(orphan))
+            if delete_orphans:
+                shutil.rmtree(orphan)
+                self.stdout.write(self.style.WARNING(f"  orphaned segment {orphan.name} ({size}) deleted"))
+            else:
+                self.stdout.write(self.style.WARNING(f"  orphaned segment {orphan.name} ({size})"))
+        if not orphans:
+            self.stdout.write("  no orphaned segments")
+
+    # -----------------------------
+    # prune
+    # -----------------------------
+    def _live_sources(self, municipality_id):
+        """元のPDFが残っている資料名の集合"""
+        from chatbot.models import IngestJob
+        from chatbot.uploads import pdf_dir
+
+        sources = set()
+        jobs = IngestJob.objects.filter(municipality_id=municipality_id).exclude(status=IngestJob.STATUS_FAILED)
+        for pdf_path, original_name in jobs.values_list("pdf_path", "original_name"):
+            if Path(pdf_path).exists():
+                sources.add(original_name)
+        # ジョブ導入前の資料は chatbot/pdfs/<ファイル名> に保存されている
+        sources.update(p.name for p in pdf_dir().glob("*.pdf"))
+        return sources
+
+    def _prune(self, options):
+        from chatbot import answer_cache
+        from chatbot.lexical_index import get_lexical_index
+        from chatbot.utils import get_chroma_client, get_collection
+
+        targets = []
+        for collection in get_chroma_client().list_collections():
+            matched, municipality_id = _municipality_of(collection.name)
+            if matched and (options["municipality"] is None or options["municipality"] == municipality_id):
+                targets.append(municipality_id)
+
+        total = 0
+        for municipality_id in targets:
+            collection = get_collection(municipality_id)
+            live = self._live_sources(municipality_id)
+            stale = {}
+            for batch in _iter_batches(collection, ["metadatas"]):
+                for doc_id, meta in zip(batch["ids"], batch["metadatas"]):
+                    source = (meta or {}).get("source")
+                    if source not in live:
+                        stale.setdefault(source, []).append(doc_id)
+
+            for source, ids in sorted(stale.items(), key=lambda x: str(x[0])):
+                self.stdout.write(f"  {collection.name}: {source} ({len(ids)} chunks)")
+            ids = [doc_id for ids in stale.values() for doc_id in ids]
+            total += len(ids)
+
+            if ids and options["apply"]:
+                for i in range(0, len(ids), BATCH_SIZE):
+                    collection.delete(ids=ids[i:i + BATCH_SIZE])
+                get_lexical_index(municipality_id).delete(ids)
+                if municipality_id is None:
+                    answer_cache.invalidate_all()
+                else:
+                    answer_cache.invalidate(municipality_id)
+
+        if options["apply"]:
+            self.stdout.write(self.style.SUCCESS(f"Pruned {total} chunks"))
+        else:
+            self.stdout.write(f"{total} chunks would be pruned (run with --apply to delete)")
+
+    # -----------------------------
+    # rebuild
+    # -----------------------------
+    def _copy_and_swap(self, client, old, metadata, embed=None):
+        """
+        old の全件を metadata の新しいコレクションにコピーし、同じ名前で入れ替える
+        embed を指定した場合は、保存済みのベクトルの代わりに embed(documents) の結果を使う
+        """
+        name = old.name
+        temp_name = f"{name}_rebuild"
+        # 前回の処理が途中で止まっていた場合の残りは作り直す
+        try:
+            client.delete_collection(temp_name)
+        except Exception:
+            pass
+
+        new = client.create_collection(name=temp_name, metadata=metadata)
+        include = ["documents", "metadatas"] if embed else ["embeddings", "documents", "metadatas"]
+        copied = 0
+        for batch in _iter_batches(old, include):
+            new.add(
+                ids=batch["ids"],
+                embeddings=embed(batch["documents"]) if embed else batch["embeddings"],
+                documents=batch["documents"],
+                metadatas=batch["metadatas"],
+            )
+            copied += len(batch["ids"])
+            if embed:
+                self.stdout.write(f"  {name}: {copied} entries re-embedded")
+
+        if copied != old.count():
+            client.delete_collection(temp_name)
+            raise CommandError(f"{name} changed during the rebuild; aborted (run again)")
+
+        # コピーが揃ってから入れ替える（途中で止まっても元のコレクションは残る）
+        client.delete_collection(name)
+        new.modify(name=name)
+        return copied
+
+    def _rebuild(self, options):
+        from chatbot.utils import collection_name, get_chroma_client
+
+        client = get_chroma_client()
+        name = collection_name(options["municipality"])
+        try:
+            old = client.get_collection(name)
+        except Exception:
+            raise CommandError(f"Collection not found: {name}")
+
+        metadata = _hnsw_metadata(old.metadata, options["m"], options["construction_ef"], options["search_ef"])
+        started = time.perf_counter()
+        copied = self._copy_and_swap(client, old, metadata)
+        elapsed = time.perf_counter() - started
+
+        params = {k: v for k, v in metadata.items() if k.startswith("hnsw:")}
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {name}: {copied} entries in {elapsed:.1f}s {params}"))
+        # 起動中のWebプロセスは古いコレクションを保持しているため、再起動が必要
+        self.stdout.write("Restart the web/worker processes so they pick up the rebuilt collection.")
+
+    # -----------------------------
+    # reembed
+    # -----------------------------
+    def _reembed(self, options):
+        from chatbot.embeddings import embed_texts
+        from chatbot.utils import (
+            collection_embedding_model,
+            embedding_model_id,
+            get_chroma_client,
+            get_embedding_model,
+        )
+
+        client = get_chroma_client()
+        model_id = embedding_model_id()
+        embedding_function = get_embedding_model()
+
+        targets = []
+        for collection in client.list_collections():
+            matched, municipality_id = _municipality_of(collection.name)
+            if matched and (options["municipality"] is None or options["municipality"] == municipality_id):
+                targets.append(client.get_collection(collection.name))
+
+        for old in targets:
+            current = collection_embedding_model(old)
+            if current == model_id and not options["force"]:
+                self.stdout.write(f"{old.name}: already embedded with {model_id}")
+                continue
+
+            # HNSW の設定などは引き継ぎ、記録するモデル名だけを変える
+            metadata = {**(old.metadata or {}), "embedding_model": model_id}
+            started = time.perf_counter()
+            copied = self._copy_and_swap(
+                client, old, metadata,
+                embed=lambda docs: embed_texts(docs, embedding_function, model_id),
+            )
+            self.stdout.write(self.style.SUCCESS(
+                f"{old.name}: {copied} entries re-embedded {current} -> {model_id} in {time.perf_counter() - started:.1f}s"
+            ))
+
+        self.stdout.write("Restart the web/worker processes so they pick up the re-embedded collections.")
+
+    # -----------------------------
+    # bench
+    # -----------------------------
+    def _load_vectors(self, options):
+        import numpy as np
+
+        rng = np.random.default_rng(options["seed"])
+        if options["synthetic"]:
+            # 資料のチャンクに近づけるため、いくつかの話題（クラスタ）の周りにばらつかせる
+            centers = rng.normal(size=(max(1, options["synthetic"] // 200), options["dim"]))
+            labels = rng.integers(0, len(centers), size=options["synthetic"])
+            vectors = centers[labels] + 0.6 * rng.normal(size=(options["synthetic"], options["dim"]))
+        else:
+            from chatbot.utils import get_collection
+
+            collection = get_collection(options["municipality"])
+            rows = [
+                vec for batch in _iter_batches(collection, ["embeddings"]) for vec in batch["embeddings"]
+            ]
+            if not rows:
+                raise CommandError(f"{collection.name} is empty (use --synthetic N)")
+            vectors = np.asarray(rows, dtype=np.float32)
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+        return vectors, rng
+
+    def _bench(self, options):
+        import numpy as np
+        from chromadb import PersistentClient
+
+        try:
+            param_sets = [tuple(int(x) for x in p.split(":")) for p in options["params"].split(",") if p.strip()]
+            if any(len(p) != 3 for p in param_sets):
+                raise ValueError
+        except ValueError:
+            raise CommandError("--params は M:construction_ef:search_ef のカンマ区切りで指定してください")
+
+        vectors, rng = self._load_vectors(options)
+        k = options["k"]
+        n_queries = min(options["queries"], len(vectors) // 10 or 1)
+        if len(vectors) - n_queries < k:
+            raise CommandError(f"Not enough vectors for k={k} ({len(vectors)} available)")
+
+        # 質問に使うベクトルはインデックスに含めない（自分自身が必ず見つかって再現率が高く出るのを避ける）
+        order = rng.permutation(len(vectors))
+        queries, corpus = vectors[order[:n_queries]], vectors[order[n_queries:]]
+        ids = [str(i) for i in range(len(corpus))]
+
+        # 正解: 総当たりのコサイン類似度の上位 k 件
+        truth = np.argsort(-(queries @ corpus.T), axis=1)[:, :k]
+        truth = [set(str(i) for i in row) for row in truth]
+
+        self.stdout.write(f"{len(corpus)} vectors (dim {corpus.shape[1]}), {n_queries} queries, recall@{k}")
+        self.stdout.write(f"  {'M':>4} {'constr_ef':>9} {'search_ef':>9} {'build(s)':>9} {'recall':>7} {'p50(ms)':>8} {'p95(ms)':>8}")
+
+        for m, construction_ef, search_ef in param_sets:
+            with tempfile.TemporaryDirectory(prefix="chroma_bench_") as tmp:
+                client = PersistentClient(path=tmp)
+                collection = client.create_collection(
+                    name="bench",
+                    metadata={
+                        "hnsw:space": "cosine",
+                        "hnsw:M": m,
+                        "hnsw:construction_ef": construction_ef,
+                        "hnsw:search_ef": search_ef,
+                    },
+                )
+                started = time.perf_counter()
+                for i in range(0, len(corpus), BATCH_SIZE):
+                    collection.add(ids=ids[i:i + BATCH_SIZE], embeddings=corpus[i:i + BATCH_SIZE])
+                build = time.perf_counter() - started
+
+                latencies, recalls = [], []
+                for query, expected in zip(queries, truth):
+                    started = time.perf_counter()
+                    result = collection.query(query_embeddings=[query], n_results=k, include=[])
+                    latencies.append((time.perf_counter() - started) * 1000)
+                    recalls.append(len(expected & set(result["ids"][0])) / k)
+
+                latencies.sort()
+                p95 = latencies[min(len(latencies) - 1, round(0.95 * (len(latencies) - 1)))]
+                self.stdout.write(
+                    f"  {m:>4} {construction_ef:>9} {search_ef:>9} {build:>9.2f} "
+                    f"{statistics.mean(recalls):>7.3f} {statistics.median(latencies):>8.2f} {p95:>8.2f}"
+                )
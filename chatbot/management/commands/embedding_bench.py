@@ -0,0 +1,118 @@
+import json
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# -----------------------------
+# 埋め込みモデルのベンチマーク（スループット・メモリ）
+# -----------------------------
+# 使い方（例）:
+#   python manage.py embedding_bench --model-path models/paraphrase-multilingual-MiniLM-L12-v2
+#   python manage.py embedding_bench --variants default,st,st-int8,st-onnx --texts 2000
+# 各バリアントを新しいPythonプロセスで実行し、モデルの読み込み時間・埋め込み速度・常駐メモリを比べる
+VARIANTS = {
+    "hashing": {"CHATBOT_EMBEDDING_PROVIDER": "hashing"},
+    "default": {"CHATBOT_EMBEDDING_PROVIDER": "default"},
+    "st": {"CHATBOT_EMBEDDING_PROVIDER": "sentence-transformers", "CHATBOT_EMBEDDING_BACKEND": "torch"},
+    "st-int8": {
+        "CHATBOT_EMBEDDING_PROVIDER": "sentence-transformers",
+        "CHATBOT_EMBEDDING_BACKEND": "torch",
+        "CHATBOT_EMBEDDING_QUANTIZE": True,
+    },
+    "st-onnx": {"CHATBOT_EMBEDDING_PROVIDER": "sentence-transformers", "CHATBOT_EMBEDDING_BACKEND": "onnx"},
+    "st-onnx-int8": {"CHATBOT_EMBEDDING_PROVIDER": "sentence-transformers", "CHATBOT_EMBEDDING_BACKEND": "onnx"},
+}
+
+BENCH_SCRIPT = """
+import json, os, random, resource, time
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+import django
+django.setup()
+from django.test.utils import override_settings
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+overrides = json.loads({overrides!r})
+with override_settings(**overrides):
+    from chatbot.embeddings import create_embedding_function, embed_texts
+    from chatbot.management.commands.chatbot_bench import _chunk_text
+
+    rng = random.Random(0)
+    texts = [_chunk_text(rng, sentences=4) for _ in range({texts!r})]
+    before = rss_mb()
+    started = time.perf_counter()
+    fn, model_id = create_embedding_function(overrides["CHATBOT_EMBEDDING_PROVIDER"])
+    fn(["warm up"])
+    loaded = time.perf_counter()
+    vectors = embed_texts(texts, fn, model_id, batch_size={batch_size!r}, use_cache=False)
+    finished = time.perf_counter()
+    print("__RESULT__" + json.dumps({{
+        "model_id": model_id,
+        "dim": len(vectors[0]),
+        "load_seconds": loaded - started,
+        "texts_per_sec": len(texts) / (finished - loaded),
+        "rss_mb": rss_mb(),
+        "model_rss_mb": rss_mb() - before,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }}))
+"""
+
+
+class Command(BaseCommand):
+    help = "埋め込みモデル（標準・多言語・int8/ONNX）のスループットと常駐メモリを比べる"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--variants", default="default,st,st-int8,st-onnx", help=f"比較する設定（{', '.join(VARIANTS)}）")
+        parser.add_argument("--model-path", help="sentence-transformers モデルのパス（省略時は CHATBOT_EMBEDDING_MODEL_PATH）")
+        parser.add_argument("--onnx-int8-file", default="onnx/model_qint8_avx2.onnx", help="st-onnx-int8 で使う ONNX ファイル")
+        parser.add_argument("--texts", type=int, default=1000, help="埋め込むテキスト数")
+        parser.add_argument("--batch-size", type=int, default=None, help="省略時は CHATBOT_EMBEDDING_BATCH_SIZE")
+
+    def _run(self, overrides, options):
+        script = BENCH_SCRIPT.format(
+            overrides=json.dumps(overrides),
+            texts=options["texts"],
+            batch_size=options["batch_size"] or getattr(settings, "CHATBOT_EMBEDDING_BATCH_SIZE", 32),
+        )
+        proc = subprocess.run([sys.executable, "-c", script], cwd=settings.BASE_DIR, capture_output=True, text=True)
+        for line in proc.stdout.splitlines():
+            if line.startswith("__RESULT__"):
+                return json.loads(line[len("__RESULT__"):])
+        # 失敗理由は最後の行（例外メッセージ）だけ表示する
+        lines = proc.stderr.strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else "failed")
+
+    def handle(self, *args, **options):
+        names = [v.strip() for v in options["variants"].split(",") if v.strip()]
+        unknown = [v for v in names if v not in VARIANTS]
+        if unknown:
+            raise CommandError(f"Unknown variants: {', '.join(unknown)}")
+
+        model_path = options["model_path"] or getattr(settings, "CHATBOT_EMBEDDING_MODEL_PATH", None)
+
+        self.stdout.write(
+            f"{'variant':<14}{'model':<48}{'dim':>5}{'load(s)':>9}{'texts/s':>10}{'model MB':>10}{'max RSS MB':>12}"
+        )
+        for name in names:
+            overrides = dict(VARIANTS[name])
+            if overrides["CHATBOT_EMBEDDING_PROVIDER"] == "sentence-transformers":
+                if not model_path:
+                    self.stdout.write(f"{name:<14}skipped: --model-path / CHATBOT_EMBEDDING_MODEL_PATH is not set")
+                    continue
+                overrides["CHATBOT_EMBEDDING_MODEL_PATH"] = str(model_path)
+                if name == "st-onnx-int8":
+                    overrides["CHATBOT_EMBEDDING_ONNX_FILE"] = options["onnx_int8_file"]
+
+            try:
+                r = self._run(overrides, options)
+            except RuntimeError as e:
+                self.stdout.write(f"{name:<14}failed: {e}")
+                continue
+            self.stdout.write(
+                f"{name:<14}{r['model_id'][:47]:<48}{r['dim']:>5}{r['load_seconds']:>9.2f}"
+                f"{r['texts_per_sec']:>10.1f}{r['model_rss_mb']:>10.0f}{r['max_rss_mb']:>12.0f}"
+            )
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from chatbot.lexical_index import rebuild_from_collection
+from chatbot.utils import get_collection
+
+
+class Command(BaseCommand):
+    help = "pdf_collection の内容から語彙検索インデックス（SQLite FTS5）を作り直す"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--municipality", type=int, default=None, help="対象の自治体ID（省略時は共通コレクション）")
+
+    def handle(self, *args, **options):
+        municipality_id = options["municipality"]
+        count = rebuild_from_collection(get_collection(municipality_id), municipality_id)
+        self.stdout.write(self.style.SUCCESS(f"Lexical index rebuilt: {count} chunks"))
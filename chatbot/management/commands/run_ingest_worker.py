@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from chatbot.jobs import start_workers
+
+
+class Command(BaseCommand):
+    help = "PDF取り込みジョブのワーカーを起動する（Webプロセスとは別に専用ワーカーを動かす場合）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=None, help="ワーカースレッド数")
+
+    def handle(self, *args, **options):
+        pool = start_workers(options["workers"])
+        self.stdout.write(f"Ingest worker started ({pool.num_workers} threads). Ctrl+C で停止します。")
+        try:
+            pool.join()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping ingest workers...")
+            pool.stop(timeout=10)
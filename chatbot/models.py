@@ -1,3 +1,6 @@
+import uuid
+
+from django.conf import settings
 from django.db import models
 
 class UploadedPDF(models.Model):
@@ -6,3 +9,145 @@ class UploadedPDF(models.Model):
 
     def __str__(self):
         return self.file.name
+
+
+class IngestJob(models.Model):
+    """
+    PDF取り込み（抽出・OCR・ベクトル登録）のジョブ
+    - 外部ブローカーを使わず、既存のDBをキューとして利用する
+    """
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "待機中"),
+        (STATUS_RUNNING, "処理中"),
+        (STATUS_DONE, "完了"),
+        (STATUS_FAILED, "失敗"),
+    )
+
+    pdf_path = models.CharField(max_length=500)
+    original_name = models.CharField(max_length=255)
+    # アップロードした職員の自治体（資料はこの自治体専用のコレクションに登録される）
+    municipality = models.ForeignKey(
+        'users.Municipality',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    last_error = models.TextField(blank=True)
+    # リトライ時はこの時刻まで取得を待つ（バックオフ）
+    run_after = models.DateTimeField(null=True, blank=True)
+    # 実行中ジョブのロック取得時刻（ワーカー停止時の回収に使う）
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        verbose_name = "取り込みジョブ"
+        verbose_name_plural = "取り込みジョブ"
+
+    def __str__(self):
+        return f"{self.original_name} ({self.get_status_display()})"
+
+
+class RateLimitBucket(models.Model):
+    """
+    チャットAPIのレート制限用トークンバケット
+    - 複数のワーカープロセスで状態を共有するためDBに保存する
+    - key は "user:<ID>" / "ip:<アドレス>"
+    """
+    key = models.CharField(max_length=100, unique=True)
+    tokens = models.FloatField()
+    # 最後にトークンを補充した時刻（UNIX時間）
+    updated = models.FloatField()
+
+    class Meta:
+        verbose_name = "レート制限バケット"
+        verbose_name_plural = "レート制限バケット"
+
+    def __str__(self):
+        return f"{self.key} ({self.tokens:.1f})"
+
+
+class UploadSession(models.Model):
+    """
+    分割アップロード（再開可能）のセッション
+    - 受信済みのデータは一時ファイルに追記し、received バイトまで受け取ったことを記録する
+    - 通信が切れた場合、クライアントは received から続きを送る
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    municipality = models.ForeignKey(
+        'users.Municipality',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "アップロードセッション"
+        verbose_name_plural = "アップロードセッション"
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size})"
+
+
+class ChatSession(models.Model):
+    """
+    チャットの会話セッション（複数回のやり取りをまたいで文脈を保持する）
+    - 古いやり取りはトークン数の上限を超えたら summary に要約して圧縮する
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # 未ログインの住民の場合は空
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.CASCADE)
+    municipality = models.ForeignKey(
+        'users.Municipality',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+    # 要約済みのやり取りの要約（ローリングサマリー）
+    summary = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "チャットセッション"
+        verbose_name_plural = "チャットセッション"
+
+    def __str__(self):
+        return f"{self.pk} ({self.updated_at:%Y-%m-%d %H:%M})"
+
+
+class ChatTurn(models.Model):
+    """会話セッション内の1回のやり取り（質問と回答）"""
+    session = models.ForeignKey(ChatSession, related_name="turns", on_delete=models.CASCADE)
+    question = models.TextField()
+    # 履歴を踏まえて書き換えた検索用の質問（書き換えなかった場合は question と同じ）
+    search_query = models.TextField(blank=True)
+    answer = models.TextField()
+    # question + answer のトークン数（履歴の予算計算に使う）
+    tokens = models.PositiveIntegerField(default=0)
+    # True のやり取りは summary に要約済みで、プロンプトには含めない
+    summarized = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+        verbose_name = "チャットのやり取り"
+        verbose_name_plural = "チャットのやり取り"
+
+    def __str__(self):
+        return self.question[:50]
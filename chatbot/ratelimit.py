@@ -0,0 +1,276 @@
+import asyncio
+import logging
+import math
+import random
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+
+from config import metrics
+
+from .models import RateLimitBucket
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# チャットAPIの受付制御
+# -----------------------------
+# 1. レート制限: 利用者ごと・IPアドレスごとのトークンバケット（DBで全プロセス共有） → 超過は 429
+# 2. 同時実行数: 処理中の上限 + 待ち行列の上限（プロセスごと。イベントループをまたいで共有する） → 満杯・待ち時間切れは 503
+# どちらも Retry-After（秒）を返し、クライアントに再試行のタイミングを伝える。
+
+_RESULTS = ("admitted", "rejected_user_rate", "rejected_ip_rate", "rejected_queue_full", "rejected_queue_timeout")
+_admissions = metrics.counter("chatbot_admissions", "Chat requests admitted or rejected by rate limits and queues.", ["result"])
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _incr(key):
+    _admissions.inc(result=key)
+
+
+def get_stats():
+    """受付・拒否の回数（このプロセス内の累計）"""
+    stats = {key: _admissions.value(result=key) for key in _RESULTS}
+    rejected = sum(v for k, v in stats.items() if k.startswith("rejected_"))
+    stats["rejected"] = rejected
+    total = stats["admitted"] + rejected
+    stats["rejection_rate"] = rejected / total if total else 0.0
+    return stats
+
+
+class Rejected(Exception):
+    """受付を拒否した（status: 429 / 503, retry_after: 秒）"""
+
+    def __init__(self, reason, status, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+# -----------------------------
+# トークンバケット
+# -----------------------------
+def take_token(key, capacity, per_minute):
+    """
+    バケットからトークンを1つ取り出す
+    戻り値: (許可したか, 次のトークンが貯まるまでの秒数)
+    """
+    if capacity <= 0 or per_minute <= 0:
+        raise ValueError(f"Rate limit for {key} needs capacity > 0 and per_minute > 0 (got {capacity}, {per_minute})")
+    rate = per_minute / 60
+    now = time.time()
+
+    with transaction.atomic():
+        bucket = RateLimitBucket.objects.select_for_update().filter(key=key).first()
+        if bucket is None:
+            try:
+                # 同時に作成された場合に備えてセーブポイントを挟む
+                with transaction.atomic():
+                    RateLimitBucket.objects.create(key=key, tokens=capacity - 1, updated=now)
+                return True, 0.0
+            except IntegrityError:
+                bucket = RateLimitBucket.objects.select_for_update().get(key=key)
+
+        tokens = min(capacity, bucket.tokens + max(0.0, now - bucket.updated) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        bucket.tokens = tokens
+        bucket.updated = now
+        bucket.save(update_fields=["tokens", "updated"])
+
+    if random.random() < 0.01:
+        purge_idle_buckets()
+    return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+
+def purge_idle_buckets(idle_seconds=24 * 60 * 60):
+    """長く使われていない（満タンに戻っている）バケットを削除する"""
+    RateLimitBucket.objects.filter(updated__lt=time.time() - idle_seconds).delete()
+
+
+def client_ip(request):
+    # リバースプロキシの背後で動かす場合のみ X-Forwarded-For を信頼する
+    if _setting("CHATBOT_RATE_LIMIT_TRUST_X_FORWARDED_FOR", False):
+        forwarded = request.META.get("HTTP_X_FORWARDED_FOR", "")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def check_rate_limit(user, ip):
+    """レート制限を超えていれば Rejected を送出する（DBを使うため同期関数）"""
+    if not _setting("CHATBOT_RATE_LIMIT_ENABLED", True):
+        return
+
+    limits = []
+    if user is not None and user.is_authenticated:
+        limits.append((f"user:{user.pk}", _setting("CHATBOT_RATE_LIMIT_USER", {"capacity": 10, "per_minute": 10}),
+                       "rejected_user_rate"))
+    if ip:
+        limits.append((f"ip:{ip}", _setting("CHATBOT_RATE_LIMIT_IP", {"capacity": 30, "per_minute": 30}),
+                       "rejected_ip_rate"))
+
+    for key, limit, stat in limits:
+        # capacity・per_minute が 0（または None）の制限は無効とみなす
+        capacity, per_minute = (limit or {}).get("capacity") or 0, (limit or {}).get("per_minute") or 0
+        if capacity <= 0 or per_minute <= 0:
+            continue
+        try:
+            allowed, retry_after = take_token(key, capacity, per_minute)
+        except DatabaseError as e:
+            # DB障害時に質問を受け付けられなくなるより、制限なしで通すほうを選ぶ
+            logger.error(f"Rate limit check failed: {e}")
+            return
+        if not allowed:
+            _incr(stat)
+            raise Rejected("rate_limited", 429, retry_after)
+
+
+# -----------------------------
+# 同時実行数・待ち行列
+# -----------------------------
+class AsyncAdmissionGate:
+    """
+    非同期ビュー用: 処理中が max_active 件を超えたら待たせ、
+    待ちが max_queued 件を超えたら、または queue_timeout 秒待っても空かなければ拒否する
+    - 上限はプロセス全体で共有する（WSGI・runserver では async_to_sync がリクエストごとに
+      別のイベントループを作るため、asyncio.Semaphore ではループごとの上限になってしまう）
+    - 空きを待つ間はスレッドを止めず、待っている側のループの Future で通知を受ける
+    """
+
+    def __init__(self, max_active, max_queued, queue_timeout):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._lock = threading.Lock()
+        # 空きを待っている (イベントループ, Future)。先に来た順に空きを渡す
+        self._waiters = deque()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.active < self.max_active:
+                self.active += 1
+                future = None
+            elif len(self._waiters) >= self.max_queued:
+                _incr("rejected_queue_full")
+                raise Rejected("queue_full", 503, self.queue_timeout)
+            else:
+                future = loop.create_future()
+                self._waiters.append((loop, future))
+
+        if future is None:
+            _incr("admitted")
+            return self
+
+        started = time.perf_counter()
+        granted = False
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+            granted = True
+        except asyncio.TimeoutError:
+            _incr("rejected_queue_timeout")
+            raise Rejected("queue_timeout", 503, self.queue_timeout)
+        finally:
+            if not granted:
+                self._abandon(loop, future)
+        metrics.observe_stage("admission_wait", time.perf_counter() - started)
+        _incr("admitted")
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+    def _abandon(self, loop, future):
+        """待ち時間切れ・キャンセルで待つのをやめた"""
+        with self._lock:
+            try:
+                self._waiters.remove((loop, future))
+            except ValueError:
+                pass  # 既に空きを渡す処理が始まっている（_grant で返却される）
+        if future.done() and not future.cancelled():
+            # 待ち時間切れと同時に空きを受け取っていた
+            self.release()
+        else:
+            future.cancel()
+
+    def _grant(self, future):
+        # 待っている側のイベントループで実行される
+        if future.done():
+            # 既に待つのをやめていたので、次の待ちに回す
+            self.release()
+        else:
+            future.set_result(True)
+
+    def release(self):
+        """処理が終わった枠を、待っている次のリクエストに渡す（いなければ空ける）"""
+        with self._lock:
+            while self._waiters:
+                loop, future = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:
+                    continue  # 待っていたループが既に終了している
+            self.active -= 1
+
+
+class ThreadAdmissionGate:
+    """スレッド用（ストリーミングAPI）: 処理中が上限なら待たずに拒否する"""
+
+    def __init__(self, max_active, retry_after):
+        self._semaphore = threading.BoundedSemaphore(max_active)
+        self.retry_after = retry_after
+
+    def acquire(self):
+        if not self._semaphore.acquire(blocking=False):
+            _incr("rejected_queue_full")
+            raise Rejected("queue_full", 503, self.retry_after)
+        _incr("admitted")
+
+    def release(self):
+        self._semaphore.release()
+
+
+_async_gate = None
+_thread_gate = None
+_gate_lock = threading.Lock()
+
+
+def get_async_gate():
+    """プロセス全体で共有するゲート（どのイベントループから使ってもよい）"""
+    global _async_gate
+    if _async_gate is None:
+        with _gate_lock:
+            if _async_gate is None:
+                _async_gate = AsyncAdmissionGate(
+                    max_active=_setting("CHATBOT_MAX_CONCURRENT_CHATS", 32),
+                    max_queued=_setting("CHATBOT_MAX_QUEUED_CHATS", 64),
+                    queue_timeout=_setting("CHATBOT_QUEUE_TIMEOUT", 10),
+                )
+    return _async_gate
+
+
+def get_thread_gate():
+    global _thread_gate
+    if _thread_gate is None:
+        with _gate_lock:
+            if _thread_gate is None:
+                _thread_gate = ThreadAdmissionGate(
+                    max_active=_setting("CHATBOT_MAX_CONCURRENT_STREAMS", 32),
+                    retry_after=_setting("CHATBOT_QUEUE_TIMEOUT", 10),
+                )
+    return _thread_gate
@@ -0,0 +1,220 @@
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from config import metrics
+
+from . import lexical_index
+from .chunking import count_tokens
+
+# -----------------------------
+# 検索結果の後処理
+# -----------------------------
+# 1. 多めに取得する（over-fetch）。語彙検索（FTS5）の結果も Reciprocal Rank Fusion で統合する
+# 2. MMR でほぼ同じ内容のチャンクを除きつつ、関連度の高いものを選ぶ
+# 3. （任意）ローカルの CrossEncoder で並べ替える
+# 4. トークン予算内に収まるだけプロンプトに詰める
+
+
+def retrieval_settings():
+    return {
+        "fetch_k": getattr(settings, "CHATBOT_RETRIEVAL_FETCH_K", 30),
+        "top_k": getattr(settings, "CHATBOT_RETRIEVAL_TOP_K", 10),
+        "mmr_lambda": getattr(settings, "CHATBOT_MMR_LAMBDA", 0.7),
+        "dedup_similarity": getattr(settings, "CHATBOT_DEDUP_SIMILARITY", 0.95),
+        "token_budget": getattr(settings, "CHATBOT_CONTEXT_TOKEN_BUDGET", 3000),
+        "reranker_model": getattr(settings, "CHATBOT_RERANKER_MODEL", None),
+        "rrf_k": getattr(settings, "CHATBOT_RRF_K", 60),
+    }
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def mmr_select(relevance, embeddings, top_k, mmr_lambda, dedup_similarity):
+    """
+    Maximal Marginal Relevance で候補を選ぶ
+    relevance: 質問との関連度 (大きいほど関連)
+    embeddings: 候補の埋め込み
+    戻り値: 選ばれた候補のインデックス（選ばれた順）
+    """
+    if len(relevance) == 0:
+        return []
+
+    relevance = np.asarray(relevance, dtype=np.float32)
+    vectors = _normalize(embeddings)
+    pairwise = vectors @ vectors.T
+
+    selected = []
+    remaining = [int(i) for i in np.argsort(-relevance)]
+    while remaining and len(selected) < top_k:
+        if selected:
+            redundancy = pairwise[np.ix_(remaining, selected)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(remaining), dtype=np.float32)
+
+        scores = mmr_lambda * relevance[remaining] - (1 - mmr_lambda) * redundancy
+        best = int(np.argmax(scores))
+        index = remaining.pop(best)
+
+        # 既に選んだものとほぼ同じ内容なら捨てる
+        if redundancy[best] >= dedup_similarity:
+            continue
+        selected.append(index)
+
+    return selected
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    複数の順位リストを RRF で統合する
+    rankings: [[ID, ...], ...]（それぞれ関連度の高い順）
+    戻り値: [(ID, スコア), ...]（スコアの高い順）
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+# -----------------------------
+# 再ランキング（任意）
+# -----------------------------
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+def _get_reranker(model_path):
+    global _reranker
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                from sentence_transformers import CrossEncoder
+                _reranker = CrossEncoder(model_path, device="cpu")
+    return _reranker
+
+
+def rerank(query, candidates, model_path):
+    """CrossEncoder のスコア順に並べ替える（失敗した場合は元の順番のまま）"""
+    if not candidates:
+        return candidates
+    try:
+        scores = _get_reranker(model_path).predict([(query, c["text"]) for c in candidates])
+    except Exception as e:
+        print(f"[WARN] Reranking skipped: {e}")
+        return candidates
+    order = np.argsort(-np.asarray(scores))
+    return [candidates[i] for i in order]
+
+
+# -----------------------------
+# トークン予算
+# -----------------------------
+def pack_to_budget(candidates, token_budget):
+    """先頭から順に、トークン予算に収まる候補だけを残す（収まらない候補は飛ばして次を試す）"""
+    packed = []
+    used = 0
+    for c in candidates:
+        if used + c["tokens"] > token_budget:
+            continue
+        packed.append(c)
+        used += c["tokens"]
+    return packed, used
+
+
+def _candidate(doc_id, doc, meta, emb):
+    return {"id": doc_id, "text": doc, "meta": meta or {}, "tokens": count_tokens(doc), "embedding": emb}
+
+
+def retrieve_context(query, query_embedding, targets):
+    """
+    質問に対してプロンプトに入れるチャンクを選ぶ
+    targets: 検索する [(コレクション, 語彙インデックスの自治体ID), ...]（複数の場合は距離順に統合する）
+    戻り値: ([{"id", "text", "meta", "tokens"}, ...], 統計情報の辞書)
+    """
+    conf = retrieval_settings()
+    by_id, distances = {}, {}
+    for collection, _ in targets:
+        with metrics.timer("chroma_query", collection=collection.name, n_results=conf["fetch_k"]):
+            results = collection.query(
+                query_embeddings=[query_embedding],
+                n_results=conf["fetch_k"],
+                include=["documents", "metadatas", "embeddings", "distances"],
+            )
+        for doc_id, doc, meta, emb, distance in zip(
+            results["ids"][0], results["documents"][0], results["metadatas"][0],
+            results["embeddings"][0], results["distances"][0],
+        ):
+            # 同じ資料が複数のコレクションにある場合は1件にまとめる
+            if doc_id not in distances or distance < distances[doc_id]:
+                by_id[doc_id] = _candidate(doc_id, doc, meta, emb)
+                distances[doc_id] = distance
+
+    ids = sorted(distances, key=distances.get)[:conf["fetch_k"]]
+    # 従来方式（ベクトル検索の上位 top_k をそのまま連結）で使っていたトークン数
+    baseline_tokens = sum(by_id[doc_id]["tokens"] for doc_id in ids[:conf["top_k"]])
+
+    lexical_rankings = []
+    if lexical_index.is_enabled():
+        with metrics.timer("lexical_search"):
+            for _, municipality_id in targets:
+                ranking = [
+                    doc_id for doc_id, _ in lexical_index.get_lexical_index(municipality_id).search(query, conf["fetch_k"])
+                ]
+                if ranking:
+                    lexical_rankings.append(ranking)
+    lexical_ids = [doc_id for ranking in lexical_rankings for doc_id in ranking]
+
+    if lexical_ids:
+        # ベクトル検索と語彙検索の順位を統合し、語彙検索でしか出てこなかったチャンクを補完する
+        fused = reciprocal_rank_fusion([ids] + lexical_rankings, conf["rrf_k"])[:conf["fetch_k"]]
+        for collection, _ in targets:
+            missing = [doc_id for doc_id, _ in fused if doc_id not in by_id]
+            if not missing:
+                break
+            extra = collection.get(ids=missing, include=["documents", "metadatas", "embeddings"])
+            for doc_id, doc, meta, emb in zip(extra["ids"], extra["documents"], extra["metadatas"], extra["embeddings"]):
+                by_id[doc_id] = _candidate(doc_id, doc, meta, emb)
+        # 語彙インデックスにだけ残っているIDは除く
+        fused = [(doc_id, score) for doc_id, score in fused if doc_id in by_id]
+        top_score = fused[0][1] if fused else 1.0
+        candidates = [by_id[doc_id] for doc_id, _ in fused]
+        relevance = [score / top_score for _, score in fused]
+    else:
+        candidates = [by_id[doc_id] for doc_id in ids]
+        # コサイン距離 → 類似度
+        relevance = [1.0 - distances[doc_id] for doc_id in ids]
+
+    if not candidates:
+        return [], {"candidates": 0, "baseline_tokens": 0, "used_tokens": 0, "saved_tokens": 0}
+
+    selected = mmr_select(
+        relevance, [c["embedding"] for c in candidates], conf["top_k"], conf["mmr_lambda"], conf["dedup_similarity"]
+    )
+    chosen = [candidates[i] for i in selected]
+
+    if conf["reranker_model"]:
+        with metrics.timer("rerank", candidates=len(chosen)):
+            chosen = rerank(query, chosen, conf["reranker_model"])
+
+    packed, used_tokens = pack_to_budget(chosen, conf["token_budget"])
+
+    stats = {
+        "candidates": len(candidates),
+        "lexical_hits": len(lexical_ids),
+        "selected": len(selected),
+        "packed": len(packed),
+        "baseline_tokens": baseline_tokens,
+        "used_tokens": used_tokens,
+        "saved_tokens": baseline_tokens - used_tokens,
+    }
+    print(
+        f"[INFO] Context: {stats['packed']}/{stats['candidates']} chunks, "
+        f"{used_tokens} tokens (saved {stats['saved_tokens']} vs top-{conf['top_k']})"
+    )
+    return packed, stats
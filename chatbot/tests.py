@@ -1,3 +1,506 @@
-from django.test import TestCase
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from users.models import CustomUser
+
+from . import llm, ratelimit, utils
+from .chunking import chunk_text, count_tokens
+from .conversation import load_history
+from .embeddings import embed_texts
+from .lexical_index import get_lexical_index
+from .models import ChatSession, ChatTurn, IngestJob, RateLimitBucket, UploadSession
+
+
+class TempStorageMixin:
+    """ChromaDB・語彙インデックス・埋め込みキャッシュ・PDFの保存先を一時ディレクトリに切り替える"""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        storage = override_settings(
+            CHATBOT_CHROMA_PATH=str(self.tmp / "chroma"),
+            CHATBOT_LEXICAL_INDEX_PATH=self.tmp / "lexical_index.sqlite3",
+            CHATBOT_EMBEDDING_CACHE_PATH=self.tmp / "embedding_cache.sqlite3",
+            CHATBOT_PDF_DIR=self.tmp / "pdfs",
+            CHATBOT_EMBEDDING_PROVIDER="hashing",
+            CHATBOT_LLM_BACKEND="fake",
+            CHATBOT_FAKE_LLM_DELAY=0,
+        )
+        storage.enable()
+        self.addCleanup(storage.disable)
+        utils.reset_clients()
+        self.addCleanup(utils.reset_clients)
+
+
+# -----------------------------
+# チャンク分割
+# -----------------------------
+class ChunkTextTests(TestCase):
+    def assert_chunks_valid(self, text, chunks, chunk_tokens):
+        for chunk in chunks:
+            self.assertEqual(chunk["text"], text[chunk["start"]:chunk["end"]])
+            self.assertLessEqual(count_tokens(chunk["text"]), chunk_tokens)
+        # 隣り合うチャンクの間に抜けがない
+        for prev, nxt in zip(chunks, chunks[1:]):
+            self.assertLess(prev["start"], nxt["start"])
+            self.assertLessEqual(nxt["start"], prev["end"])
+        self.assertEqual(chunks[-1]["end"], len(text.rstrip()))
+
+    def test_chunks_end_at_sentence_boundaries(self):
+        sentences = [f"避難所{i}番は市役所の近くにあります。" for i in range(40)]
+        text = "".join(sentences)
+        chunks = chunk_text(text, chunk_tokens=60, overlap_tokens=0)
+
+        self.assertGreater(len(chunks), 1)
+        self.assert_chunks_valid(text, chunks, 60)
+        for chunk in chunks:
+            self.assertTrue(chunk["text"].endswith("。"))
+        # 重複なしの場合は、前のチャンクの終わりから次のチャンクが始まる
+        for prev, nxt in zip(chunks, chunks[1:]):
+            self.assertEqual(nxt["start"], prev["end"])
+
+    def test_adjacent_chunks_overlap_by_whole_sentences(self):
+        text = "".join(f"避難所{i}番は市役所の近くにあります。" for i in range(40))
+        chunks = chunk_text(text, chunk_tokens=60, overlap_tokens=25)
+
+        self.assert_chunks_valid(text, chunks, 60)
+        for prev, nxt in zip(chunks, chunks[1:]):
+            overlap = text[nxt["start"]:prev["end"]]
+            self.assertTrue(overlap, "chunks should overlap")
+            self.assertLessEqual(count_tokens(overlap), 25)
+            self.assertTrue(overlap.endswith("。"))
+
+    def test_sentence_without_punctuation_is_split_with_overlap(self):
+        text = "あ" * 1000
+        chunks = chunk_text(text, chunk_tokens=100, overlap_tokens=10)
+
+        self.assertGreater(len(chunks), 1)
+        self.assert_chunks_valid(text, chunks, 100)
+        for prev, nxt in zip(chunks, chunks[1:]):
+            self.assertLess(nxt["start"], prev["end"])
+            self.assertLessEqual(count_tokens(text[nxt["start"]:prev["end"]]), 10)
+
+    def test_short_text_is_single_chunk(self):
+        self.assertEqual(chunk_text("  避難所は市役所です。\n", chunk_tokens=100), [
+            {"text": "避難所は市役所です。", "start": 2, "end": 12},
+        ])
+
+
+# -----------------------------
+# レート制限
+# -----------------------------
+class TakeTokenTests(TestCase):
+    def take(self, now, key="test", capacity=2, per_minute=60):
+        with mock.patch("chatbot.ratelimit.time.time", return_value=now):
+            return ratelimit.take_token(key, capacity, per_minute)
+
+    def test_bucket_empties_and_refills(self):
+        self.assertEqual(self.take(1000.0), (True, 0.0))
+        self.assertEqual(self.take(1000.0), (True, 0.0))
+
+        allowed, retry_after = self.take(1000.0)
+        self.assertFalse(allowed)
+        # 1トークン/秒 で空なので、1秒後に貯まる
+        self.assertAlmostEqual(retry_after, 1.0)
+
+        allowed, retry_after = self.take(1000.5)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 0.5)
+
+        self.assertEqual(self.take(1001.0), (True, 0.0))
+
+    def test_refill_is_capped_at_capacity(self):
+        self.take(1000.0)
+        self.take(1000.0)
+        # 長く空けても capacity 個までしか貯まらない
+        self.assertTrue(self.take(5000.0)[0])
+        self.assertTrue(self.take(5000.0)[0])
+        self.assertFalse(self.take(5000.0)[0])
+
+    def test_buckets_are_per_key(self):
+        self.take(1000.0, key="a", capacity=1)
+        self.assertFalse(self.take(1000.0, key="a", capacity=1)[0])
+        self.assertTrue(self.take(1000.0, key="b", capacity=1)[0])
+        self.assertEqual(RateLimitBucket.objects.count(), 2)
+
+    def test_invalid_limits_are_rejected(self):
+        with self.assertRaises(ValueError):
+            ratelimit.take_token("test", 1, 0)
+        with self.assertRaises(ValueError):
+            ratelimit.take_token("test", 0, 10)
+
+
+@override_settings(
+    CHATBOT_RATE_LIMIT_ENABLED=True,
+    CHATBOT_RATE_LIMIT_IP={"capacity": 1, "per_minute": 6},
+    CHATBOT_RATE_LIMIT_TRUST_X_FORWARDED_FOR=False,
+)
+class RateLimitResponseTests(TestCase):
+    def post(self, url):
+        return self.client.post(url, data=json.dumps({"question": ""}), content_type="application/json")
+
+    def test_stream_api_returns_429_with_retry_after(self):
+        url = reverse("chatbot:chat_stream_api")
+        # 空の質問でもトークンは消費される
+        self.assertEqual(self.post(url).status_code, 400)
+
+        response = self.post(url)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()["reason"], "rate_limited")
+        # 6回/分 → 次のトークンまで10秒
+        self.assertEqual(response["Retry-After"], "10")
+
+    def test_async_api_returns_429_with_retry_after(self):
+        url = reverse("chatbot:chat_api")
+        self.post(url)
+
+        response = self.post(url)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(int(response["Retry-After"]), 10)
+
+    @override_settings(CHATBOT_RATE_LIMIT_ENABLED=False)
+    def test_disabled_rate_limit_admits_everything(self):
+        url = reverse("chatbot:chat_stream_api")
+        for _ in range(3):
+            self.assertEqual(self.post(url).status_code, 400)
+        self.assertFalse(RateLimitBucket.objects.exists())
+
+
+# -----------------------------
+# 会話履歴
+# -----------------------------
+@override_settings(CHATBOT_HISTORY_TOKEN_BUDGET=800)
+class LoadHistoryTests(TestCase):
+    def test_unsummarized_turns_are_trimmed_to_budget(self):
+        session = ChatSession.objects.create()
+        for i in range(5):
+            ChatTurn.objects.create(session=session, question=f"質問{i}", answer=f"回答{i}", tokens=300)
+
+        # 要約が走っていない・失敗した場合も、新しい方から予算内のやり取りだけを入れる
+        history = load_history(session)
+
+        self.assertEqual(history["turns"], [("質問3", "回答3"), ("質問4", "回答4")])
+
+    def test_summarized_turns_are_excluded(self):
+        session = ChatSession.objects.create(summary="これまでの要約")
+        ChatTurn.objects.create(session=session, question="古い質問", answer="古い回答", tokens=10, summarized=True)
+        ChatTurn.objects.create(session=session, question="質問", answer="回答", tokens=10)
+
+        self.assertEqual(load_history(session), {"summary": "これまでの要約", "turns": [("質問", "回答")]})
+
+    def test_new_session_has_no_history(self):
+        self.assertIsNone(load_history(ChatSession.objects.create()))
+
+
+# -----------------------------
+# ストリーミングAPI（偽LLM）
+# -----------------------------
+async def join_async(content):
+    return b"".join([part async for part in content])
+
+
+@override_settings(CHATBOT_RATE_LIMIT_ENABLED=False, CHATBOT_QUERY_REWRITE="off")
+class ChatStreamApiTests(TempStorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # 検索で資料が見つかるようにしておく（見つからなければ LLM を呼ばずに定型文を返す）
+        docs = ["避難所は市役所の体育館です。", "避難所には水と食料を持参してください。"]
+        ids = [f"test_{i}" for i in range(len(docs))]
+        metadatas = [{"source": "test.pdf", "page": 1, "chunk": i, "municipality_id": -1} for i in range(len(docs))]
+        embeddings = embed_texts(docs, utils.get_embedding_model(), utils.embedding_model_id())
+        utils.get_collection(None).upsert(ids=ids, documents=docs, embeddings=embeddings, metadatas=metadatas)
+        get_lexical_index(None).upsert(ids, docs, metadatas)
+
+    def stream(self, question, session_id=None):
+        response = self.client.post(
+            reverse("chatbot:chat_stream_api"),
+            data=json.dumps({"question": question, "session_id": session_id}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/event-stream"))
+        try:
+            body = async_to_sync(join_async)(response.streaming_content).decode("utf-8")
+        finally:
+            response.close()
+        return [self.parse_event(block) for block in body.split("\n\n") if block]
+
+    @staticmethod
+    def parse_event(block):
+        event, data = None, None
+        for line in block.split("\n"):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+        return event, data
+
+    def test_stream_sends_deltas_then_done(self):
+        with mock.patch("chatbot.views.compact_in_background"):
+            events = self.stream("避難所はどこですか")
+
+        self.assertEqual(events[0][0], "session")
+        session_id = events[0][1]["session_id"]
+        self.assertEqual(events[-1], ("done", {}))
+
+        deltas = events[1:-1]
+        self.assertTrue(deltas)
+        self.assertTrue(all(event is None and "delta" in data for event, data in deltas))
+        answer = "".join(data["delta"] for _, data in deltas)
+        self.assertEqual(answer, utils.llm.get_backend().text)
+
+        # 回答は履歴として保存され、次の質問は同じセッションで続けられる
+        session = ChatSession.objects.get(pk=session_id)
+        self.assertEqual(list(session.turns.values_list("question", "answer")), [("避難所はどこですか", answer)])
+        with mock.patch("chatbot.views.compact_in_background"):
+            events = self.stream("持ち物は？", session_id)
+        self.assertEqual(events[0][1]["session_id"], session_id)
+        self.assertEqual(session.turns.count(), 2)
+
+    def test_stream_reports_generation_error(self):
+        with mock.patch("chatbot.views.ask_gemini_stream", side_effect=RuntimeError("boom")):
+            events = self.stream("避難所はどこですか")
+
+        self.assertEqual(events[0][0], "session")
+        self.assertEqual(events[-1][0], "error")
+        self.assertNotIn("done", [event for event, _ in events])
+
+    @override_settings(CHATBOT_FAKE_LLM_DELAY=0.05)
+    async def test_async_client_receives_first_delta_while_generating(self):
+        utils.llm.reset_backend()
+        gate = ratelimit.ThreadAdmissionGate(max_active=1, retry_after=1)
+        finished = threading.Event()
+        fake_stream = llm.FakeBackend.stream
+
+        def tracked_stream(backend, prompt):
+            yield from fake_stream(backend, prompt)
+            finished.set()
+
+        with mock.patch("chatbot.views.compact_in_background"), \
+                mock.patch("chatbot.views.get_thread_gate", return_value=gate), \
+                mock.patch.object(llm.FakeBackend, "stream", tracked_stream):
+            response = await self.async_client.post(
+                reverse("chatbot:chat_stream_api"),
+                data=json.dumps({"question": "避難所はどこですか"}),
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_async)
+
+            parts = []
+            first_delta_while_generating = None
+            async for part in response.streaming_content:
+                parts.append(part)
+                if first_delta_while_generating is None and b'"delta"' in part:
+                    first_delta_while_generating = not finished.is_set()
+            response.close()
+
+        # 最初の断片は偽LLMが生成を終える前に届く（まとめて送られていない）
+        self.assertIs(first_delta_while_generating, True)
+        self.assertTrue(finished.is_set())
+        events = [self.parse_event(block) for block in b"".join(parts).decode("utf-8").split("\n\n") if block]
+        self.assertEqual(events[-1], ("done", {}))
+        # ストリームが終わると同時配信の枠が返されている
+        gate.acquire()
+
+    def test_rejected_stream_does_not_create_session(self):
+        gate = mock.Mock()
+        gate.acquire.side_effect = ratelimit.Rejected("rejected_queue_full", 503, 1)
+        with mock.patch("chatbot.views.get_thread_gate", return_value=gate):
+            response = self.client.post(
+                reverse("chatbot:chat_stream_api"),
+                data=json.dumps({"question": "避難所はどこですか"}),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertFalse(ChatSession.objects.exists())
+
+
+# -----------------------------
+# PDFアップロード
+# -----------------------------
+@override_settings(CHATBOT_UPLOAD_CHUNK_BYTES=1024)
+class UploadTests(TempStorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user("official", password="pw", is_official=True)
+        self.client.force_login(self.user)
+        patcher = mock.patch("chatbot.views.ensure_workers_started")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pdf = b"%PDF-1.4\n" + os.urandom(2500)
+
+    def upload(self, data, name="a.pdf"):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        return self.client.post(reverse("chatbot:upload_pdf"), {"pdf": SimpleUploadedFile(name, data)})
+
+    def create_session(self, size):
+        response = self.client.post(
+            reverse("chatbot:upload_session_create"),
+            data=json.dumps({"filename": "large.pdf", "size": size}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def put(self, url, start, end):
+        return self.client.put(
+            url,
+            data=self.pdf[start:end + 1],
+            content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE=f"bytes {start}-{end}/{len(self.pdf)}",
+        )
+
+    def leftover_temp_files(self):
+        pdf_dir = self.tmp / "pdfs"
+        return list(pdf_dir.glob(".upload-*.part")) + list(pdf_dir.glob("partial/*"))
+
+    def test_upload_is_stored_by_content_hash(self):
+        response = self.upload(self.pdf)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["status"], "queued")
+        stored = self.tmp / "pdfs" / f"{hashlib.sha256(self.pdf).hexdigest()}.pdf"
+        self.assertEqual(stored.read_bytes(), self.pdf)
+        self.assertEqual(IngestJob.objects.get().pdf_path, str(stored))
+        self.assertEqual(self.leftover_temp_files(), [])
+
+    def test_duplicate_upload_returns_existing_job(self):
+        first = self.upload(self.pdf).json()
+        second = self.upload(self.pdf, name="renamed.pdf")
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json()["status"], "duplicate")
+        self.assertEqual(second.json()["job_id"], first["job_id"])
+        self.assertEqual(IngestJob.objects.count(), 1)
+
+    def test_failed_job_is_not_treated_as_duplicate(self):
+        first = self.upload(self.pdf).json()
+        IngestJob.objects.filter(pk=first["job_id"]).update(status=IngestJob.STATUS_FAILED)
+
+        self.assertEqual(self.upload(self.pdf).json()["status"], "queued")
+        self.assertEqual(IngestJob.objects.count(), 2)
+
+    def test_non_pdf_is_rejected(self):
+        response = self.upload(b"not a pdf")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.leftover_temp_files(), [])
+
+    def test_only_first_pdf_field_is_stored(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        other = b"%PDF-1.4\n" + os.urandom(100)
+        response = self.client.post(reverse("chatbot:upload_pdf"), {
+            "attachment": SimpleUploadedFile("x.pdf", other),
+            "pdf": [SimpleUploadedFile("a.pdf", self.pdf), SimpleUploadedFile("b.pdf", other)],
+        })
+
+        self.assertEqual(response.status_code, 202)
+        stored = [p.name for p in (self.tmp / "pdfs").glob("*.pdf")]
+        self.assertEqual(stored, [f"{hashlib.sha256(self.pdf).hexdigest()}.pdf"])
+        self.assertEqual(self.leftover_temp_files(), [])
+
+    @override_settings(CHATBOT_UPLOAD_MAX_BYTES=1000)
+    def test_oversized_upload_is_rejected(self):
+        response = self.upload(self.pdf)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.leftover_temp_files(), [])
+
+    @override_settings(CHATBOT_UPLOAD_MAX_BYTES=1000)
+    def test_oversized_upload_stops_reading_body(self):
+        from django.core.files.uploadhandler import StopUpload
+
+        from .uploads import HashingPdfUploadHandler
+
+        handler = HashingPdfUploadHandler()
+        handler.new_file("pdf", "a.pdf", "application/pdf", None)
+        handler.receive_data_chunk(self.pdf[:800], 0)
+        with self.assertRaises(StopUpload) as cm:
+            handler.receive_data_chunk(self.pdf[800:1600], 800)
+        # 上限超過は残りを読まずに切る。PDFでない場合は応答を返せるよう本文を読み切る
+        self.assertTrue(cm.exception.connection_reset)
+
+        handler = HashingPdfUploadHandler()
+        handler.new_file("pdf", "a.txt", "text/plain", None)
+        with self.assertRaises(StopUpload) as cm:
+            handler.receive_data_chunk(b"not a pdf", 0)
+        self.assertFalse(cm.exception.connection_reset)
+        self.assertEqual(self.leftover_temp_files(), [])
+
+    def test_csrf_failure_removes_temp_file(self):
+        client = self.client_class(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        response = client.post(reverse("chatbot:upload_pdf"), {"pdf": SimpleUploadedFile("a.pdf", self.pdf)})
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.leftover_temp_files(), [])
+        self.assertFalse(IngestJob.objects.exists())
+
+    def test_chunked_upload_resumes_from_received_offset(self):
+        session = self.create_session(len(self.pdf))
+        url = session["upload_url"]
+
+        self.assertEqual(self.put(url, 0, 1023).json()["received"], 1024)
+        # 通信が切れて再送した場合など、受信済みの位置以外からは受け付けず、受信済みバイト数を返す
+        response = self.put(url, 0, 1023)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["received"], 1024)
+        self.assertEqual(self.client.get(url).json()["received"], 1024)
+
+        self.assertEqual(self.put(url, 1024, 2047).json()["received"], 2048)
+        response = self.put(url, 2048, len(self.pdf) - 1)
+
+        self.assertEqual(response.status_code, 202)
+        stored = self.tmp / "pdfs" / f"{hashlib.sha256(self.pdf).hexdigest()}.pdf"
+        self.assertEqual(stored.read_bytes(), self.pdf)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(self.leftover_temp_files(), [])
+
+    def test_chunked_upload_rehashes_when_running_hash_is_missing(self):
+        from . import uploads
+
+        session = self.create_session(len(self.pdf))
+        url = session["upload_url"]
+        self.put(url, 0, 1023)
+        # 別のプロセスで途中まで受け取った場合（このプロセスにハッシュの途中経過がない）
+        uploads._save_hash(UploadSession.objects.get().pk, None, None)
+        self.put(url, 1024, 2047)
+        response = self.put(url, 2048, len(self.pdf) - 1)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue((self.tmp / "pdfs" / f"{hashlib.sha256(self.pdf).hexdigest()}.pdf").exists())
+
+    def test_chunked_upload_of_existing_pdf_is_duplicate(self):
+        first = self.upload(self.pdf).json()
+        session = self.create_session(len(self.pdf))
+        for start in range(0, len(self.pdf), 1024):
+            response = self.put(session["upload_url"], start, min(start + 1023, len(self.pdf) - 1))
+
+        self.assertEqual(response.json()["status"], "duplicate")
+        self.assertEqual(response.json()["job_id"], first["job_id"])
+
+    def test_chunk_larger_than_chunk_size_is_rejected(self):
+        session = self.create_session(len(self.pdf))
+
+        response = self.put(session["upload_url"], 0, 2047)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(UploadSession.objects.get().received, 0)
+        self.assertEqual(list((self.tmp / "pdfs" / "partial").glob("*.chunk")), [])
@@ -0,0 +1,329 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopUpload
+from django.utils import timezone
+
+from .models import IngestJob, UploadSession
+
+# -----------------------------
+# PDFアップロードの保存
+# -----------------------------
+# - アップロードされたデータはメモリや Django の一時ファイルを経由せず、保存先と同じディレクトリの一時ファイルに直接書く
+# - 書きながら SHA-256 を計算し、保存名は「<ハッシュ>.pdf」にする（内容アドレス方式）
+#   → 同名の別ファイルで上書きされず、同じ内容のファイルは1つだけ保存される
+# - サイズ上限を超えた時点で受信を打ち切る
+# - 大きなPDFは分割アップロード（UploadSession）で送り、通信が切れても続きから再開できる
+#   （チャンクの受信中はDBのロックを取らず、受信し終えたチャンクを行ロックの中で追記する）
+PDF_MAGIC = b"%PDF-"
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def max_upload_bytes():
+    return _setting("CHATBOT_UPLOAD_MAX_BYTES", 100 * 1024 * 1024)
+
+
+def pdf_dir():
+    path = Path(_setting("CHATBOT_PDF_DIR", settings.BASE_DIR / "chatbot" / "pdfs"))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def partial_dir():
+    path = pdf_dir() / "partial"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+class UploadRejected(Exception):
+    """アップロードを受け付けない（status: HTTPステータス）"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def store_pdf(temp_path, sha256):
+    """
+    一時ファイルを内容アドレスの保存先に移動する
+    戻り値: (保存先パス, 新規に保存したか)
+    """
+    final_path = pdf_dir() / f"{sha256}.pdf"
+    if final_path.exists():
+        os.unlink(temp_path)
+        return final_path, False
+    # 同じディレクトリ内の rename なので、途中の状態のファイルが見えることはない
+    os.replace(temp_path, final_path)
+    return final_path, True
+
+
+def check_content_length(request):
+    """Content-Length で上限超過が分かる場合は、本文を読む前に拒否する"""
+    try:
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    # multipart の区切り・ヘッダー分の余裕を持たせる
+    if length > max_upload_bytes() + 64 * 1024:
+        raise UploadRejected("ファイルサイズが上限を超えています。", status=413)
+
+
+def find_duplicate_job(pdf_path, municipality_id):
+    """同じ内容のPDFがこの自治体で取り込み済み（または取り込み中）なら、そのジョブを返す"""
+    return (
+        IngestJob.objects.filter(pdf_path=str(pdf_path), municipality_id=municipality_id)
+        .exclude(status=IngestJob.STATUS_FAILED)
+        .order_by("-created_at")
+        .first()
+    )
+
+
+# -----------------------------
+# 一括アップロード（multipart/form-data）
+# -----------------------------
+class HashedUploadedFile(UploadedFile):
+    """保存先ディレクトリの一時ファイルに書き込まれたアップロードファイル"""
+
+    def __init__(self, file, name, size, sha256):
+        super().__init__(file, name, "application/pdf", size)
+        self.sha256 = sha256
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class HashingPdfUploadHandler(FileUploadHandler):
+    """
+    受信したデータを一時ファイルに書きながら SHA-256 を計算するアップロードハンドラ
+    - 先頭が "%PDF-" でない、またはサイズ上限を超えた場合は受信を打ち切り、error に理由を残す
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.error = None
+        self._file = None
+        self._hash = None
+        self._size = 0
+
+    def new_file(self, field_name, *args, **kwargs):
+        # 受け付けるのは "pdf" フィールドの1ファイルだけ（他のフィールド・2つ目以降のファイルは読み飛ばし、一時ファイルを作らない）
+        if field_name != "pdf" or self._file is not None:
+            raise SkipFile()
+        super().new_file(field_name, *args, **kwargs)
+        self._file = tempfile.NamedTemporaryFile(dir=pdf_dir(), prefix=".upload-", suffix=".part", delete=False)
+        self._hash = hashlib.sha256()
+        self._size = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        if start == 0 and not raw_data.startswith(PDF_MAGIC):
+            self._abort(UploadRejected("PDFファイルではありません。"))
+        self._size += len(raw_data)
+        if self._size > max_upload_bytes():
+            # 残りの本文は読まずに接続を切る（上限を超えた分を読み捨てるのに時間を使わない）
+            self._abort(UploadRejected("ファイルサイズが上限を超えています。", status=413), connection_reset=True)
+        self._hash.update(raw_data)
+        self._file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self._file.flush()
+        self._file.seek(0)
+        return HashedUploadedFile(self._file, self.file_name, file_size, self._hash.hexdigest())
+
+    def _abort(self, error, connection_reset=False):
+        self.error = error
+        self.discard()
+        raise StopUpload(connection_reset=connection_reset)
+
+    def discard(self):
+        """書きかけの一時ファイルを削除する"""
+        if self._file is not None:
+            self._file.close()
+            try:
+                os.unlink(self._file.name)
+            except FileNotFoundError:
+                pass
+            self._file = None
+
+
+# -----------------------------
+# 分割アップロード（再開可能）
+# -----------------------------
+def chunk_bytes():
+    return _setting("CHATBOT_UPLOAD_CHUNK_BYTES", 5 * 1024 * 1024)
+
+
+def partial_path(session):
+    return partial_dir() / f"{session.pk}.part"
+
+
+def create_session(user, filename, size):
+    if size <= 0:
+        raise UploadRejected("ファイルが空です。")
+    if size > max_upload_bytes():
+        raise UploadRejected("ファイルサイズが上限を超えています。", status=413)
+
+    purge_expired_sessions()
+    session = UploadSession.objects.create(
+        user=user,
+        municipality_id=user.municipality_id,
+        filename=filename,
+        size=size,
+    )
+    partial_path(session).touch()
+    return session
+
+
+# 分割アップロードの SHA-256 の途中経過（セッションID → (ハッシュ済みバイト数, hashlib オブジェクト)）
+# チャンクを追記するたびに続きを計算し、完了時にファイル全体を読み直さずに済ませる。
+# 別のプロセスがチャンクを受け取った場合など続きが分からないときは、完了時にファイル全体から計算する
+_session_hashes = {}
+_session_hashes_lock = threading.Lock()
+
+
+def _resume_hash(session_id, offset):
+    """offset バイトまでハッシュ済みの hashlib オブジェクト（分からなければ None）"""
+    if offset == 0:
+        return hashlib.sha256()
+    with _session_hashes_lock:
+        entry = _session_hashes.get(session_id)
+    if entry is not None and entry[0] == offset:
+        return entry[1].copy()
+    return None
+
+
+def _save_hash(session_id, offset, hasher):
+    with _session_hashes_lock:
+        if hasher is None:
+            _session_hashes.pop(session_id, None)
+        else:
+            _session_hashes[session_id] = (offset, hasher)
+
+
+def receive_chunk(session, offset, stream, length):
+    """
+    offset の位置のチャンク（length バイト）を stream から読み込み、チャンク用の一時ファイルに保存する
+    - セッションの行ロックを取らずに呼ぶ（遅いクライアントが受信中にロックを持ち続けないように）
+    - offset が受信済みバイト数と一致しない場合は 409（クライアントは受信済み位置から送り直す）
+    戻り値: チャンクの一時ファイルのパス（append_chunk で追記し、discard_chunk で削除する）
+    """
+    if offset != session.received:
+        raise UploadRejected("送信位置が一致しません。", status=409)
+    if length <= 0 or length > chunk_bytes() or offset + length > session.size:
+        raise UploadRejected("チャンクのサイズが不正です。")
+
+    path = partial_dir() / f"{session.pk}.{uuid.uuid4().hex}.chunk"
+    written = 0
+    try:
+        with open(path, "wb") as f:
+            while written < length:
+                data = stream.read(min(64 * 1024, length - written))
+                if not data:
+                    break
+                if offset == 0 and written == 0 and not data.startswith(PDF_MAGIC):
+                    raise UploadRejected("PDFファイルではありません。")
+                f.write(data)
+                written += len(data)
+
+        if written != length:
+            # 途中で切れたチャンクは受信済みに含めない
+            raise UploadRejected("チャンクを最後まで受信できませんでした。")
+    except BaseException:
+        discard_chunk(path)
+        raise
+    return path
+
+
+def append_chunk(session, offset, chunk_path):
+    """
+    受信済みのチャンクをセッションの一時ファイルに追記し、受信済みバイト数を更新する
+    - セッションの行ロック（select_for_update）を取った状態で呼ぶ
+    - 待っている間に別のリクエストが同じ位置を追記していた場合は 409
+    """
+    if offset != session.received:
+        raise UploadRejected("送信位置が一致しません。", status=409)
+
+    hasher = _resume_hash(session.pk, offset)
+    with open(partial_path(session), "r+b") as f, open(chunk_path, "rb") as chunk:
+        # 前回の書き込みが途中で切れていた場合に備え、受信済み位置から書き直す
+        f.seek(offset)
+        f.truncate()
+        for block in iter(lambda: chunk.read(1024 * 1024), b""):
+            f.write(block)
+            if hasher is not None:
+                hasher.update(block)
+        received = f.tell()
+
+    session.received = received
+    session.save(update_fields=["received", "updated_at"])
+    _save_hash(session.pk, received, hasher)
+    return session
+
+
+def discard_chunk(chunk_path):
+    try:
+        os.unlink(chunk_path)
+    except FileNotFoundError:
+        pass
+
+
+def complete_session(session):
+    """
+    全データを受信したセッションを保存先に移動する
+    （SHA-256 はチャンクごとに計算した続きを使い、分からない場合のみファイル全体から計算する）
+    戻り値: (保存先パス, 新規に保存したか)
+    """
+    path = partial_path(session)
+    hasher = _resume_hash(session.pk, session.size)
+    if hasher is None:
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(block)
+    result = store_pdf(path, hasher.hexdigest())
+    _save_hash(session.pk, None, None)
+    session.delete()
+    return result
+
+
+def delete_session(session):
+    try:
+        os.unlink(partial_path(session))
+    except FileNotFoundError:
+        pass
+    _save_hash(session.pk, None, None)
+    session.delete()
+
+
+def purge_expired_sessions():
+    """一定時間更新のない分割アップロードと、受信中に切断された一時ファイルを削除する"""
+    ttl = _setting("CHATBOT_UPLOAD_SESSION_TTL", 24 * 60 * 60)
+    for session in UploadSession.objects.filter(updated_at__lt=timezone.now() - timedelta(seconds=ttl)):
+        delete_session(session)
+
+    expires_before = time.time() - ttl
+    for path in list(pdf_dir().glob(".upload-*.part")) + list(partial_dir().glob("*.chunk")):
+        try:
+            if path.stat().st_mtime < expires_before:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+    # 別のプロセスで完了・削除されたセッションのハッシュの途中経過
+    with _session_hashes_lock:
+        session_ids = list(_session_hashes)
+    live = set(UploadSession.objects.filter(pk__in=session_ids).values_list("pk", flat=True))
+    for session_id in session_ids:
+        if session_id not in live:
+            _save_hash(session_id, None, None)
@@ -6,5 +6,12 @@ app_name = 'chatbot'
 urlpatterns = [
     path("", views.chat_page, name="chat_page"),
     path("upload/", views.upload_pdf, name="upload_pdf"),
+    path("upload/sessions/", views.upload_session_create, name="upload_session_create"),
+    path("upload/sessions/<uuid:session_id>/", views.upload_session, name="upload_session"),
+    path("jobs/<int:job_id>/", views.job_status, name="job_status"),
+    path("jobs/<int:job_id>/retry/", views.job_retry, name="job_retry"),
     path('api/', views.chat_api, name='chat_api'),
+    path('api/stream/', views.chat_stream_api, name='chat_stream_api'),
+    path('api/cache-stats/', views.cache_stats, name='cache_stats'),
+    path('metrics/', views.metrics_endpoint, name='metrics'),
 ]
@@ -1,160 +1,647 @@
+import asyncio
+import hashlib
 import os
-import uuid
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-import pdfplumber
-from pdf2image import convert_from_path
-import pytesseract
 
-from chromadb import PersistentClient
-from chromadb.utils import embedding_functions
+from django.conf import settings
 
-import google.generativeai as genai
+from config import metrics
+
+from . import answer_cache, llm
+from .chunking import chunk_text, chunking_signature, count_tokens
+from .embeddings import create_embedding_function, embed_texts, model_id_for, reset_embedding_cache
+from .lexical_index import get_lexical_index, reset_lexical_indexes
 
 # -----------------------------
-# 設定・初期化
+# 設定・初期化（遅延初期化）
 # -----------------------------
-# 環境変数からAPIキーを取得
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable is not set")
-
-genai.configure(api_key=GEMINI_API_KEY)
-
-# モデル設定 (Gemini 2.0 Flash)
-# ※ system_instruction を設定することで、キャラ付けとガードレールを強化
-model = genai.GenerativeModel(
-    model_name="gemini-2.0-flash",
-    system_instruction="あなたは自治体の親切な窓口担当AIです。提供された「参考資料」の内容のみに基づいて回答してください。"
-)
-
+# LLM / ChromaDB / 埋め込みモデル / PDF・OCRライブラリはインポートが重いため、
+# モジュール読み込み時には初期化せず、初めて使うときに生成する。
+# （manage.py の各コマンドやワーカー起動が速くなり、APIキー未設定でも起動はできる）
+# 保存先は settings.CHATBOT_CHROMA_PATH で変更できる
 CHROMA_PATH = "chromadb_store"
-chroma_client = PersistentClient(path=CHROMA_PATH)
-
-# コレクションの取得・作成
-collection = chroma_client.get_or_create_collection(
-    name="pdf_collection",
-    metadata={"hnsw:space": "cosine"}
-)
-
-# 埋め込みモデル
-# 注意: 日本語精度を極限まで高めるなら GoogleGenerativeAIEmbeddingFunction への変更を推奨しますが
-# まずは動作安定のため Default を使用します。
-embedding_model = embedding_functions.DefaultEmbeddingFunction()
+# 自治体に紐付かない資料（共通・移行前のデータ）のコレクション名
+# 自治体ごとの資料は "pdf_collection_m<自治体ID>" に分けて登録し、検索もその自治体の中だけで行う
+COLLECTION_NAME = "pdf_collection"
+# embedding_model の記録がないコレクションは、当初の ChromaDB 標準モデルで作られたもの
+LEGACY_EMBEDDING_MODEL_ID = "chroma-default/all-MiniLM-L6-v2"
+
+_init_lock = threading.RLock()
+_chroma_client = None
+_collections = {}
+_embedding_model = None
+
+
+def get_chroma_client():
+    global _chroma_client
+    if _chroma_client is None:
+        with _init_lock:
+            if _chroma_client is None:
+                from chromadb import PersistentClient
+                _chroma_client = PersistentClient(path=str(getattr(settings, "CHATBOT_CHROMA_PATH", CHROMA_PATH)))
+    return _chroma_client
+
+
+def collection_name(municipality_id=None):
+    if municipality_id is None:
+        return COLLECTION_NAME
+    return f"{COLLECTION_NAME}_m{municipality_id}"
+
+
+def collection_metadata():
+    """
+    新しく作るコレクションのメタデータ
+    - HNSW のパラメータは settings.CHATBOT_HNSW_PARAMS で指定する（既存のコレクションは chroma_maintenance rebuild で作り直す）
+    - どの埋め込みモデルのベクトルかを embedding_model に記録する
+    """
+    params = getattr(settings, "CHATBOT_HNSW_PARAMS", {})
+    return {
+        "hnsw:space": "cosine",
+        **{f"hnsw:{k}": v for k, v in params.items()},
+        "embedding_model": embedding_model_id(),
+    }
+
+
+def collection_embedding_model(collection):
+    """コレクションのベクトルを作った埋め込みモデルのID（記録導入前のコレクションは ChromaDB 標準モデル）"""
+    return (collection.metadata or {}).get("embedding_model", LEGACY_EMBEDDING_MODEL_ID)
+
+
+def get_collection(municipality_id=None):
+    """コレクションの取得・作成（自治体ごと）"""
+    collection = _collections.get(municipality_id)
+    if collection is None:
+        with _init_lock:
+            collection = _collections.get(municipality_id)
+            if collection is None:
+                collection = get_chroma_client().get_or_create_collection(
+                    name=collection_name(municipality_id),
+                    metadata=collection_metadata()
+                )
+                if collection_embedding_model(collection) != embedding_model_id():
+                    print(
+                        f"[WARN] {collection.name} was embedded with {collection_embedding_model(collection)}, "
+                        f"but the current model is {embedding_model_id()}. "
+                        "Run `python manage.py chroma_maintenance reembed`."
+                    )
+                _collections[municipality_id] = collection
+    return collection
+
+
+def search_targets(municipality_id=None):
+    """
+    質問時に検索するコレクションと語彙インデックス: [(コレクション, 自治体ID), ...]
+    自治体の利用者は、自治体のコレクションに加えて共通コレクション
+    （自治体未設定の職員がアップロードした資料・自治体ごとに分ける前に登録した資料）も検索する
+    """
+    targets = [(get_collection(municipality_id), municipality_id)]
+    if municipality_id is not None and getattr(settings, "CHATBOT_SEARCH_SHARED_COLLECTION", True):
+        shared = get_collection(None)
+        # 別の埋め込みモデルのベクトルとは比較できないため、再埋め込みが済むまで検索しない
+        if shared.count() > 0 and collection_embedding_model(shared) == embedding_model_id():
+            targets.append((shared, None))
+    return targets
+
+
+def get_embedding_model():
+    """
+    埋め込みモデル（settings.CHATBOT_EMBEDDING_PROVIDER で選択）
+    日本語の資料には多言語モデル（"sentence-transformers" + CHATBOT_EMBEDDING_MODEL_PATH）を推奨
+    """
+    global _embedding_model
+    if _embedding_model is None:
+        with _init_lock:
+            if _embedding_model is None:
+                _embedding_model, _ = create_embedding_function(
+                    getattr(settings, "CHATBOT_EMBEDDING_PROVIDER", "default")
+                )
+    return _embedding_model
+
+
+def embedding_model_id():
+    """
+    埋め込みキャッシュのキー・コレクションの記録に使うモデルID（モデルを変えたら別のキャッシュになる）
+    モデルは読み込まずに設定から求める
+    """
+    return model_id_for(getattr(settings, "CHATBOT_EMBEDDING_PROVIDER", "default"))
+
+
+def reset_clients():
+    """
+    生成済みのクライアント・モデルを破棄する
+    （ベンチマーク等で保存先や設定を切り替えたあと、次の呼び出しで作り直させる）
+    """
+    global _chroma_client, _embedding_model
+    with _init_lock:
+        _chroma_client = None
+        _collections.clear()
+        _embedding_model = None
+    llm.reset_backend()
+    answer_cache.reset()
+    reset_lexical_indexes()
+    reset_embedding_cache()
+
+
+_retrieval_executor = None
+
+
+def get_retrieval_executor():
+    """
+    非同期ビューから ChromaDB 検索・埋め込みなどの同期処理を逃がすためのスレッドプール
+    スレッド数を固定して、同時アクセスが増えてもスレッドが際限なく増えないようにする
+    """
+    global _retrieval_executor
+    if _retrieval_executor is None:
+        with _init_lock:
+            if _retrieval_executor is None:
+                _retrieval_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, "CHATBOT_RETRIEVAL_WORKERS", 4),
+                    thread_name_prefix="chatbot-retrieval",
+                )
+    return _retrieval_executor
+
+
+_stream_executor = None
+
+
+def get_stream_executor():
+    """
+    ストリーミング中の Gemini の断片を受け取るためのスレッドプール
+    配信中は1本につき1スレッドを使うため、検索用とは分けて同時配信数の上限と同じ数だけ用意する
+    """
+    global _stream_executor
+    if _stream_executor is None:
+        with _init_lock:
+            if _stream_executor is None:
+                _stream_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, "CHATBOT_MAX_CONCURRENT_STREAMS", 32),
+                    thread_name_prefix="chatbot-stream",
+                )
+    return _stream_executor
+
+
+_DONE = object()
+
+
+async def iterate_in_thread(make_iterator, executor):
+    """
+    同期イテレータを executor のスレッドで回し、要素を asyncio.Queue 経由で受け取る非同期イテレータ
+    途中で閉じられた場合（接続の切断など）は、スレッド側も次の要素を受け取った時点でイテレータを閉じる
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def put(item, error=None):
+        if stop.is_set():
+            return
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, (item, error))
+        except RuntimeError:
+            # 受け取り側のイベントループが既に閉じている
+            pass
+
+    def pump():
+        iterator = make_iterator()
+        try:
+            for item in iterator:
+                if stop.is_set():
+                    break
+                put(item)
+        except Exception as e:
+            put(_DONE, e)
+            return
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+        put(_DONE)
+
+    executor.submit(pump)
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def warm_up(include_llm=True):
+    """
+    重い初期化を前もって済ませる（起動直後の最初のリクエストが遅くならないように）
+    CHATBOT_WARMUP_ON_START = True の場合、wsgi.py / asgi.py から呼ばれる
+    """
+    started = time.perf_counter()
+    import pdfplumber  # noqa: F401
+    import pdf2image  # noqa: F401
+    import pytesseract  # noqa: F401
+
+    get_collection()
+    # 埋め込みモデルは最初の呼び出しでモデルファイルを読み込むため、1件だけ実行しておく
+    get_embedding_model()(["warm up"])
+    if include_llm and (getattr(settings, "CHATBOT_LLM_BACKEND", "gemini") != "gemini" or os.getenv("GEMINI_API_KEY")):
+        llm.get_backend()
+    print(f"[INFO] Chatbot warm-up finished in {time.perf_counter() - started:.2f}s")
 
 
 # -----------------------------
 # PDF → テキスト抽出（OCR対応）
 # -----------------------------
-def extract_text_with_ocr(pdf_path):
-    pages_text = []
+# テキストがこの文字数以下のページは画像PDFとみなしてOCRする
+OCR_MIN_TEXT_LENGTH = 50
+
+
+def _ocr_settings():
+    return {
+        # "parallel": 一括ラスタライズ + プロセスプールでOCR / "sequential": 従来通り1ページずつ
+        "mode": getattr(settings, "CHATBOT_OCR_MODE", "parallel"),
+        "dpi": getattr(settings, "CHATBOT_OCR_DPI", 300),
+        "workers": getattr(settings, "CHATBOT_OCR_WORKERS", None) or os.cpu_count() or 1,
+        "lang": getattr(settings, "CHATBOT_OCR_LANG", "jpn+eng"),
+        # 間のページ数がこれ以下なら、まとめて1回でラスタライズする
+        "merge_gap": getattr(settings, "CHATBOT_OCR_MERGE_GAP", 2),
+    }
+
+
+def _ocr_image_file(args):
+    """プロセスプールのワーカーで実行される (画像パス, 言語) → (テキスト, OCRにかかった秒数)"""
+    import pytesseract
+
+    image_path, lang = args
+    started = time.perf_counter()
+    text = pytesseract.image_to_string(image_path, lang=lang).strip()
+    return text, time.perf_counter() - started
+
+
+def _page_runs(page_numbers, merge_gap):
+    """OCR対象のページ番号を、まとめてラスタライズする連続区間に分ける"""
+    runs = []
+    for num in sorted(page_numbers):
+        if runs and num - runs[-1][1] <= merge_gap + 1:
+            runs[-1][1] = num
+        else:
+            runs.append([num, num])
+    return runs
+
+
+def _ocr_pages_sequential(pdf_path, page_numbers, conf):
+    """従来方式: ページごとに convert_from_path を呼び、1コアでOCRする"""
+    import pytesseract
+    from pdf2image import convert_from_path
+
+    results = {}
+    for num in page_numbers:
+        try:
+            with metrics.timer("ocr_page", page=num, mode="sequential"):
+                images = convert_from_path(pdf_path, dpi=conf["dpi"], first_page=num, last_page=num)
+                ocr_text = ""
+                for img in images:
+                    ocr_text += pytesseract.image_to_string(img, lang=conf["lang"])
+            results[num] = ocr_text.strip()
+        except Exception as e:
+            print(f"[ERROR] OCR failed on page {num}: {e}")
+            results[num] = ""  # エラー時は空文字を追加してページズレを防ぐ
+    return results
+
+
+def _ocr_pages_parallel(pdf_path, page_numbers, conf):
+    """
+    並列方式:
+    - OCRが必要なページを (近接ページをまとめた) 区間ごとに1回でラスタライズする
+      (poppler がPDFを開き直す回数を減らす)
+    - 画像は一時ディレクトリにファイルとして書き出し、パスだけをプロセスプールに渡す
+    """
+    from pdf2image import convert_from_path
+
+    wanted = set(page_numbers)
+    results = {num: "" for num in page_numbers}
+
+    with tempfile.TemporaryDirectory(prefix="ocr_") as tmp_dir:
+        jobs = []
+        for first, last in _page_runs(page_numbers, conf["merge_gap"]):
+            try:
+                with metrics.timer("ocr_rasterize", first_page=first, last_page=last):
+                    paths = convert_from_path(
+                        pdf_path,
+                        dpi=conf["dpi"],
+                        first_page=first,
+                        last_page=last,
+                        output_folder=tmp_dir,
+                        paths_only=True,
+                        thread_count=conf["workers"],
+                        fmt="png",
+                    )
+            except Exception as e:
+                print(f"[ERROR] Rasterization failed on pages {first}-{last}: {e}")
+                continue
+
+            # convert_from_path はページ順に並んだパスを返す
+            for num, path in zip(range(first, last + 1), sorted(paths)):
+                if num in wanted:
+                    jobs.append((num, path))
+
+        if not jobs:
+            return results
+
+        workers = min(conf["workers"], len(jobs))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_ocr_image_file, (path, conf["lang"])): num
+                for num, path in jobs
+            }
+            for future, num in futures.items():
+                try:
+                    results[num], seconds = future.result()
+                    metrics.observe_stage("ocr_page", seconds, page=num, mode="parallel")
+                except Exception as e:
+                    metrics.STAGE_ERRORS.inc(stage="ocr_page")
+                    print(f"[ERROR] OCR failed on page {num}: {e}")
+
+    return results
+
+
+def _page_hash(page, text, needs_ocr):
+    """
+    ページ内容のハッシュ（IDと差分検出に使う）
+    - テキストページ: 抽出テキスト
+    - 画像ページ: コンテンツストリームと埋め込み画像のバイト列（OCR前に計算できる）
+    """
+    from pdfminer.pdftypes import resolve1
+
+    h = hashlib.sha256()
+    h.update((text or "").encode("utf-8"))
+    if needs_ocr:
+        for stream in page.page_obj.contents or []:
+            data = resolve1(stream)
+            if hasattr(data, "get_data"):
+                h.update(data.get_data())
+        for img in page.images:
+            stream = img.get("stream")
+            if stream is not None:
+                h.update(stream.get_rawdata() or stream.get_data() or b"")
+    return h.hexdigest()
+
+
+def extract_pages(pdf_path, known_hashes=None, mode=None):
+    """
+    PDFをページごとに抽出する
+    戻り値: [{"page": ページ番号(1始まり), "hash": 内容ハッシュ, "text": テキスト, "skipped": bool}, ...]
+    - known_hashes に含まれるハッシュのページは変更なしとみなし、OCRせずに skipped=True で返す
+    """
+    import pdfplumber
+
+    known_hashes = known_hashes or set()
+    pages = []
+    ocr_pages = []
     print(f"[INFO] Extracting text from PDF: {pdf_path}")
 
     try:
-        with pdfplumber.open(pdf_path) as pdf:
+        with metrics.timer("pdf_extract", file=Path(pdf_path).name) as fields, pdfplumber.open(pdf_path) as pdf:
+            fields["pages"] = len(pdf.pages)
             for i, page in enumerate(pdf.pages):
-                text = page.extract_text()
+                text = (page.extract_text() or "").strip()
+                needs_ocr = len(text) <= OCR_MIN_TEXT_LENGTH
+                page_hash = _page_hash(page, text, needs_ocr)
+
+                if page_hash in known_hashes:
+                    pages.append({"page": i + 1, "hash": page_hash, "text": None, "skipped": True})
+                    continue
 
                 # テキストが十分に取得できた場合
-                if text and len(text.strip()) > 50:
-                    pages_text.append(text.strip())
+                if not needs_ocr:
+                    pages.append({"page": i + 1, "hash": page_hash, "text": text, "skipped": False})
                     continue
 
-                # ------------ OCR 実行 -------------
-                print(f"[INFO] Page {i+1} text is empty or too short. Running OCR...")
-                
-                # popplerのパスが通っていない場合、poppler_path引数が必要になることがあります
-                try:
-                    images = convert_from_path(pdf_path, first_page=i+1, last_page=i+1)
-                    ocr_text = ""
-                    for img in images:
-                        # 日本語読み取り設定
-                        ocr_text += pytesseract.image_to_string(img, lang="jpn+eng")
-                    
-                    pages_text.append(ocr_text.strip())
-                except Exception as e:
-                    print(f"[ERROR] OCR failed on page {i+1}: {e}")
-                    pages_text.append("") # エラー時は空文字を追加してページズレを防ぐ
+                # OCR対象としてページ番号(1始まり)を控えておく
+                print(f"[INFO] Page {i+1} text is empty or too short. Queued for OCR.")
+                pages.append({"page": i + 1, "hash": page_hash, "text": "", "skipped": False})
+                ocr_pages.append(i + 1)
 
     except Exception as e:
         print(f"[ERROR] Failed to open PDF: {e}")
         raise e
 
-    return pages_text
+    if not ocr_pages:
+        return pages
+
+    # ------------ OCR 実行 -------------
+    # popplerのパスが通っていない場合、poppler_path引数が必要になることがあります
+    conf = _ocr_settings()
+    mode = mode or conf["mode"]
+    started = time.perf_counter()
+
+    if mode == "parallel":
+        ocr_results = _ocr_pages_parallel(pdf_path, ocr_pages, conf)
+    else:
+        ocr_results = _ocr_pages_sequential(pdf_path, ocr_pages, conf)
+
+    for num, text in ocr_results.items():
+        pages[num - 1]["text"] = text
+
+    elapsed = time.perf_counter() - started
+    rate = len(ocr_pages) / elapsed if elapsed > 0 else 0.0
+    metrics.observe_stage("ocr", elapsed, mode=mode, pages=len(ocr_pages))
+    print(
+        f"[INFO] OCR ({mode}, dpi={conf['dpi']}, workers={conf['workers'] if mode == 'parallel' else 1}) "
+        f"{len(ocr_pages)} pages in {elapsed:.1f}s ({rate:.2f} pages/sec)"
+    )
+
+    return pages
+
+
+def extract_text_with_ocr(pdf_path, mode=None):
+    """ページごとのテキストのリストを返す（OCR対応）"""
+    return [p["text"] for p in extract_pages(pdf_path, mode=mode)]
 
 
 # -----------------------------
 # PDF → ChromaDB へ登録
 # -----------------------------
-def process_pdf_and_update_index(pdf_path):
-    # ファイル名をIDのプレフィックスにして、ユニーク性を担保する
-    file_name = Path(pdf_path).name
-    
-    pages = extract_text_with_ocr(pdf_path)
+def _source_key(file_name):
+    # 日本語ファイル名はIDに使いにくいため、ハッシュ化してIDのプレフィックスにする
+    return hashlib.sha1(file_name.encode("utf-8")).hexdigest()[:12]
+
+
+def process_pdf_and_update_index(pdf_path, municipality_id=None, source_name=None):
+    """
+    PDFをベクトルDBへ登録する（内容ハッシュをキーにした冪等な upsert）
+    - municipality_id を指定した場合は、その自治体専用のコレクションに登録する
+    - source_name は資料名（アップロード時のファイル名）。省略時は保存先のファイル名を使う
+    - 各ページは文単位でトークン数上限のチャンクに分割して登録する
+    - IDは「ファイル名ハッシュ_ページ内容ハッシュ_チャンク番号」なので、同じPDFを再アップロードしても重複しない
+    - 前回から変わっていないページは OCR・埋め込みをスキップする
+    - 新しい版で消えたページはコレクションから削除する
+    戻り値: {"added": 追加/更新チャンク数, "unchanged": 変更なしチャンク数, "removed": 削除チャンク数}
+    """
+    file_name = source_name or Path(pdf_path).name
+    source_key = _source_key(file_name)
+    collection = get_collection(municipality_id)
+    # 別のモデルのベクトルが混ざると検索できなくなるため、モデル変更後は再埋め込みが済むまで登録しない
+    if collection_embedding_model(collection) != embedding_model_id():
+        raise ValueError(
+            f"{collection.name} was embedded with {collection_embedding_model(collection)}; "
+            f"run `python manage.py chroma_maintenance reembed` before adding documents with {embedding_model_id()}"
+        )
+    lexical = get_lexical_index(municipality_id)
+    signature = chunking_signature()
+
+    # 既存の登録内容（ページハッシュ → ID）
+    # チャンク設定が変わったページは変更ありとみなして再分割する
+    existing = collection.get(where={"source": file_name}, include=["metadatas"])
+    existing_meta = dict(zip(existing["ids"], existing["metadatas"]))
+    existing_by_hash = {}
+    for doc_id, meta in existing_meta.items():
+        meta = meta or {}
+        if meta.get("page_hash") and meta.get("chunking") == signature:
+            existing_by_hash.setdefault(meta["page_hash"], []).append(doc_id)
+
+    pages = extract_pages(pdf_path, known_hashes=set(existing_by_hash))
     print(f"[DEBUG] Extracted {len(pages)} pages from {file_name}.")
 
-    # 空ページを除去しつつ、元のページ番号を保持したい場合は工夫が必要ですが
-    # ここではシンプルに空文字を除外して登録します
-    valid_docs = []
-    valid_metadatas = []
-    valid_ids = []
+    keep_ids = set()
+    moved_ids, moved_metadatas = [], []
+    new_entries = {}  # ID → (テキスト, メタデータ)。同一内容のページは1件にまとめる
+
+    for p in pages:
+        if p["skipped"]:
+            # 変更なし: ページ番号だけずれていればメタデータのみ更新する
+            for doc_id in existing_by_hash[p["hash"]]:
+                keep_ids.add(doc_id)
+                meta = existing_meta[doc_id]
+                if meta.get("page") != p["page"]:
+                    moved_ids.append(doc_id)
+                    moved_metadatas.append({**meta, "page": p["page"]})
+            continue
 
-    for i, text in enumerate(pages):
+        text = p["text"] or ""
         if not text.strip():
             continue
-            
-        valid_docs.append(text)
-        # メタデータにファイル名を含めることで、どの資料か特定可能にする
-        valid_metadatas.append({"source": file_name, "page": i + 1})
-        # IDをユニークにする (ファイル名_ページ番号)
-        # 日本語ファイル名はIDに使えない場合があるためUUIDを混ぜるかハッシュ化が安全ですが、簡易的に以下とします
-        safe_id = f"{file_name}_{i}_{uuid.uuid4().hex[:8]}"
-        valid_ids.append(safe_id)
-
-    if not valid_docs:
-        print("[WARN] No valid text extracted. Skipping database update.")
-        return
 
-    # 埋め込み生成
-    embeddings = embedding_model(valid_docs)
+        for chunk_index, chunk in enumerate(chunk_text(text)):
+            doc_id = f"{source_key}_{p['hash'][:32]}_{chunk_index}"
+            if doc_id in new_entries:
+                continue
+            # メタデータにファイル名・ページ・ページ内の文字位置を含めることで、どの資料のどこか特定可能にする
+            new_entries[doc_id] = (chunk["text"], {
+                "source": file_name,
+                "page": p["page"],
+                "page_hash": p["hash"],
+                "chunk": chunk_index,
+                "char_start": chunk["start"],
+                "char_end": chunk["end"],
+                "chunking": signature,
+                # 未指定の場合は -1（Chroma のメタデータに None は入れられないため）
+                "municipality_id": municipality_id if municipality_id is not None else -1,
+            })
+
+    stale_ids = [doc_id for doc_id in existing_meta if doc_id not in keep_ids and doc_id not in new_entries]
+
+    if new_entries:
+        ids = list(new_entries)
+        docs = [new_entries[i][0] for i in ids]
+        metadatas = [new_entries[i][1] for i in ids]
+
+        # 埋め込み生成（変更のあったページのみ・バッチ単位・キャッシュ利用）
+        embeddings = embed_texts(docs, get_embedding_model(), embedding_model_id())
+
+        with metrics.timer("chroma_upsert", collection=collection.name, chunks=len(ids)):
+            collection.upsert(
+                ids=ids,
+                documents=docs,
+                embeddings=embeddings,
+                metadatas=metadatas
+            )
+
+        # 語彙検索インデックスも同じIDで更新する
+        lexical.upsert(ids, docs, metadatas)
+
+    if moved_ids:
+        collection.update(ids=moved_ids, metadatas=moved_metadatas)
+
+    if stale_ids:
+        collection.delete(ids=stale_ids)
+        lexical.delete(stale_ids)
+
+    if not new_entries and not keep_ids:
+        print("[WARN] No valid text extracted. Skipping database update.")
 
-    collection.add(
-        ids=valid_ids,
-        documents=valid_docs,
-        embeddings=embeddings,
-        metadatas=valid_metadatas
+    # 資料が変わった場合、キャッシュ済みの回答は古くなっている可能性がある
+    # （共通コレクションの資料は全自治体の回答に使われるため、全自治体のキャッシュを消す）
+    if new_entries or moved_ids or stale_ids:
+        if municipality_id is None:
+            answer_cache.invalidate_all()
+        else:
+            answer_cache.invalidate(municipality_id)
+
+    summary = {"added": len(new_entries), "unchanged": len(keep_ids), "removed": len(stale_ids)}
+    print(
+        f"[INFO] Indexed {file_name}: {summary['added']} added/updated, "
+        f"{summary['unchanged']} unchanged, {summary['removed']} removed."
     )
-
-    print(f"[INFO] Successfully added {len(valid_docs)} chunks to ChromaDB.")
+    return summary
 
 
 # -----------------------------
 # 質問 → Gemini
 # -----------------------------
-def ask_gemini(query):
-    print(f"[QUERY] {query}")
-    
+def embed_query(query):
+    """質問文の埋め込み（コレクション登録時と同じモデル）"""
+    with metrics.timer("query_embedding"):
+        return [float(x) for x in get_embedding_model()([query])[0]]
+
+
+NO_CONTEXT_ANSWER = "申し訳ありません。関連する情報が見つかりませんでした。"
+GENERATION_ERROR_ANSWER = "申し訳ありません。現在回答を生成できません。"
+
+PROMPT_TOKENS = metrics.histogram(
+    "chatbot_prompt_tokens",
+    "Size of prompts sent to the LLM in tokens.",
+    buckets=(250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 16000),
+)
+
+
+def build_prompt(query, query_embedding, municipality_id=None, history=None, search_query=None):
+    """
+    検索結果からプロンプトを組み立てる（関連資料がなければ None）
+    - history: 会話セッションの履歴（conversation.load_history の戻り値）
+    - search_query: 履歴を踏まえて書き換えた検索用の質問（query_embedding はこの質問の埋め込み）
+    """
     # 1. 関連情報の検索
-    # n_results を 3 -> 10 に増加。
-    # Gemini 2.0 Flash はコンテキストウィンドウが広いため、多めに情報を渡したほうが精度が上がります。
-    results = collection.query(
-        query_texts=[query],
-        n_results=10
-    )
+    # 多めに取得してから、重複除去（MMR）・再ランキング・トークン予算で絞り込む
+    from .conversation import format_history
+    from .retrieval import retrieve_context
 
-    retrieved_docs = results["documents"][0]
-    retrieved_meta = results["metadatas"][0]
+    search_query = search_query or query
+    retrieved, retrieval_stats = retrieve_context(search_query, query_embedding, search_targets(municipality_id))
 
-    if not retrieved_docs:
-        return "申し訳ありません。関連する情報が見つかりませんでした。"
+    if not retrieved:
+        return None
 
     # 検索結果を見やすく整形（出典ファイル名も含める）
     context_list = []
-    for doc, meta in zip(retrieved_docs, retrieved_meta):
+    for item in retrieved:
+        meta = item["meta"]
         source_info = f"【出典: {meta.get('source', '不明')} (p.{meta.get('page', '?')})】"
-        context_list.append(f"{source_info}\n{doc}")
+        context_list.append(f"{source_info}\n{item['text']}")
     
     context_text = "\n\n----------------\n\n".join(context_list)
 
+    # 会話の続きの場合は、これまでのやり取り（要約＋直近の数回分）も渡す
+    history_text = format_history(history)
+    if history_text:
+        history_text = f"\n# これまでの会話（質問の意図を理解するために使ってください）\n{history_text}\n"
+    question_text = query
+    if search_query != query:
+        question_text += f"\n（会話の流れを踏まえた質問: {search_query}）"
+
     # 2. プロンプト作成
     prompt = f"""
 # 役割定義
@@ -169,20 +656,146 @@ def ask_gemini(query):
 # 特記事項
 - 質問が外国語であっても、日本語で回答した後、英語での説明も併記してください。
 - 詳細が不明な場合は、「詳細は市役所の担当課までお問い合わせください」と案内してください。
-
+{history_text}
 
 
 質問：
-{query}
+{question_text}
 
 【参考資料】：
 {context_text}
 """
 
+    tokens = count_tokens(prompt)
+    PROMPT_TOKENS.observe(tokens)
+    metrics.log_event(
+        "prompt",
+        tokens=tokens,
+        context_tokens=retrieval_stats["used_tokens"],
+        chunks=retrieval_stats["packed"],
+        history=bool(history_text),
+    )
+    return prompt
+
+
+def cached_answer_or_embedding(search_query, municipality_id=None):
+    """
+    回答キャッシュを確認する
+    完全一致なら質問を埋め込まずに返し、そうでなければ埋め込んで類似質問を探す（埋め込みは検索でもそのまま使う）
+    戻り値: (キャッシュ済みの回答 or None, 質問の埋め込み or None)
+    """
+    cached_answer = answer_cache.lookup_exact(search_query, municipality_id)
+    if cached_answer is not None:
+        return cached_answer, None
+    query_embedding = embed_query(search_query)
+    return answer_cache.lookup_similar(search_query, query_embedding, municipality_id), query_embedding
+
+
+def ask_gemini(query, municipality_id=None, history=None, search_query=None):
+    """
+    質問に回答する
+    会話セッションの場合は history（履歴）と search_query（履歴を踏まえて書き換えた質問）を渡す
+    """
+    search_query = search_query or query
+    print(f"[QUERY] {query}" + (f" -> {search_query}" if search_query != query else ""))
+
+    # 0. 回答キャッシュ
+    cached_answer, query_embedding = cached_answer_or_embedding(search_query, municipality_id)
+    if cached_answer is not None:
+        return cached_answer
+
+    # 1-2. 検索・プロンプト作成
+    prompt = build_prompt(query, query_embedding, municipality_id, history, search_query)
+    if prompt is None:
+        return NO_CONTEXT_ANSWER
+
     # 3. 生成実行
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        answer = llm.generate(prompt)
     except Exception as e:
         print(f"[ERROR] Gemini generation failed: {e}")
-        return "申し訳ありません。現在回答を生成できません。"
+        return GENERATION_ERROR_ANSWER
+
+    # 会話の途中の回答は履歴に依存するため、キャッシュするのは履歴なしで答えたものだけ
+    if not history:
+        answer_cache.store(search_query, query_embedding, answer, municipality_id)
+    return answer
+
+
+async def ask_gemini_stream(query, municipality_id=None, history=None, search_query=None):
+    """
+    ask_gemini のストリーミング版（ASGI の非同期ビュー用）。生成されたテキストを断片ごとに yield する
+    - 埋め込み・キャッシュ・ChromaDB 検索は ask_gemini_async と同じスレッドプールで実行する
+    - Gemini の断片はストリーム用のスレッドで受け取り、asyncio.Queue 経由でイベントループに渡す
+    - キャッシュヒット時は回答全体を1回で返す
+    - 生成途中で失敗した場合は例外をそのまま送出する（呼び出し側でエラーイベントにする）
+    """
+    search_query = search_query or query
+    print(f"[QUERY:stream] {query}" + (f" -> {search_query}" if search_query != query else ""))
+    loop = asyncio.get_running_loop()
+    executor = get_retrieval_executor()
+
+    cached_answer, query_embedding = await loop.run_in_executor(
+        executor, cached_answer_or_embedding, search_query, municipality_id
+    )
+    if cached_answer is not None:
+        yield cached_answer
+        return
+
+    prompt = await loop.run_in_executor(
+        executor, build_prompt, query, query_embedding, municipality_id, history, search_query
+    )
+    if prompt is None:
+        yield NO_CONTEXT_ANSWER
+        return
+
+    parts = []
+    try:
+        async for text in iterate_in_thread(lambda: llm.stream(prompt), get_stream_executor()):
+            parts.append(text)
+            yield text
+    except Exception as e:
+        print(f"[ERROR] Gemini streaming failed: {e}")
+        raise
+
+    # 最後まで生成できた回答のみキャッシュする
+    if not history:
+        await loop.run_in_executor(
+            executor, answer_cache.store, search_query, query_embedding, "".join(parts), municipality_id
+        )
+
+
+async def ask_gemini_async(query, municipality_id=None, history=None, search_query=None):
+    """
+    ask_gemini の非同期版（ASGI の非同期ビュー用）
+    - 埋め込み・キャッシュ・ChromaDB 検索は上限付きスレッドプールで実行する
+    - Gemini の呼び出しは await するため、生成待ちの間ワーカースレッドを占有しない
+    """
+    search_query = search_query or query
+    print(f"[QUERY:async] {query}" + (f" -> {search_query}" if search_query != query else ""))
+    loop = asyncio.get_running_loop()
+    executor = get_retrieval_executor()
+
+    cached_answer, query_embedding = await loop.run_in_executor(
+        executor, cached_answer_or_embedding, search_query, municipality_id
+    )
+    if cached_answer is not None:
+        return cached_answer
+
+    prompt = await loop.run_in_executor(
+        executor, build_prompt, query, query_embedding, municipality_id, history, search_query
+    )
+    if prompt is None:
+        return NO_CONTEXT_ANSWER
+
+    try:
+        answer = await llm.agenerate(prompt)
+    except Exception as e:
+        print(f"[ERROR] Gemini generation failed: {e}")
+        return GENERATION_ERROR_ANSWER
+
+    if not history:
+        await loop.run_in_executor(
+            executor, answer_cache.store, search_query, query_embedding, answer, municipality_id
+        )
+    return answer
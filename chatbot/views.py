@@ -1,12 +1,45 @@
+import hmac
 import json
 import logging
+import re
 from pathlib import Path
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.http import JsonResponse, HttpResponseForbidden
-from django.shortcuts import render
-from django.views.decorators.csrf import csrf_exempt
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import render, get_object_or_404
+from django.urls import reverse
+from django.db import transaction
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.contrib.auth.decorators import login_required
-from .utils import process_pdf_and_update_index, ask_gemini
+
+from config import metrics
+
+from . import answer_cache, llm, ratelimit
+from .conversation import (
+    arewrite_query,
+    compact_in_background,
+    get_or_create_session,
+    load_history,
+    record_turn,
+)
+from .jobs import enqueue_pdf, ensure_workers_started, job_to_dict, retry_job
+from .models import IngestJob, UploadSession
+from .ratelimit import Rejected, check_rate_limit, client_ip, get_async_gate, get_thread_gate
+from .uploads import (
+    HashingPdfUploadHandler,
+    UploadRejected,
+    append_chunk,
+    check_content_length,
+    chunk_bytes,
+    complete_session,
+    create_session,
+    delete_session,
+    discard_chunk,
+    find_duplicate_job,
+    receive_chunk,
+    store_pdf,
+)
+from .utils import GENERATION_ERROR_ANSWER, ask_gemini_async, ask_gemini_stream
 
 logger = logging.getLogger(__name__)
 
@@ -15,66 +48,377 @@ def chat_page(request):
     return render(request, "chatbot/chat.html")
 
 @login_required
+@csrf_exempt
 def upload_pdf(request):
     """
     PDFアップロード処理
     - ログイン必須
     - 自治体職員 (is_official) のみ実行可能
+    - 受信データはハッシュを計算しながら保存先に直接書き込み、「<SHA-256>.pdf」として保存する
+    - 同じ内容のPDFが取り込み済みなら、新しいジョブを作らずに既存のジョブを返す
+    - 保存後すぐにジョブを登録して返す（抽出・登録はワーカーが行う）
     """
     # 権限チェック: 職員でなければ 403 Forbidden
     if not request.user.is_official:
         return JsonResponse({"error": "この操作を行う権限がありません。"}, status=403)
 
-    if request.method == "POST":
-        uploaded_file = request.FILES.get("pdf")
-        
-        if not uploaded_file:
-            return JsonResponse({"error": "ファイルが選択されていません。"}, status=400)
+    if request.method != "POST":
+        return JsonResponse({"error": "POST method required"}, status=405)
+
+    try:
+        check_content_length(request)
+    except UploadRejected as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+
+    # アップロードハンドラは request.FILES を読む前に差し替える必要がある。
+    # CSRF ミドルウェアが先に本文を読んでしまわないよう csrf_exempt にし、ハンドラ設定後に検証する
+    handler = HashingPdfUploadHandler(request)
+    request.upload_handlers = [handler]
+    try:
+        return _receive_pdf(request, handler)
+    finally:
+        # CSRF 検証で拒否された場合など、保存先に移動しなかった一時ファイルを残さない
+        # （移動済みの場合は何もしない）
+        handler.discard()
+
+
+@csrf_protect
+def _receive_pdf(request, handler):
+    uploaded_file = request.FILES.get("pdf")
+
+    if handler.error is not None:
+        return JsonResponse({"error": str(handler.error)}, status=handler.error.status)
+    if not uploaded_file:
+        return JsonResponse({"error": "ファイルが選択されていません。"}, status=400)
 
-        # ファイル名に日本語が含まれる場合のトラブル回避のため、必要ならリネーム等を検討
-        # ここではシンプルにそのまま保存します
-        pdf_dir = settings.BASE_DIR / "chatbot" / "pdfs"
-        pdf_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        uploaded_file.close()
+        save_path, _ = store_pdf(uploaded_file.temporary_file_path(), uploaded_file.sha256)
+        return _enqueue_upload(request, save_path, uploaded_file.name)
+    except Exception as e:
+        handler.discard()
+        logger.error(f"Upload failed: {e}")
+        return JsonResponse({"error": str(e)}, status=500)
 
-        save_path = pdf_dir / uploaded_file.name
 
+def _enqueue_upload(request, save_path, filename):
+    """保存したPDFの取り込みジョブを登録する（同じ内容のPDFが取り込み済みなら既存のジョブを返す）"""
+    municipality_id = request.user.municipality_id
+    job = find_duplicate_job(save_path, municipality_id)
+    if job is not None:
+        return JsonResponse({
+            "status": "duplicate",
+            "filename": filename,
+            "job_id": job.pk,
+            "status_url": reverse("chatbot:job_status", args=[job.pk]),
+        })
+
+    # ベクトルDBへの登録はバックグラウンドで実行
+    # 資料はアップロードした職員の自治体に紐付ける
+    job = enqueue_pdf(save_path, filename, municipality_id)
+    ensure_workers_started()
+
+    return JsonResponse({
+        "status": "queued",
+        "filename": filename,
+        "job_id": job.pk,
+        "status_url": reverse("chatbot:job_status", args=[job.pk]),
+    }, status=202)
+
+
+def _upload_session_to_dict(session):
+    return {
+        "session_id": str(session.pk),
+        "filename": session.filename,
+        "size": session.size,
+        "received": session.received,
+        "chunk_size": chunk_bytes(),
+        "upload_url": reverse("chatbot:upload_session", args=[session.pk]),
+    }
+
+
+@login_required
+def upload_session_create(request):
+    """
+    分割アップロードの開始
+    POST {"filename": "...", "size": バイト数} → セッションID・送信先URL・チャンクサイズを返す
+    """
+    if not request.user.is_official:
+        return JsonResponse({"error": "この操作を行う権限がありません。"}, status=403)
+    if request.method != "POST":
+        return JsonResponse({"error": "POST method required"}, status=405)
+
+    try:
+        body = json.loads(request.body.decode("utf-8"))
+        filename = Path(str(body.get("filename", ""))).name[:255]
+        size = int(body.get("size", 0))
+    except (json.JSONDecodeError, TypeError, ValueError):
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    if not filename:
+        return JsonResponse({"error": "ファイルが選択されていません。"}, status=400)
+
+    try:
+        session = create_session(request.user, filename, size)
+    except UploadRejected as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+    return JsonResponse(_upload_session_to_dict(session), status=201)
+
+
+_CONTENT_RANGE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+
+@login_required
+def upload_session(request, session_id):
+    """
+    分割アップロードのセッション
+    - GET:    受信済みバイト数を返す（再開時はこの位置から送る）
+    - PUT:    チャンクを送る（Content-Range: bytes <開始>-<終了>/<全体>）。最後のチャンクで取り込みジョブを登録する
+    - DELETE: アップロードを中止する
+    """
+    if not request.user.is_official:
+        return JsonResponse({"error": "この操作を行う権限がありません。"}, status=403)
+
+    if request.method == "GET":
+        session = get_object_or_404(UploadSession, pk=session_id, user=request.user)
+        return JsonResponse(_upload_session_to_dict(session))
+
+    if request.method == "DELETE":
+        session = get_object_or_404(UploadSession, pk=session_id, user=request.user)
+        delete_session(session)
+        return JsonResponse({"status": "cancelled"})
+
+    if request.method != "PUT":
+        return JsonResponse({"error": "PUT method required"}, status=405)
+
+    match = _CONTENT_RANGE.match(request.headers.get("Content-Range", ""))
+    if not match:
+        return JsonResponse({"error": "Content-Range ヘッダーが必要です。"}, status=400)
+    start, end, total = (int(x) for x in match.groups())
+
+    session = get_object_or_404(UploadSession, pk=session_id, user=request.user)
+    try:
+        if total != session.size:
+            raise UploadRejected("ファイルサイズが一致しません。")
+        # 本文の受信はロックの外で行う（遅いクライアントが行ロック・トランザクションを持ち続けないように）
+        chunk_path = receive_chunk(session, start, request, end - start + 1)
         try:
-            with open(save_path, "wb") as f:
-                for chunk in uploaded_file.chunks():
-                    f.write(chunk)
-            
-            # ベクトルDBへの登録処理
-            process_pdf_and_update_index(str(save_path))
-            
-            return JsonResponse({"status": "success", "filename": uploaded_file.name})
+            # 同じセッションへの同時送信は行ロックで順番に処理する（ロック中は受信済みのチャンクを追記するだけ）
+            with transaction.atomic():
+                session = get_object_or_404(
+                    UploadSession.objects.select_for_update(), pk=session_id, user=request.user
+                )
+                append_chunk(session, start, chunk_path)
+        finally:
+            discard_chunk(chunk_path)
+
+        if session.received < session.size:
+            return JsonResponse(_upload_session_to_dict(session))
+
+        # 最後のチャンクを追記したリクエストだけがここに来る
+        save_path, _ = complete_session(session)
+        return _enqueue_upload(request, save_path, session.filename)
+    except UploadRejected as e:
+        data = {"error": str(e)}
+        if e.status == 409:
+            # クライアントが正しい位置から再送できるように受信済みバイト数を返す
+            data["received"] = UploadSession.objects.filter(pk=session_id).values_list("received", flat=True).first()
+        return JsonResponse(data, status=e.status)
 
-        except Exception as e:
-            logger.error(f"Upload failed: {e}")
-            return JsonResponse({"error": str(e)}, status=500)
 
-    return JsonResponse({"error": "POST method required"}, status=405)
+@login_required
+def job_status(request, job_id):
+    """取り込みジョブの状態を返す（chat.html からポーリングされる）"""
+    if not request.user.is_official:
+        return JsonResponse({"error": "この操作を行う権限がありません。"}, status=403)
+
+    # 他の自治体のジョブは見えないようにする
+    job = get_object_or_404(IngestJob, pk=job_id, municipality_id=request.user.municipality_id)
+    # 未処理のジョブが残っている場合に備えてワーカーを起動しておく
+    if job.status == IngestJob.STATUS_PENDING:
+        ensure_workers_started()
+    return JsonResponse(job_to_dict(job))
+
+
+@login_required
+def job_retry(request, job_id):
+    """失敗したジョブを再実行する"""
+    if not request.user.is_official:
+        return JsonResponse({"error": "この操作を行う権限がありません。"}, status=403)
+    if request.method != "POST":
+        return JsonResponse({"error": "POST method required"}, status=405)
+
+    job = get_object_or_404(IngestJob, pk=job_id, municipality_id=request.user.municipality_id)
+    if job.status != IngestJob.STATUS_FAILED:
+        return JsonResponse({"error": "失敗したジョブのみ再実行できます。"}, status=409)
+
+    retry_job(job)
+    ensure_workers_started()
+    return JsonResponse(job_to_dict(job), status=202)
+
+
+def _rejected_response(rejected):
+    """受付制御で拒否したときの応答（429: レート制限 / 503: 混雑）"""
+    message = (
+        "短時間に多くの質問が送信されました。しばらくしてから再度お試しください。"
+        if rejected.status == 429 else
+        "現在混み合っています。しばらくしてから再度お試しください。"
+    )
+    response = JsonResponse({"error": message, "reason": rejected.reason}, status=rejected.status)
+    response["Retry-After"] = str(rejected.retry_after)
+    return response
 
 
 @csrf_exempt
-def chat_api(request):
-    """チャットボットAPI (POSTのみ)"""
+async def chat_api(request):
+    """
+    チャットボットAPI (POSTのみ)
+    非同期ビュー: Gemini の応答待ちの間もワーカースレッドを占有しない
+    リクエスト: {"question": "...", "session_id": "..."}（session_id は省略可。前回の応答の session_id を送ると会話の続きになる）
+    """
     if request.method != "POST":
         return JsonResponse({"error": "POST only"}, status=405)
 
     try:
+        user = await request.auser()
+        # 利用者・IPごとのレート制限（バケットはDBで全プロセス共有）
+        await sync_to_async(check_rate_limit)(user, client_ip(request))
+
         body = json.loads(request.body.decode("utf-8"))
         question = body.get("question", "").strip()
 
         if not question:
             return JsonResponse({"error": "質問内容が空です。"}, status=400)
 
-        # Geminiへ問い合わせ
-        answer = ask_gemini(question)
-        return JsonResponse({"answer": answer})
+        # 検索対象は質問者の自治体の資料のみ
+        municipality_id = user.municipality_id if user.is_authenticated else None
+
+        # Geminiへ問い合わせ（同時実行数を超えた場合は順番待ち、待ち行列が満杯なら拒否）
+        async with get_async_gate():
+            # 会話セッション: 履歴を踏まえて検索用の質問を書き換え、回答後に履歴を保存・要約する
+            session = await sync_to_async(get_or_create_session)(body.get("session_id"), user)
+            with metrics.timer("chat", mode="async"):
+                history = await sync_to_async(load_history)(session)
+                search_query = await arewrite_query(history, question)
+                answer = await ask_gemini_async(question, municipality_id, history, search_query)
+        # 履歴の保存は同時実行数の枠を返してから行い、要約は回答を返した後にバックグラウンドで行う
+        if answer != GENERATION_ERROR_ANSWER:
+            folded = await sync_to_async(record_turn)(session, question, search_query, answer)
+            compact_in_background(session, folded)
+        return JsonResponse({"answer": answer, "session_id": str(session.pk)})
 
+    except Rejected as e:
+        return _rejected_response(e)
     except json.JSONDecodeError:
         return JsonResponse({"error": "Invalid JSON"}, status=400)
     except Exception as e:
         logger.error(f"Chat API Error: {e}")
         return JsonResponse({"error": str(e)}, status=500)
-    
\ No newline at end of file
+    
+
+
+def _sse(data, event=None):
+    """Server-Sent Events の1イベント分の文字列"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@csrf_exempt
+async def chat_stream_api(request):
+    """
+    チャットボットAPI（ストリーミング版, POSTのみ）
+    生成されたテキストを Server-Sent Events で少しずつ返す
+    非同期ビュー: 断片は届いた順にそのまま送り、配信中もワーカースレッドを占有しない
+    - event: session          会話セッションID（次の質問の session_id に指定すると会話の続きになる）
+    - data: {"delta": "..."}  回答の断片
+    - event: done             生成完了
+    - event: error            生成失敗
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST only"}, status=405)
+
+    user = await request.auser()
+    try:
+        await sync_to_async(check_rate_limit)(user, client_ip(request))
+    except Rejected as e:
+        return _rejected_response(e)
+
+    try:
+        body = json.loads(request.body.decode("utf-8"))
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+
+    question = body.get("question", "").strip()
+    if not question:
+        return JsonResponse({"error": "質問内容が空です。"}, status=400)
+
+    # 検索対象は質問者の自治体の資料のみ
+    municipality_id = user.municipality_id if user.is_authenticated else None
+
+    # 同時に配信中のストリーム数の上限（超えたら待たせずに 503）
+    gate = get_thread_gate()
+    try:
+        gate.acquire()
+    except Rejected as e:
+        return _rejected_response(e)
+
+    # セッションは受け付けたリクエストだけ作る（拒否したリクエストで行を作らない）
+    try:
+        session = await sync_to_async(get_or_create_session)(body.get("session_id"), user)
+    except Exception as e:
+        gate.release()
+        logger.error(f"Chat stream API Error: {e}")
+        return JsonResponse({"error": str(e)}, status=500)
+
+    async def event_stream():
+        try:
+            # 次の質問で送り返してもらうセッションID
+            yield _sse({"session_id": str(session.pk)}, event="session")
+            with metrics.timer("chat", mode="stream"):
+                history = await sync_to_async(load_history)(session)
+                search_query = await arewrite_query(history, question)
+                parts = []
+                async for delta in ask_gemini_stream(question, municipality_id, history, search_query):
+                    parts.append(delta)
+                    yield _sse({"delta": delta})
+            yield _sse({}, event="done")
+            # 回答を送り終えてから履歴を保存する（要約はバックグラウンドで行う）
+            folded = await sync_to_async(record_turn)(session, question, search_query, "".join(parts))
+            compact_in_background(session, folded)
+        except Exception as e:
+            logger.error(f"Chat stream API Error: {e}")
+            yield _sse({"error": "申し訳ありません。現在回答を生成できません。"}, event="error")
+        finally:
+            # 完了・失敗・切断（aclose やキャンセル）のいずれでも、ここで1回だけ枠を返す
+            gate.release()
+
+    response = StreamingHttpResponse(event_stream(), content_type="text/event-stream; charset=utf-8")
+    response["Cache-Control"] = "no-cache"
+    # nginx 等のリバースプロキシでバッファリングさせない
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@login_required
+def cache_stats(request):
+    """回答キャッシュのヒット・ミス回数、LLM生成の相乗り回数、受付・拒否の回数を返す（このプロセス内の累計）"""
+    if not request.user.is_official:
+        return JsonResponse({"error": "この操作を行う権限がありません。"}, status=403)
+    stats = answer_cache.get_stats()
+    stats["llm"] = llm.get_stats()
+    stats["admission"] = ratelimit.get_stats()
+    return JsonResponse(stats)
+
+
+def metrics_endpoint(request):
+    """
+    各段階の処理時間・回数を Prometheus のテキスト形式で返す（このプロセス内の累計）
+    - 職員としてログインしている場合、または
+    - CHATBOT_METRICS_TOKEN を設定し、Authorization: Bearer <トークン> を付けた場合（Prometheus からの収集用）
+    """
+    token = getattr(settings, "CHATBOT_METRICS_TOKEN", None)
+    authorization = request.META.get("HTTP_AUTHORIZATION", "")
+    if token and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        pass
+    elif not (request.user.is_authenticated and request.user.is_official):
+        return HttpResponse("Forbidden\n", status=403, content_type="text/plain; charset=utf-8")
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
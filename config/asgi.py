@@ -14,3 +14,10 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_asgi_application()
+
+# チャットボットの重い初期化（ChromaDB・埋め込みモデル等）を起動時に済ませる場合
+from django.conf import settings
+
+if getattr(settings, 'CHATBOT_WARMUP_ON_START', False):
+    from chatbot.utils import warm_up
+    warm_up()
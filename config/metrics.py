@@ -0,0 +1,197 @@
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# -----------------------------
+# 処理時間・回数の計測
+# -----------------------------
+# 取り込み（PDF抽出・OCR・埋め込み・ChromaDB 登録）とチャット（検索・プロンプト・LLM・キャッシュ）の
+# 各段階、お知らせ（外部APIへのリクエスト・避難場所の検索）の処理時間と回数を集計し、
+#   - /chatbot/metrics/ で Prometheus のテキスト形式として公開する
+#   - 1件ごとに JSON 形式のログ（ロガー "chatbot.metrics"）にも出す
+# 集計はプロセスごと（複数ワーカーの場合は Prometheus 側で合算する）。複数のアプリで使うので config に置く。
+# prometheus_client には依存せず、必要な Counter / Histogram だけを実装している。
+logger = logging.getLogger("chatbot.metrics")
+
+# 処理時間（秒）の既定のバケット。OCR・LLM は数十秒かかることがある
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(list(zip(self.labelnames, key)), value))
+        return lines
+
+
+class Counter(_Metric):
+    """増える一方の回数"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self, labels, value):
+        return [f"{self.name}_total{_format_labels(labels)} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    """値の分布（処理時間・トークン数など）"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def snapshot(self, **labels):
+        """{"count": 回数, "sum": 合計}（まだ記録がなければどちらも0）"""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return {"count": state["count"], "sum": state["sum"]} if state else {"count": 0, "sum": 0.0}
+
+    def _samples(self, labels, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state["counts"]):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', _format_value(bound))])} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(state['sum'])}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {state['count']}")
+        return lines
+
+
+def _register(metric_class, name, *args, **kwargs):
+    # 同じ名前で2回作られた場合（モジュールの再読み込みなど）は既存のものを返す
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = metric_class(name, *args, **kwargs)
+        return metric
+
+
+def counter(name, documentation, labelnames=()):
+    """Counter を作成して登録する（公開時の名前は name + "_total"）"""
+    return _register(Counter, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def render():
+    """登録済みの全メトリクスを Prometheus のテキスト形式で返す"""
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# -----------------------------
+# 共通のメトリクス
+# -----------------------------
+STAGE_SECONDS = histogram(
+    "chatbot_stage_duration_seconds",
+    "Duration of ingestion and chat pipeline stages in seconds.",
+    ["stage"],
+)
+STAGE_ERRORS = counter(
+    "chatbot_stage_errors",
+    "Pipeline stages that raised an exception.",
+    ["stage"],
+)
+
+
+# -----------------------------
+# 構造化ログ
+# -----------------------------
+def log_event(event, **fields):
+    """1行1イベントの JSON ログを出す（CHATBOT_METRICS_LOG = False なら出さない）"""
+    if not getattr(settings, "CHATBOT_METRICS_LOG", True) or not logger.isEnabledFor(logging.INFO):
+        return
+    logger.info(json.dumps({"event": event, "ts": round(time.time(), 3), **fields}, ensure_ascii=False, default=str))
+
+
+def observe_stage(stage, seconds, **fields):
+    """計測済みの処理時間を記録する（別プロセスで計測した OCR など）"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    log_event("stage", stage=stage, seconds=round(seconds, 4), **fields)
+
+
+@contextmanager
+def timer(stage, **fields):
+    """
+    with ブロックの処理時間を stage として記録する
+    fields はログにだけ出す（ラベルにすると組み合わせが増えすぎるため）
+    """
+    started = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as e:
+        STAGE_ERRORS.inc(stage=stage)
+        observe_stage(stage, time.perf_counter() - started, error=type(e).__name__, **fields)
+        raise
+    observe_stage(stage, time.perf_counter() - started, **fields)
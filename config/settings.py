@@ -151,4 +151,251 @@ LOGIN_URL = '/users/login/'
 LOGIN_REDIRECT_URL = 'notices:notices_list'
 
 # ログアウト後の遷移先（お好みで。ログイン画面に戻すのが一般的です）
-LOGOUT_REDIRECT_URL = 'users:login'
\ No newline at end of file
+LOGOUT_REDIRECT_URL = 'users:login'
+
+
+# -----------------------------
+# チャットボット: PDF取り込みキュー
+# -----------------------------
+# Webプロセス内で取り込みワーカーを自動起動するか
+# （専用プロセスで `python manage.py run_ingest_worker` を動かす場合は False）
+CHATBOT_INGEST_AUTOSTART = True
+CHATBOT_INGEST_WORKERS = 2
+CHATBOT_INGEST_MAX_ATTEMPTS = 3
+CHATBOT_INGEST_RETRY_BACKOFF = 30  # 秒（試行ごとに2倍）
+CHATBOT_INGEST_POLL_INTERVAL = 5  # 秒
+CHATBOT_INGEST_LOCK_TIMEOUT = 30 * 60  # 秒（これを超えた処理中ジョブは回収）
+
+
+# -----------------------------
+# チャットボット: OCR
+# -----------------------------
+# "parallel": OCR対象ページを一括ラスタライズし、プロセスプールでtesseractを並列実行
+# "sequential": 1ページずつ処理（従来方式）
+CHATBOT_OCR_MODE = "parallel"
+CHATBOT_OCR_DPI = 300
+CHATBOT_OCR_WORKERS = None  # None の場合は CPU コア数
+CHATBOT_OCR_LANG = "jpn+eng"
+# OCR対象ページの間隔がこのページ数以下なら、まとめて1回でラスタライズする
+CHATBOT_OCR_MERGE_GAP = 2
+
+# -----------------------------
+# チャットボット: チャンク分割
+# -----------------------------
+# PDFの各ページを文単位でまとめ、このトークン数以下のチャンクとして登録する
+CHATBOT_CHUNK_TOKENS = 400
+# 隣り合うチャンクで重複させるトークン数
+CHATBOT_CHUNK_OVERLAP_TOKENS = 50
+
+# -----------------------------
+# チャットボット: 埋め込み
+# -----------------------------
+# 1回の埋め込み呼び出しで処理するチャンク数（メモリ使用量の上限になる）
+CHATBOT_EMBEDDING_BATCH_SIZE = 32
+# "default": ChromaDB 標準 (all-MiniLM-L6-v2, 英語モデル) / "hashing": オフライン検証用の特徴ハッシュ
+# "sentence-transformers": CHATBOT_EMBEDDING_MODEL_PATH のローカルモデル（多言語モデル推奨）
+# ※ モデルを変えたら python manage.py chroma_maintenance reembed で登録済みのベクトルを作り直す
+CHATBOT_EMBEDDING_PROVIDER = "default"
+# 例: BASE_DIR / "models" / "paraphrase-multilingual-MiniLM-L12-v2"
+CHATBOT_EMBEDDING_MODEL_PATH = None
+# "torch" / "onnx"（onnx の場合はモデルディレクトリに ONNX ファイルが必要）
+CHATBOT_EMBEDDING_BACKEND = "torch"
+# torch: True なら int8 に動的量子化する（CPUでの推論が速くなり、メモリも減る）
+CHATBOT_EMBEDDING_QUANTIZE = False
+# onnx: 使うファイル（例: "onnx/model_qint8_avx2.onnx"）。None なら onnx/model.onnx
+CHATBOT_EMBEDDING_ONNX_FILE = None
+# 推論に使うCPUスレッド数（None なら PyTorch の既定値）
+CHATBOT_EMBEDDING_THREADS = None
+# (モデルID, テキストハッシュ) → ベクトル のキャッシュ
+CHATBOT_EMBEDDING_CACHE_PATH = BASE_DIR / "embedding_cache.sqlite3"
+
+# -----------------------------
+# チャットボット: PDFアップロード
+# -----------------------------
+# アップロードされたPDFは CHATBOT_PDF_DIR に「<SHA-256>.pdf」として保存する
+CHATBOT_PDF_DIR = BASE_DIR / "chatbot" / "pdfs"
+CHATBOT_UPLOAD_MAX_BYTES = 100 * 1024 * 1024
+# 分割アップロードの1回あたりの最大サイズと、途中で止まったアップロードを削除するまでの時間（秒）
+CHATBOT_UPLOAD_CHUNK_BYTES = 5 * 1024 * 1024
+CHATBOT_UPLOAD_SESSION_TTL = 24 * 60 * 60
+
+# -----------------------------
+# チャットボット: 起動
+# -----------------------------
+# True の場合、wsgi/asgi の起動時に ChromaDB・埋め込みモデル等を初期化する
+# （False なら最初に使われたときに初期化される）
+CHATBOT_WARMUP_ON_START = False
+
+# -----------------------------
+# チャットボット: 回答キャッシュ
+# -----------------------------
+CHATBOT_ANSWER_CACHE_ENABLED = True
+CHATBOT_ANSWER_CACHE_TTL = 6 * 60 * 60  # 秒
+# 質問の埋め込みのコサイン類似度がこの値以上なら同じ質問とみなす
+CHATBOT_ANSWER_CACHE_SIMILARITY = 0.92
+
+# -----------------------------
+# チャットボット: LLM
+# -----------------------------
+# "gemini": Gemini API / "fake": APIを呼ばずに定型文をストリーミングする（画面確認・負荷試験用）
+# LLMBackend を継承したクラスのドット区切りパスも指定できる
+CHATBOT_LLM_BACKEND = os.getenv("CHATBOT_LLM_BACKEND", "gemini")
+CHATBOT_GEMINI_MODEL = "gemini-2.0-flash"
+# 同じプロンプトの生成が実行中なら、新たに生成せずその結果を共有する
+CHATBOT_LLM_COALESCE = True
+# 偽LLM（CHATBOT_LLM_BACKEND = "fake"）の設定
+CHATBOT_FAKE_LLM_TEXT = None  # None の場合は既定の定型文
+CHATBOT_FAKE_LLM_DELAY = 0.05  # 断片ごとの待ち時間（秒）
+
+# -----------------------------
+# チャットボット: 同時実行
+# -----------------------------
+# プロセスあたりで同時に処理するチャット数（超えた分は待ち行列に入る）
+CHATBOT_MAX_CONCURRENT_CHATS = 32
+# 待ち行列の上限（超えたら 503 を返す）と、待ち時間の上限（秒）
+CHATBOT_MAX_QUEUED_CHATS = 64
+CHATBOT_QUEUE_TIMEOUT = 10
+# プロセスあたりで同時に配信するストリーミング回答の数（超えたら 503 を返す）
+CHATBOT_MAX_CONCURRENT_STREAMS = 32
+# ChromaDB 検索・埋め込みを実行するスレッド数
+CHATBOT_RETRIEVAL_WORKERS = 4
+
+# -----------------------------
+# チャットボット: 会話セッション
+# -----------------------------
+# 直近のやり取りをそのままプロンプトに入れる上限（トークン）。超えた分は要約にまとめる
+CHATBOT_HISTORY_TOKEN_BUDGET = 800
+# 要約の上限（トークン）
+CHATBOT_SUMMARY_TOKEN_BUDGET = 400
+# 続きの質問を検索用に書き換える方法: "llm" / "concat"（直前の質問とつなげる）/ "off"
+CHATBOT_QUERY_REWRITE = "llm"
+# 最後のやり取りからこの秒数が過ぎたセッションは削除する
+CHATBOT_CHAT_SESSION_TTL = 24 * 60 * 60
+# 回答後に履歴を要約するスレッドの数（プロセスあたり）
+CHATBOT_COMPACT_WORKERS = 2
+
+# -----------------------------
+# チャットボット: レート制限
+# -----------------------------
+# トークンバケット: capacity 回まで連続で質問でき、1分あたり per_minute 回分回復する（超えたら 429）
+# capacity・per_minute を 0 にした制限は無効になる
+# 負荷試験（chat_loadtest）ではサーバーを CHATBOT_RATE_LIMIT_ENABLED=0 で起動する（1つのIPから大量に送るため）
+CHATBOT_RATE_LIMIT_ENABLED = os.getenv("CHATBOT_RATE_LIMIT_ENABLED", "1") != "0"
+CHATBOT_RATE_LIMIT_USER = {"capacity": 10, "per_minute": 10}
+# 庁舎・避難所など同じIPから複数人が使う場合を考慮して多めにする
+CHATBOT_RATE_LIMIT_IP = {"capacity": 30, "per_minute": 30}
+# リバースプロキシの背後で動かす場合のみ True（X-Forwarded-For の先頭をクライアントIPとみなす）
+CHATBOT_RATE_LIMIT_TRUST_X_FORWARDED_FOR = False
+
+# -----------------------------
+# チャットボット: 検索結果の絞り込み
+# -----------------------------
+# 自治体の利用者も共通コレクション（pdf_collection）を検索するか
+# （自治体未設定の職員がアップロードした資料・自治体ごとに分ける前に登録した資料が入っている）
+CHATBOT_SEARCH_SHARED_COLLECTION = True
+CHATBOT_RETRIEVAL_FETCH_K = 30  # ChromaDB から多めに取得する件数
+CHATBOT_RETRIEVAL_TOP_K = 10  # MMR で選ぶ最大件数
+CHATBOT_MMR_LAMBDA = 0.7  # 1に近いほど関連度重視、0に近いほど多様性重視
+CHATBOT_DEDUP_SIMILARITY = 0.95  # 選択済みチャンクとの類似度がこれ以上なら重複として除外
+CHATBOT_CONTEXT_TOKEN_BUDGET = 3000  # プロンプトに入れる参考資料の最大トークン数
+# ローカルの CrossEncoder モデルのパス（None なら再ランキングしない）
+CHATBOT_RERANKER_MODEL = None
+
+# -----------------------------
+# チャットボット: ベクトル検索インデックス（HNSW）
+# -----------------------------
+# 新しく作るコレクションに使う。空なら ChromaDB の既定値（M=16, construction_ef=100, search_ef=100）
+# 値は python manage.py chroma_maintenance bench で再現率と速度を比べて決める
+CHATBOT_HNSW_PARAMS = {}
+
+# -----------------------------
+# チャットボット: 語彙検索（ハイブリッド検索）
+# -----------------------------
+# True の場合、ベクトル検索に加えて文字 n-gram の全文検索（SQLite FTS5）を行い、
+# Reciprocal Rank Fusion で統合する
+CHATBOT_HYBRID_SEARCH = True
+CHATBOT_LEXICAL_INDEX_PATH = BASE_DIR / "lexical_index.sqlite3"
+CHATBOT_RRF_K = 60
+
+# -----------------------------
+# チャットボット: メトリクス
+# -----------------------------
+# /chatbot/metrics/ で各段階の処理時間・回数を Prometheus 形式で公開する（職員ログインまたはトークンで取得）
+# 設定した場合、Authorization: Bearer <トークン> を付けた収集リクエストを受け付ける
+CHATBOT_METRICS_TOKEN = os.getenv("CHATBOT_METRICS_TOKEN")
+# True の場合、各段階の処理時間を JSON 形式のログ（ロガー "chatbot.metrics"）にも出す
+CHATBOT_METRICS_LOG = True
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        # メッセージ自体が JSON なので、そのまま1行で出す
+        "json_line": {"format": "%(message)s"},
+        "plain": {"format": "[%(levelname)s] %(name)s: %(message)s"},
+    },
+    "handlers": {
+        "metrics_console": {"class": "logging.StreamHandler", "formatter": "json_line"},
+        "console": {"class": "logging.StreamHandler", "formatter": "plain"},
+    },
+    "loggers": {
+        # 外部APIのサーキットブレーカーの開閉（notices.http_client）などを INFO から出す
+        "notices": {
+            "handlers": ["console"],
+            "level": os.getenv("NOTICES_LOG_LEVEL", "INFO"),
+            "propagate": False,
+        },
+        "chatbot.metrics": {
+            "handlers": ["metrics_console"],
+            "level": os.getenv("CHATBOT_METRICS_LOG_LEVEL", "INFO"),
+            "propagate": False,
+        },
+    },
+}
+
+# -----------------------------
+# お知らせ: 外部データ（避難所・天気）
+# -----------------------------
+# 接続先（テスト時は `python manage.py notices_stub_server` のURLに向ける）
+NOTICES_BODIK_DATASTORE_URL = os.getenv(
+    "NOTICES_BODIK_DATASTORE_URL", "https://data.bodik.jp/api/3/action/datastore_search"
+)
+NOTICES_OPEN_METEO_URL = os.getenv("NOTICES_OPEN_METEO_URL", "https://api.open-meteo.com/v1/forecast")
+NOTICES_FETCH_TIMEOUT = 10  # 秒（NOTICES_HTTP_TIMEOUTS にないホスト）
+# ホストごとのタイムアウト（秒、または (接続, 読み取り)）。大きなページを返す BODIK は読み取りを長めにする
+NOTICES_HTTP_TIMEOUTS = {
+    "data.bodik.jp": (3, 15),
+    "api.open-meteo.com": (3, 5),
+}
+# 外部APIへの接続（notices.http_client）
+NOTICES_HTTP_POOL_SIZE = 10  # ホストごとに保持する接続数（NOTICES_REFRESH_WORKERS 以上にする）
+NOTICES_HTTP_RETRIES = 2  # 接続エラー・タイムアウト・429/5xx の再試行回数
+NOTICES_HTTP_BACKOFF = 0.5  # 再試行の待ち時間の基準（秒）。0〜基準×2^n のランダムな時間待つ
+NOTICES_HTTP_BACKOFF_MAX = 5
+# 連続してこの回数失敗したホストへは、NOTICES_HTTP_CIRCUIT_RESET 秒間リクエストを送らない
+NOTICES_HTTP_CIRCUIT_FAILURES = 5
+NOTICES_HTTP_CIRCUIT_RESET = 60
+# 避難場所の同期で datastore_search 1回あたりに取得する件数
+NOTICES_BODIK_PAGE_SIZE = 500
+# Webプロセス内で定期更新スレッドを起動するか
+# （専用プロセスで `python manage.py refresh_notices` を動かす場合は False）
+NOTICES_REFRESH_AUTOSTART = True
+NOTICES_REFRESH_TICK = 30  # 更新時刻を確認する間隔（秒）
+# 更新時刻になったフィード（自治体 × データの種類）を同時に取得するスレッド数
+NOTICES_REFRESH_WORKERS = 8
+# 期限（各フィードの max_age）のこの割合が過ぎたら更新する
+NOTICES_REFRESH_AHEAD = 0.8
+# 更新に失敗した後、次に試すまでの間隔（秒）
+NOTICES_REFRESH_RETRY_INTERVAL = 60
+# 更新ロックの有効期限（秒）。更新中のプロセスが落ちても、この時間が過ぎれば他が更新できる
+NOTICES_REFRESH_LOCK_TIMEOUT = 60
+# 外部APIが落ちていても、最後に取得したデータをこの期間（秒）は表示し続ける
+NOTICES_FEED_KEEP_STALE = 7 * 24 * 60 * 60
+# 最寄りの避難場所API（/notices/api/shelters/nearest/）で返す最大件数
+NOTICES_SHELTER_NEAREST_MAX = 50
+# 自治体ごとに使うアダプター（LLMバックエンドと同じく、クラスのドット区切りパスで追加できる）
+# 自治体（users.Municipality）の api_url・shelter_resource_id・緯度経度のうち、必要な設定があるものだけ使う
+NOTICES_ADAPTERS = [
+    "notices.adapters.CkanShelterAdapter",
+    "notices.adapters.OpenMeteoWeatherAdapter",
+]
@@ -0,0 +1,175 @@
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import http_client
+from .shelters import last_synced_at, sync_shelters
+
+# -----------------------------
+# 自治体ごとの外部データ取得（アダプター）
+# -----------------------------
+# 自治体（users.Municipality）の api_url・座標・リソースIDから、取得できるデータの種類ごとにアダプターを作る。
+#   "shelters": CKAN DataStore（BODIK・東京都オープンデータカタログなど）の避難場所データ → Shelter テーブルに同期
+#   "weather":  Open-Meteo の天気予報（緯度・経度）
+# 使うアダプターは settings.NOTICES_ADAPTERS（クラスのドット区切りパス）で追加・差し替えできる。
+# キャッシュ・定期更新は notices.utils が行う（アダプターは取得だけを担当し、失敗時は例外を送出する）。
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# 奄美市：指定緊急避難場所のリソースID
+AMAMI_EVACUATION_RESOURCE_ID = '815306ec-66f3-4e31-9706-e0f39e3368a5'
+# 奄美市名瀬の座標
+AMAMI_LATITUDE = 28.37
+AMAMI_LONGITUDE = 129.49
+
+# WMOコードをアイコンと文字に変換
+WEATHER_MAP = {
+    0: "☀️ 快晴", 1: "🌤 晴れ", 2: "⛅ 曇り", 3: "☁️ 曇天",
+    45: "🌫 霧", 51: "🌦 小雨", 61: "☔ 雨", 63: "🌧 激しい雨",
+    71: "❄️ 雪", 95: "⚡ 雷雨"
+}
+
+# users.Municipality.api_url の既定値（未設定とみなす）
+DUMMY_API_HOSTS = {"example.com"}
+
+
+def bodik_datastore_url():
+    return _setting("NOTICES_BODIK_DATASTORE_URL", "https://data.bodik.jp/api/3/action/datastore_search")
+
+
+def open_meteo_url():
+    return _setting("NOTICES_OPEN_METEO_URL", "https://api.open-meteo.com/v1/forecast")
+
+
+# -----------------------------
+# 取得元（自治体ごとの設定）
+# -----------------------------
+@dataclass(frozen=True)
+class Source:
+    # キャッシュキー・フィード名に使う（"amami" / "m<自治体ID>"）
+    key: str
+    name: str
+    datastore_url: str = ""
+    shelter_resource_id: str = ""
+    latitude: float = None
+    longitude: float = None
+
+    @classmethod
+    def from_municipality(cls, municipality):
+        datastore_url = ""
+        api_url = (municipality.api_url or "").rstrip("/")
+        if api_url and urlparse(api_url).hostname not in DUMMY_API_HOSTS:
+            datastore_url = f"{api_url}/api/3/action/datastore_search"
+        return cls(
+            key=f"m{municipality.pk}",
+            name=municipality.name,
+            datastore_url=datastore_url,
+            shelter_resource_id=municipality.shelter_resource_id,
+            latitude=municipality.latitude,
+            longitude=municipality.longitude,
+        )
+
+
+def default_source():
+    """自治体の設定がない利用者に表示する奄美市のデータ（従来の表示内容）"""
+    return Source(
+        key="amami",
+        name="奄美市（名瀬）",
+        datastore_url=bodik_datastore_url(),
+        shelter_resource_id=AMAMI_EVACUATION_RESOURCE_ID,
+        latitude=AMAMI_LATITUDE,
+        longitude=AMAMI_LONGITUDE,
+    )
+
+
+def municipality_sources():
+    from users.models import Municipality
+
+    return [Source.from_municipality(m) for m in Municipality.objects.order_by("pk")]
+
+
+# -----------------------------
+# アダプター
+# -----------------------------
+class Adapter:
+    """取得元1つ・データ1種類分の取得処理"""
+
+    kind = "base"
+    # 取得からこの秒数までは最新とみなす
+    max_age = 60 * 60
+    # DBに同期するアダプターの場合、最後に同期に成功した時刻（UNIX秒）を返すメソッドを定義する
+    synced_at = None
+
+    def __init__(self, source):
+        self.source = source
+
+    @classmethod
+    def supports(cls, source):
+        """この取得元で使えるか（必要な設定がそろっているか）"""
+        return False
+
+    def fetch(self):
+        raise NotImplementedError
+
+
+class CkanShelterAdapter(Adapter):
+    """CKAN DataStore の避難場所データを Shelter テーブルに同期する（戻り値は同期結果の件数）"""
+
+    kind = "shelters"
+    # 避難場所は頻繁に変わらないため24時間
+    max_age = 60 * 60 * 24
+
+    @classmethod
+    def supports(cls, source):
+        return bool(source.datastore_url and source.shelter_resource_id)
+
+    def fetch(self):
+        return sync_shelters(self.source.shelter_resource_id, self.source.datastore_url)
+
+    def synced_at(self):
+        return last_synced_at(self.source.shelter_resource_id)
+
+
+class OpenMeteoWeatherAdapter(Adapter):
+    """Open-Meteo から緯度・経度の地点の今日の天気を取得する"""
+
+    kind = "weather"
+    max_age = 60 * 60 * 3
+
+    @classmethod
+    def supports(cls, source):
+        return source.latitude is not None and source.longitude is not None
+
+    def fetch(self):
+        params = {
+            "latitude": self.source.latitude,
+            "longitude": self.source.longitude,
+            "daily": ["weather_code", "temperature_2m_max", "temperature_2m_min"],
+            "timezone": "Asia/Tokyo"
+        }
+        daily = http_client.get(open_meteo_url(), params=params).json()['daily']
+        return {
+            'status': WEATHER_MAP.get(daily['weather_code'][0], "☁️ 曇り"),
+            'max_temp': daily['temperature_2m_max'][0],
+            'min_temp': daily['temperature_2m_min'][0],
+        }
+
+
+DEFAULT_ADAPTERS = [
+    "notices.adapters.CkanShelterAdapter",
+    "notices.adapters.OpenMeteoWeatherAdapter",
+]
+
+
+def adapter_classes():
+    return [import_string(path) for path in _setting("NOTICES_ADAPTERS", DEFAULT_ADAPTERS)]
+
+
+def adapters_for(source):
+    """取得元で使えるアダプターの一覧"""
+    return [cls(source) for cls in adapter_classes() if cls.supports(source)]
@@ -4,7 +4,7 @@ from django.contrib import admin
 
 # notices/admin.py
 from django.contrib import admin
-from .models import News
+from .models import News, Shelter, ShelterSyncState
 
 @admin.register(News)
 class NewsAdmin(admin.ModelAdmin):
@@ -12,5 +12,14 @@ class NewsAdmin(admin.ModelAdmin):
     search_fields = ('title', 'content')
     list_filter = ('municipality',)
 
-# 他のモデルも同様に登録可能
+@admin.register(Shelter)
+class ShelterAdmin(admin.ModelAdmin):
+    list_display = ('name', 'address', 'disaster_types', 'resource_id', 'updated_at')
+    search_fields = ('name', 'address')
+    list_filter = ('resource_id',)
+
+@admin.register(ShelterSyncState)
+class ShelterSyncStateAdmin(admin.ModelAdmin):
+    list_display = ('resource_id', 'last_success_at', 'total', 'added', 'changed', 'removed', 'last_error')
 
+# 他のモデルも同様に登録可能
@@ -0,0 +1,226 @@
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from config.metrics import counter, histogram
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# 外部API（BODIK・Open-Meteo など）への共通HTTPクライアント
+# -----------------------------
+# requests.get を毎回呼ぶと、そのたびに TCP/TLS 接続を作り直し、失敗しても再試行しない。
+# ここでは全アダプター共通で、
+#   - 接続を使い回す Session（ホストごとのコネクションプール、keep-alive）
+#   - ホストごとのタイムアウト（接続・読み取り）
+#   - 一時的なエラー（接続エラー・タイムアウト・429/5xx）はジッター付きの指数バックオフで再試行
+#   - 失敗が続くホストはサーキットブレーカーで一定時間すぐに失敗させる
+#     （呼び出し元のフィードは最後に取得できたデータを表示し続ける: notices.utils）
+#   - 処理時間・結果の回数を config.metrics に記録する（/chatbot/metrics/ で公開）
+# を行う。
+
+# 再試行する HTTP ステータス
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class CircuitOpenError(requests.RequestException):
+    """サーキットが開いている（直近の失敗が続いている）ため、リクエストを送らなかった"""
+
+
+# -----------------------------
+# メトリクス
+# -----------------------------
+HTTP_SECONDS = histogram(
+    "notices_http_request_duration_seconds",
+    "Duration of outbound HTTP requests (each attempt) in seconds.",
+    ["host"],
+)
+HTTP_REQUESTS = counter(
+    "notices_http_requests",
+    "Outbound HTTP requests by final outcome (ok, error, short_circuit).",
+    ["host", "outcome"],
+)
+HTTP_RETRIES = counter(
+    "notices_http_retries",
+    "Outbound HTTP attempts that were retried.",
+    ["host"],
+)
+CIRCUIT_OPENED = counter(
+    "notices_http_circuit_opened",
+    "Times the circuit breaker opened for a host.",
+    ["host"],
+)
+
+
+# -----------------------------
+# サーキットブレーカー（ホストごと）
+# -----------------------------
+class CircuitBreaker:
+    """
+    連続 failure_threshold 回失敗したら開き（以降はすぐ CircuitOpenError）、
+    reset_timeout 秒後に1件だけ試す（半開）。成功すれば閉じ、失敗すれば再び開く。
+    """
+
+    def __init__(self, host, failure_threshold, reset_timeout):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def allow(self):
+        """リクエストを送ってよいか（半開の間は1件だけ通す）"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"Circuit closed for {self.host}")
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or (self._opened_at is None and self._failures >= self.failure_threshold):
+                if self._opened_at is None:
+                    logger.error(f"Circuit opened for {self.host} after {self._failures} consecutive failures")
+                    CIRCUIT_OPENED.inc(host=self.host)
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(host):
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(
+                host,
+                failure_threshold=_setting("NOTICES_HTTP_CIRCUIT_FAILURES", 5),
+                reset_timeout=_setting("NOTICES_HTTP_CIRCUIT_RESET", 60),
+            )
+        return breaker
+
+
+def circuit_states():
+    """{ホスト: "closed" / "open" / "half_open"}"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.host: breaker.state for breaker in breakers}
+
+
+# -----------------------------
+# Session（コネクションプール）
+# -----------------------------
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """プロセス内で共有する Session（再試行はこのモジュールで行うので、urllib3 の再試行は使わない）"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = _setting("NOTICES_HTTP_POOL_SIZE", 10)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers["User-Agent"] = _setting("NOTICES_HTTP_USER_AGENT", "bousai-notices/1.0")
+                _session = session
+    return _session
+
+
+def timeout_for(host):
+    """(接続, 読み取り) のタイムアウト秒（NOTICES_HTTP_TIMEOUTS にないホストは NOTICES_FETCH_TIMEOUT）"""
+    timeout = _setting("NOTICES_HTTP_TIMEOUTS", {}).get(host)
+    if timeout is None:
+        timeout = _setting("NOTICES_FETCH_TIMEOUT", 10)
+    return timeout
+
+
+def _backoff(attempt, response=None):
+    """attempt 回目の失敗後の待ち時間（full jitter。429/503 の Retry-After 秒があればそれ以上待つ）"""
+    cap = _setting("NOTICES_HTTP_BACKOFF_MAX", 5)
+    delay = random.uniform(0, min(cap, _setting("NOTICES_HTTP_BACKOFF", 0.5) * 2 ** attempt))
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, min(cap, int(retry_after)))
+    return delay
+
+
+def get(url, params=None, timeout=None):
+    """
+    GET リクエストを送り、成功（2xx）したレスポンスを返す
+    - 一時的なエラーは NOTICES_HTTP_RETRIES 回まで再試行する
+    - 失敗した場合は requests の例外（HTTPError など）、サーキットが開いていれば CircuitOpenError を送出する
+    """
+    host = urlparse(url).hostname or ""
+    breaker = breaker_for(host)
+    if not breaker.allow():
+        HTTP_REQUESTS.inc(host=host, outcome="short_circuit")
+        raise CircuitOpenError(f"Circuit open for {host}; skipping request")
+
+    session = get_session()
+    timeout = timeout or timeout_for(host)
+    retries = _setting("NOTICES_HTTP_RETRIES", 2)
+    attempt = 0
+    while True:
+        response = None
+        started = time.perf_counter()
+        try:
+            response = session.get(url, params=params, timeout=timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            HTTP_SECONDS.observe(time.perf_counter() - started, host=host)
+            if isinstance(e, requests.HTTPError) and response.status_code not in RETRY_STATUSES:
+                # 4xx（429 以外）はリクエスト側の問題なので、再試行もサーキットの失敗にも数えない
+                HTTP_REQUESTS.inc(host=host, outcome="error")
+                breaker.record_success()
+                raise
+            if attempt >= retries:
+                HTTP_REQUESTS.inc(host=host, outcome="error")
+                breaker.record_failure()
+                raise
+            HTTP_RETRIES.inc(host=host)
+            time.sleep(_backoff(attempt, response))
+            attempt += 1
+            continue
+
+        HTTP_SECONDS.observe(time.perf_counter() - started, host=host)
+        HTTP_REQUESTS.inc(host=host, outcome="ok")
+        breaker.record_success()
+        return response
@@ -0,0 +1,141 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from django.core.management.base import BaseCommand
+
+from notices.spatial import DISASTER_TYPES
+
+# -----------------------------
+# 外部API（BODIK / Open-Meteo）のスタブサーバー
+# -----------------------------
+# 使い方（例）:
+#   python manage.py notices_stub_server --port 8765 --records 250 --delay 0.2
+#   NOTICES_BODIK_DATASTORE_URL=http://127.0.0.1:8765/api/3/action/datastore_search \
+#   NOTICES_OPEN_METEO_URL=http://127.0.0.1:8765/v1/forecast python manage.py runserver
+# 実物と同じ形式の JSON を返す。--fail-rate で一定の割合を 503 にして、障害時の表示（古いデータ）を確認できる。
+# 実行中に GET /fail または /recover を送ると、全リクエストの失敗・復旧を切り替えられる。
+
+
+def build_shelters(count, seed=0, center=(28.37, 129.49)):
+    """奄美市周辺に散らばった、BODIK の指定緊急避難場所と同じ項目のレコードを作る"""
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        records.append({
+            "_id": i + 1,
+            "名称": f"テスト避難場所{i + 1:04d}",
+            "所在地": f"鹿児島県奄美市名瀬テスト町{i % 50 + 1}-{i + 1}",
+            "緯度": round(center[0] + rng.uniform(-0.25, 0.25), 6),
+            "経度": round(center[1] + rng.uniform(-0.25, 0.25), 6),
+            "災害種別": ",".join(sorted(rng.sample(DISASTER_TYPES, rng.randint(1, 4)), key=DISASTER_TYPES.index)),
+        })
+    return records
+
+
+class StubState:
+    def __init__(self, records, delay, fail_rate):
+        self.records = records
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.failing = False
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            with state.lock:
+                state.requests += 1
+
+            if url.path == "/fail":
+                state.failing = True
+                return self._send_json(200, {"failing": True})
+            if url.path == "/recover":
+                state.failing = False
+                return self._send_json(200, {"failing": False})
+
+            if state.delay:
+                time.sleep(state.delay)
+            if state.failing or random.random() < state.fail_rate:
+                return self._send_json(503, {"error": "stub failure"})
+
+            if url.path.endswith("/api/3/action/datastore_search"):
+                return self._datastore_search(query)
+            if url.path.endswith("/v1/forecast"):
+                return self._forecast(query)
+            return self._send_json(404, {"error": "not found"})
+
+        def _datastore_search(self, query):
+            limit = int(query.get("limit", ["100"])[0])
+            offset = int(query.get("offset", ["0"])[0])
+            records = state.records[offset:offset + limit]
+            return self._send_json(200, {
+                "success": True,
+                "result": {
+                    "resource_id": query.get("resource_id", [""])[0],
+                    "records": records,
+                    "total": len(state.records),
+                    "limit": limit,
+                    "offset": offset,
+                    "_links": {"start": self.path, "next": f"{urlparse(self.path).path}?offset={offset + limit}"},
+                },
+            })
+
+        def _forecast(self, query):
+            return self._send_json(200, {
+                "latitude": float(query.get("latitude", ["0"])[0]),
+                "longitude": float(query.get("longitude", ["0"])[0]),
+                "daily": {
+                    "time": [time.strftime("%Y-%m-%d")],
+                    "weather_code": [random.choice([0, 1, 2, 3, 61])],
+                    "temperature_2m_max": [round(random.uniform(20, 30), 1)],
+                    "temperature_2m_min": [round(random.uniform(12, 20), 1)],
+                },
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class Command(BaseCommand):
+    help = "BODIK / Open-Meteo の代わりに使うローカルのスタブサーバーを起動する（開発・テスト用）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--records", type=int, default=250, help="返す避難場所の件数")
+        parser.add_argument("--seed", type=int, default=0, help="避難場所データの乱数シード")
+        parser.add_argument("--delay", type=float, default=0.0, help="応答までの待ち時間（秒）")
+        parser.add_argument("--fail-rate", type=float, default=0.0, help="503 を返す割合（0〜1）")
+
+    def handle(self, *args, **options):
+        state = StubState(build_shelters(options["records"], options["seed"]), options["delay"], options["fail_rate"])
+        server = ThreadingHTTPServer((options["host"], options["port"]), make_handler(state))
+        base = f"http://{options['host']}:{options['port']}"
+        self.stdout.write(f"Stub server listening on {base}")
+        self.stdout.write(f"  NOTICES_BODIK_DATASTORE_URL={base}/api/3/action/datastore_search")
+        self.stdout.write(f"  NOTICES_OPEN_METEO_URL={base}/v1/forecast")
+        self.stdout.write(f"  GET {base}/fail で障害状態、{base}/recover で復旧。Ctrl+C で停止します。")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write(f"Stopping stub server ({state.requests} requests served)...")
+        finally:
+            server.server_close()
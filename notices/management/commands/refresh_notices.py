@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from notices.utils import all_feeds, create_scheduler, get_feed, start_scheduler
+
+
+class Command(BaseCommand):
+    help = "避難所・天気などの外部データを更新する（--once なしの場合は定期更新を続ける）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="全フィードを1回だけ強制的に（同時に）更新して終了する")
+        parser.add_argument("--feed", action="append", help="--once で更新するフィード（例: amami:weather, m1:shelters）。省略時はすべて")
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            feeds = all_feeds()
+            names = options["feed"] or list(feeds)
+            unknown = [name for name in names if name not in feeds]
+            if unknown:
+                raise CommandError(f"Unknown feeds: {', '.join(unknown)} (available: {', '.join(feeds)})")
+
+            scheduler = create_scheduler()
+            started = time.perf_counter()
+            results = scheduler.run_once(force=True, names=names)
+            elapsed = time.perf_counter() - started
+            for name in names:
+                feed = get_feed(feeds[name])
+                status = "refreshed" if results.get(name) else f"failed ({feed['error'] or 'locked'})"
+                self.stdout.write(f"{name}: {status}, fetched_at={feed['fetched_at']}, fresh={feed['fresh']}")
+            self.stdout.write(f"{len(names)} feeds in {elapsed:.2f}s ({scheduler.workers} workers)")
+            scheduler.stop()
+            return
+
+        scheduler = start_scheduler()
+        self.stdout.write(
+            f"Feed scheduler started (tick {scheduler.tick}s, {scheduler.workers} workers). Ctrl+C で停止します。"
+        )
+        try:
+            scheduler.join()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping feed scheduler...")
+            scheduler.stop(timeout=10)
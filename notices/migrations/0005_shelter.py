@@ -0,0 +1,50 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notices', '0004_municipality_alter_post_options_alter_post_title_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShelterSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_id', models.CharField(max_length=64, unique=True)),
+                ('last_attempt_at', models.DateTimeField(blank=True, null=True)),
+                ('last_success_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('total', models.IntegerField(default=0)),
+                ('added', models.IntegerField(default=0)),
+                ('changed', models.IntegerField(default=0)),
+                ('removed', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Shelter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_id', models.CharField(max_length=64)),
+                ('record_id', models.IntegerField()),
+                ('name', models.CharField(max_length=200)),
+                ('address', models.CharField(blank=True, max_length=300)),
+                ('latitude', models.FloatField(blank=True, null=True)),
+                ('longitude', models.FloatField(blank=True, null=True)),
+                ('disaster_types', models.CharField(blank=True, max_length=300)),
+                ('raw', models.JSONField(default=dict)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': '避難場所',
+                'verbose_name_plural': '避難場所',
+                'ordering': ['resource_id', 'record_id'],
+                'constraints': [models.UniqueConstraint(fields=('resource_id', 'record_id'), name='unique_shelter_record')],
+            },
+        ),
+    ]
@@ -80,4 +80,64 @@ class Post(models.Model):
         ordering = ['-created_at']
 
     def __str__(self):
-        return self.title
\ No newline at end of file
+        return self.title
+
+# ------------------------
+# 避難場所（外部データの同期先）
+# ------------------------
+class Shelter(models.Model):
+    """BODIK（CKAN DataStore）の指定緊急避難場所レコード。sync_shelters で同期する"""
+    resource_id = models.CharField(max_length=64)
+    # 取得元レコードの _id
+    record_id = models.IntegerField()
+    name = models.CharField(max_length=200)
+    address = models.CharField(max_length=300, blank=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    # 対象災害（カンマ区切り。空なら全災害）
+    disaster_types = models.CharField(max_length=300, blank=True)
+    raw = models.JSONField(default=dict)
+    # raw のハッシュ（変更のあったレコードだけ更新するため）
+    content_hash = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['resource_id', 'record_id']
+        constraints = [
+            models.UniqueConstraint(fields=['resource_id', 'record_id'], name='unique_shelter_record'),
+        ]
+        verbose_name = "避難場所"
+        verbose_name_plural = "避難場所"
+
+    def __str__(self):
+        return self.name
+
+    def as_notice(self, source_name):
+        """お知らせ画面のカード形式（source_name: 取得元の自治体名）"""
+        lat, lng = self.latitude, self.longitude
+        # Googleマップへのリンクを生成
+        map_url = f"https://www.google.com/maps/search/?api=1&query={lat},{lng}" if lat and lng else "#"
+        return {
+            'title': f"🚨 {self.name}",
+            'content': f"【所在地】{self.address or '住所情報なし'}\n【対象災害】{self.disaster_types or '全災害'}",
+            'url': map_url,
+            'created_at': '緊急避難場所',
+            'prefecture': f'{source_name}(防災)',
+            'is_emergency': True
+        }
+
+
+class ShelterSyncState(models.Model):
+    """リソースごとの最終同期の記録"""
+    resource_id = models.CharField(max_length=64, unique=True)
+    last_attempt_at = models.DateTimeField(null=True, blank=True)
+    last_success_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    total = models.IntegerField(default=0)
+    added = models.IntegerField(default=0)
+    changed = models.IntegerField(default=0)
+    removed = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.resource_id} ({self.last_success_at})"
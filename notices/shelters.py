@@ -0,0 +1,157 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import http_client
+from .models import Shelter, ShelterSyncState
+from .spatial import rebuild_index
+
+# -----------------------------
+# 避難場所データの同期（BODIK などの CKAN DataStore → Shelter テーブル）
+# -----------------------------
+# - datastore_search を offset でページ送りし、リソースの全レコードを取得する（1ページに収まる分だけではない）
+# - 取得元の _id をキーに、前回の内容と比べて 追加 / 変更 / 削除 を求め、差分の行だけを書き込む
+# - 全ページを取得できた場合のみ反映する（途中で失敗したら何も変更しない）
+# 画面・APIは外部APIではなく Shelter テーブル（と、それから作る notices.spatial のインデックス）を読む。
+
+# 内容の比較に使わない項目（検索用に DataStore が付ける項目）
+IGNORED_FIELDS = {"_id", "_full_text", "rank"}
+SHELTER_FIELDS = ["name", "address", "latitude", "longitude", "disaster_types", "raw", "content_hash", "updated_at"]
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def record_hash(record):
+    data = {k: v for k, v in record.items() if k not in IGNORED_FIELDS}
+    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def fetch_all_records(datastore_url, resource_id, page_size=None):
+    """CKAN DataStore（datastore_url）からリソースの全レコードを、page_size 件ずつページ送りして取得する"""
+    page_size = page_size or _setting("NOTICES_BODIK_PAGE_SIZE", 500)
+    records, offset, total = [], 0, None
+    while True:
+        params = {"resource_id": resource_id, "limit": page_size, "offset": offset, "sort": "_id"}
+        result = http_client.get(datastore_url, params=params).json()
+        if not result.get("success"):
+            raise ValueError(f"BODIK datastore_search failed: {result.get('error')}")
+
+        page = result["result"]["records"]
+        total = result["result"].get("total", total)
+        records.extend(page)
+        offset += len(page)
+        if not page or len(page) < page_size or (total is not None and offset >= total):
+            break
+
+    # 取得中にレコードが増減した場合は、ずれたページが混ざっている可能性があるので反映しない
+    if total is not None and len(records) != total:
+        raise ValueError(f"Record count changed during pagination ({len(records)} fetched, total {total})")
+    return records
+
+
+def _build_shelter(resource_id, record, content_hash):
+    return Shelter(
+        resource_id=resource_id,
+        record_id=int(record["_id"]),
+        name=record.get("名称") or "名称不明",
+        address=record.get("所在地") or "",
+        latitude=_float(record.get("緯度")),
+        longitude=_float(record.get("経度")),
+        disaster_types=record.get("災害種別") or "",
+        raw={k: v for k, v in record.items() if k not in IGNORED_FIELDS},
+        content_hash=content_hash,
+    )
+
+
+def sync_shelters(resource_id, datastore_url, page_size=None):
+    """
+    リソースの全レコードを取得し、Shelter テーブルに差分だけを反映する
+    戻り値: {"total", "added", "changed", "removed", "unchanged"}
+    """
+    state, _ = ShelterSyncState.objects.get_or_create(resource_id=resource_id)
+    state.last_attempt_at = timezone.now()
+    started = time.perf_counter()
+
+    try:
+        incoming = {int(r["_id"]): r for r in fetch_all_records(datastore_url, resource_id, page_size)}
+        existing = {
+            record_id: (pk, content_hash)
+            for pk, record_id, content_hash in Shelter.objects.filter(resource_id=resource_id)
+            .values_list("pk", "record_id", "content_hash")
+        }
+        # 一時的な不具合で空が返ってきた場合に、全件削除しない
+        if not incoming and existing:
+            raise ValueError("Upstream returned no records")
+    except Exception as e:
+        state.last_error = str(e)
+        state.save(update_fields=["last_attempt_at", "last_error"])
+        raise
+
+    now = timezone.now()
+    added, changed = [], []
+    for record_id, record in incoming.items():
+        content_hash = record_hash(record)
+        current = existing.get(record_id)
+        if current is None:
+            added.append(_build_shelter(resource_id, record, content_hash))
+        elif current[1] != content_hash:
+            shelter = _build_shelter(resource_id, record, content_hash)
+            shelter.pk = current[0]
+            # bulk_update では auto_now が効かないため明示的に設定する
+            shelter.updated_at = now
+            changed.append(shelter)
+    removed = [pk for record_id, (pk, _) in existing.items() if record_id not in incoming]
+
+    with transaction.atomic():
+        Shelter.objects.bulk_create(added, batch_size=500)
+        Shelter.objects.bulk_update(changed, SHELTER_FIELDS, batch_size=500)
+        Shelter.objects.filter(pk__in=removed).delete()
+
+        state.last_success_at = now
+        state.last_error = ""
+        state.total = len(incoming)
+        state.added = len(added)
+        state.changed = len(changed)
+        state.removed = len(removed)
+        state.save()
+
+    # 行が変わった場合は、最寄り検索・GeoJSON のインデックスを作り直す
+    if added or changed or removed:
+        rebuild_index(resource_id)
+
+    summary = {
+        "total": len(incoming),
+        "added": len(added),
+        "changed": len(changed),
+        "removed": len(removed),
+        "unchanged": len(incoming) - len(added) - len(changed),
+    }
+    print(
+        f"[INFO] Synced shelters {resource_id}: {summary['total']} records, {summary['added']} added, "
+        f"{summary['changed']} changed, {summary['removed']} removed in {time.perf_counter() - started:.2f}s"
+    )
+    return summary
+
+
+def last_synced_at(resource_id):
+    """最後に同期に成功した時刻（UNIX秒。未同期なら None）"""
+    success = ShelterSyncState.objects.filter(resource_id=resource_id).values_list("last_success_at", flat=True).first()
+    return success.timestamp() if success else None
+
+
+def shelter_notices(source):
+    """お知らせ画面に表示する取得元（notices.adapters.Source）の避難場所カード"""
+    return [shelter.as_notice(source.name) for shelter in Shelter.objects.filter(resource_id=source.shelter_resource_id)]
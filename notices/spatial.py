@@ -0,0 +1,250 @@
+import gzip
+import hashlib
+import heapq
+import json
+import math
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.core.cache import cache
+
+from config.metrics import histogram
+
+from .models import Shelter
+
+# -----------------------------
+# 避難場所の空間インデックス（最寄りの避難場所の検索・地図用 GeoJSON）
+# -----------------------------
+# 取得元（resource_id）ごとに、Shelter テーブルの座標をメモリ上の k-d tree に載せる。
+#   - 緯度・経度は単位球面上の3次元ベクトルにして持つ（ベクトル間の直線距離は球面上の距離と大小関係が同じなので、
+#     経度方向の縮みや日付変更線を気にせずに最近傍を求められる）
+#   - 対象災害はビットマスクにして、検索中に条件に合わない避難場所を読み飛ばす
+#   - 地図用の GeoJSON（gzip 圧縮済み）も同時に作っておき、リクエストごとには作らない
+# 同期（notices.shelters.sync_shelters）で行が変わったら、そのプロセスでは作り直し、
+# キャッシュ上のバージョンを更新する（他のプロセスは次に参照したときに作り直す）。
+# ※ 複数プロセス間でバージョンを共有するには、CACHES に Redis などの共有キャッシュを設定する
+
+# 指定緊急避難場所の対象災害（災害対策基本法施行令の区分）
+DISASTER_TYPES = ["洪水", "土砂災害", "高潮", "地震", "津波", "大規模な火事", "内水氾濫", "火山現象"]
+
+EARTH_RADIUS_M = 6371008.8
+# 葉ノードに入れる点の数（小さすぎると木が深くなり、大きすぎると葉の総当たりが増える）
+LEAF_SIZE = 8
+
+NEAREST_SECONDS = histogram(
+    "notices_shelter_nearest_duration_seconds",
+    "Duration of nearest-shelter index queries in seconds.",
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01),
+)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def unit_vector(latitude, longitude):
+    lat, lng = math.radians(latitude), math.radians(longitude)
+    return (math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat))
+
+
+def chord_to_meters(squared_chord):
+    """単位ベクトル間の直線距離の2乗 → 地表での距離（m）"""
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(squared_chord) / 2))
+
+
+def split_disaster_types(value):
+    return [t for t in re.split(r"[,、，\s]+", value or "") if t]
+
+
+# -----------------------------
+# k-d tree
+# -----------------------------
+class KDTree:
+    """
+    3次元の点の k-d tree
+    ノードは (分割軸, 分割値, 左, 右, 葉の点の番号リスト) のタプル（葉は分割軸 -1）
+    """
+
+    def __init__(self, points):
+        self.points = points
+        self._root = self._build(list(range(len(points))))
+
+    def _build(self, indices):
+        if len(indices) <= LEAF_SIZE:
+            return (-1, 0.0, None, None, indices)
+        points = self.points
+        # 点の広がりが最も大きい軸で半分に分ける
+        axis = max(range(3), key=lambda a: max(points[i][a] for i in indices) - min(points[i][a] for i in indices))
+        indices.sort(key=lambda i: points[i][axis])
+        mid = len(indices) // 2
+        return (axis, points[indices[mid]][axis], self._build(indices[:mid]), self._build(indices[mid:]), None)
+
+    def nearest(self, target, k, accept=None):
+        """
+        target に近い順に k 個の (直線距離の2乗, 点の番号) を返す
+        accept を指定した場合は、accept(点の番号) が真の点だけを対象にする
+        """
+        if k <= 0:
+            return []
+        points = self.points
+        tx, ty, tz = target
+        heap = []  # (-距離の2乗, 点の番号) の最大ヒープ（今までに見つけた近い k 個）
+
+        def visit(node):
+            axis, split, left, right, leaf = node
+            if axis < 0:
+                for i in leaf:
+                    if accept is not None and not accept(i):
+                        continue
+                    x, y, z = points[i]
+                    d = (x - tx) ** 2 + (y - ty) ** 2 + (z - tz) ** 2
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-d, i))
+                    elif d < -heap[0][0]:
+                        heapq.heapreplace(heap, (-d, i))
+                return
+            diff = target[axis] - split
+            near, far = (left, right) if diff < 0 else (right, left)
+            visit(near)
+            # 分割面までの距離が今の k 番目より近い場合だけ、反対側も調べる
+            if len(heap) < k or diff * diff < -heap[0][0]:
+                visit(far)
+
+        visit(self._root)
+        return sorted((-d, i) for d, i in heap)
+
+
+# -----------------------------
+# 避難場所のインデックス
+# -----------------------------
+@dataclass
+class ShelterIndex:
+    resource_id: str
+    # 作成時のキャッシュ上のバージョン（変わっていたら作り直す）
+    version: object
+    shelters: list
+    tree: KDTree
+    # 避難場所ごとの対象災害のビットマスク（対象災害が空 = 全災害は -1）
+    masks: list
+    type_bits: dict
+    geojson: bytes
+    geojson_gzip: bytes
+    etag: str
+    built_at: float = field(default_factory=time.time)
+
+    def __len__(self):
+        return len(self.shelters)
+
+    @property
+    def gzip_etag(self):
+        """gzip 圧縮した GeoJSON の ETag（圧縮前と同じ値にすると、キャッシュが表現を取り違える）"""
+        return self.etag[:-1] + '-gzip"'
+
+    def _accepts(self, disaster_type):
+        """disaster_type の対象となる避難場所か（点の番号 → bool）を返す関数"""
+        # どの避難場所にもない災害の場合は、全災害対象の避難場所だけが一致するビットにする
+        want = self.type_bits.get(disaster_type, 1 << len(self.type_bits))
+        masks = self.masks
+        return lambda i: masks[i] & want
+
+    def nearest(self, latitude, longitude, k=5, disaster_type=None):
+        """
+        (latitude, longitude) に近い順に k 件（最大 NOTICES_SHELTER_NEAREST_MAX 件）
+        disaster_type を指定した場合は、その災害の対象となる避難場所（と全災害対象の避難場所）だけ
+        """
+        started = time.perf_counter()
+        k = max(1, min(k, _setting("NOTICES_SHELTER_NEAREST_MAX", 50)))
+        accept = self._accepts(disaster_type) if disaster_type else None
+        found = self.tree.nearest(unit_vector(latitude, longitude), k, accept)
+        NEAREST_SECONDS.observe(time.perf_counter() - started)
+        return [{**self.shelters[i], "distance_m": round(chord_to_meters(d))} for d, i in found]
+
+
+def version_key(resource_id):
+    return f"notices_shelter_index:{resource_id}:version"
+
+
+def build_index(resource_id, version=None):
+    """Shelter テーブルから取得元のインデックスを作る（座標のない避難場所は含めない）"""
+    started = time.perf_counter()
+    rows = (
+        Shelter.objects.filter(resource_id=resource_id, latitude__isnull=False, longitude__isnull=False)
+        .order_by("record_id")
+        .values_list("record_id", "name", "address", "latitude", "longitude", "disaster_types")
+    ) if resource_id else []
+
+    shelters, points, masks, features = [], [], [], []
+    type_bits = {t: 1 << i for i, t in enumerate(DISASTER_TYPES)}
+    for record_id, name, address, latitude, longitude, disaster_types in rows:
+        types = split_disaster_types(disaster_types)
+        mask = -1 if not types else 0
+        for t in types:
+            if t not in type_bits:
+                type_bits[t] = 1 << len(type_bits)
+            mask |= type_bits[t]
+        shelters.append({
+            "id": record_id,
+            "name": name,
+            "address": address,
+            "latitude": latitude,
+            "longitude": longitude,
+            "disaster_types": types,
+        })
+        points.append(unit_vector(latitude, longitude))
+        masks.append(mask)
+        features.append({
+            "type": "Feature",
+            "id": record_id,
+            "geometry": {"type": "Point", "coordinates": [round(longitude, 6), round(latitude, 6)]},
+            "properties": {"name": name, "address": address, "disaster_types": types},
+        })
+
+    geojson = json.dumps(
+        {"type": "FeatureCollection", "features": features}, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+    index = ShelterIndex(
+        resource_id=resource_id,
+        version=version,
+        shelters=shelters,
+        tree=KDTree(points),
+        masks=masks,
+        type_bits=type_bits,
+        geojson=geojson,
+        # mtime=0: 内容が同じなら同じバイト列になる
+        geojson_gzip=gzip.compress(geojson, compresslevel=9, mtime=0),
+        etag='"' + hashlib.sha256(geojson).hexdigest()[:32] + '"',
+    )
+    if resource_id:
+        print(
+            f"[INFO] Built shelter index {resource_id}: {len(shelters)} shelters in "
+            f"{(time.perf_counter() - started) * 1000:.1f}ms (GeoJSON {len(geojson)} bytes, gzip {len(index.geojson_gzip)} bytes)"
+        )
+    return index
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(resource_id):
+    """取得元のインデックス（未作成・キャッシュ上のバージョンが変わっていれば作り直す）"""
+    version = cache.get(version_key(resource_id))
+    index = _indexes.get(resource_id)
+    if index is not None and index.version == version:
+        return index
+    with _indexes_lock:
+        index = _indexes.get(resource_id)
+        if index is None or index.version != version:
+            index = _indexes[resource_id] = build_index(resource_id, version)
+        return index
+
+
+def rebuild_index(resource_id):
+    """同期で行が変わった後に呼ぶ（このプロセスのインデックスを作り直し、他のプロセスにも作り直させる）"""
+    version = time.time()
+    cache.set(version_key(resource_id), version, None)
+    with _indexes_lock:
+        _indexes[resource_id] = build_index(resource_id, version)
@@ -1,3 +1,258 @@
-from django.test import TestCase
+import gzip
+import math
+import random
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from users.models import CustomUser
+
+from . import spatial
+from .adapters import default_source
+from .models import Shelter, ShelterSyncState
+from .shelters import sync_shelters
+from .spatial import KDTree, build_index, chord_to_meters, get_index, unit_vector
+
+RESOURCE_ID = "test-resource"
+DATASTORE_URL = "https://data.example.jp/api/3/action/datastore_search"
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371008.8 * math.asin(math.sqrt(a))
+
+
+# -----------------------------
+# k-d tree（最寄りの避難場所）
+# -----------------------------
+class KDTreeTests(TestCase):
+    def setUp(self):
+        self.random = random.Random(42)
+        # 奄美大島周辺 + 日付変更線・極付近の点
+        self.coords = [
+            (self.random.uniform(28.0, 28.6), self.random.uniform(129.1, 129.8)) for _ in range(500)
+        ] + [(0.0, 179.99), (0.0, -179.99), (89.9, 10.0), (89.9, -170.0)]
+        self.points = [unit_vector(lat, lng) for lat, lng in self.coords]
+        self.tree = KDTree(self.points)
+
+    def brute_force(self, target, k, accept=None):
+        distances = sorted(
+            (sum((a - b) ** 2 for a, b in zip(point, target)), i)
+            for i, point in enumerate(self.points)
+            if accept is None or accept(i)
+        )
+        return distances[:k]
+
+    def assert_same_neighbours(self, found, expected):
+        self.assertEqual([i for _, i in found], [i for _, i in expected])
+        for (d1, _), (d2, _) in zip(found, expected):
+            self.assertAlmostEqual(d1, d2)
+
+    def test_nearest_matches_brute_force(self):
+        for _ in range(200):
+            target = unit_vector(self.random.uniform(27.9, 28.7), self.random.uniform(129.0, 129.9))
+            k = self.random.randint(1, 10)
+            self.assert_same_neighbours(self.tree.nearest(target, k), self.brute_force(target, k))
+
+    def test_nearest_with_filter_matches_brute_force(self):
+        def accept(i):
+            return i % 7 == 0
+
+        for _ in range(100):
+            target = unit_vector(self.random.uniform(27.9, 28.7), self.random.uniform(129.0, 129.9))
+            self.assert_same_neighbours(self.tree.nearest(target, 5, accept), self.brute_force(target, 5, accept))
+
+    def test_nearest_across_date_line(self):
+        target = unit_vector(0.0, 180.0)
+        found = [i for _, i in self.tree.nearest(target, 2)]
+        self.assertEqual(sorted(found), [500, 501])
+
+    def test_k_larger_than_points_returns_all(self):
+        tree = KDTree(self.points[:3])
+        self.assertEqual(len(tree.nearest(self.points[0], 10)), 3)
+        self.assertEqual(tree.nearest(self.points[0], 0), [])
+
+    def test_chord_distance_matches_haversine(self):
+        (lat1, lng1), (lat2, lng2) = self.coords[0], self.coords[1]
+        squared_chord = sum((a - b) ** 2 for a, b in zip(unit_vector(lat1, lng1), unit_vector(lat2, lng2)))
+        self.assertAlmostEqual(chord_to_meters(squared_chord), haversine_m(lat1, lng1, lat2, lng2), delta=0.01)
+
+
+class ShelterIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        spatial._indexes.clear()
+        rows = [
+            (1, "名瀬小学校", 28.3770, 129.4930, "洪水,地震"),
+            (2, "奄美市役所", 28.3774, 129.4939, "津波"),
+            (3, "奄美パーク", 28.4300, 129.6700, ""),
+            (4, "座標なし", None, None, "地震"),
+        ]
+        for record_id, name, lat, lng, types in rows:
+            Shelter.objects.create(
+                resource_id=RESOURCE_ID, record_id=record_id, name=name, latitude=lat, longitude=lng,
+                disaster_types=types, content_hash=str(record_id),
+            )
+
+    def test_nearest_orders_by_distance_and_skips_missing_coordinates(self):
+        index = build_index(RESOURCE_ID)
+        results = index.nearest(28.3772, 129.4935, k=10)
+
+        self.assertEqual([r["id"] for r in results], [2, 1, 3])
+        for result in results:
+            expected = haversine_m(28.3772, 129.4935, result["latitude"], result["longitude"])
+            self.assertAlmostEqual(result["distance_m"], expected, delta=1)
+
+    def test_disaster_type_filter_includes_all_hazard_shelters(self):
+        index = build_index(RESOURCE_ID)
+
+        self.assertEqual([r["id"] for r in index.nearest(28.3772, 129.4935, k=10, disaster_type="地震")], [1, 3])
+        # どの避難場所にもない災害: 全災害対象（対象災害が空）の避難場所だけ
+        self.assertEqual([r["id"] for r in index.nearest(28.3772, 129.4935, k=10, disaster_type="火山現象")], [3])
+
+    def test_geojson_contains_located_shelters(self):
+        import json
+
+        index = build_index(RESOURCE_ID)
+        geojson = json.loads(index.geojson)
+
+        self.assertEqual([f["id"] for f in geojson["features"]], [1, 2, 3])
+        self.assertEqual(geojson["features"][0]["geometry"]["coordinates"], [129.493, 28.377])
+        self.assertEqual(gzip.decompress(index.geojson_gzip), index.geojson)
+
+    def test_index_is_rebuilt_when_version_changes(self):
+        index = get_index(RESOURCE_ID)
+        self.assertIs(get_index(RESOURCE_ID), index)
+
+        Shelter.objects.filter(record_id=3).delete()
+        cache.set(f"notices_shelter_index:{RESOURCE_ID}:version", "changed")
+        rebuilt = get_index(RESOURCE_ID)
+
+        self.assertIsNot(rebuilt, index)
+        self.assertEqual(len(rebuilt), 2)
+
+
+@override_settings(NOTICES_REFRESH_AUTOSTART=False)
+class ShelterGeoJSONViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        spatial._indexes.clear()
+        Shelter.objects.create(
+            resource_id=default_source().shelter_resource_id, record_id=1, name="名瀬小学校",
+            latitude=28.3770, longitude=129.4930, content_hash="1",
+        )
+        self.client.force_login(CustomUser.objects.create_user("resident", password="pw"))
+        self.url = reverse("notices:api_shelters_geojson")
+
+    def test_gzip_and_identity_have_distinct_etags(self):
+        plain = self.client.get(self.url)
+        gzipped = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip, br")
+
+        self.assertNotIn("Content-Encoding", plain)
+        self.assertEqual(gzipped["Content-Encoding"], "gzip")
+        self.assertNotEqual(plain["ETag"], gzipped["ETag"])
+        self.assertIn("Accept-Encoding", gzipped["Vary"])
+        self.assertEqual(gzip.decompress(gzipped.content), plain.content)
+
+    def test_if_none_match_only_matches_same_representation(self):
+        plain_etag = self.client.get(self.url)["ETag"]
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=plain_etag).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=f"W/{plain_etag}").status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=plain_etag, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response.status_code, 200)
+
+
+# -----------------------------
+# 避難場所の同期（差分の反映）
+# -----------------------------
+def record(record_id, name, lat=28.38, lng=129.49, types="地震"):
+    return {"_id": record_id, "名称": name, "所在地": f"{name}の住所", "緯度": lat, "経度": lng, "災害種別": types}
+
+
+class SyncSheltersTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        spatial._indexes.clear()
+
+    def sync(self, records):
+        with mock.patch("notices.shelters.fetch_all_records", return_value=records):
+            return sync_shelters(RESOURCE_ID, DATASTORE_URL)
+
+    def names(self):
+        return dict(Shelter.objects.filter(resource_id=RESOURCE_ID).values_list("record_id", "name"))
+
+    def test_first_sync_adds_all_records(self):
+        summary = self.sync([record(1, "A"), record(2, "B"), record(3, "C")])
+
+        self.assertEqual(summary, {"total": 3, "added": 3, "changed": 0, "removed": 0, "unchanged": 0})
+        self.assertEqual(self.names(), {1: "A", 2: "B", 3: "C"})
+        state = ShelterSyncState.objects.get(resource_id=RESOURCE_ID)
+        self.assertIsNotNone(state.last_success_at)
+        self.assertEqual((state.total, state.added), (3, 3))
+
+    def test_second_sync_applies_only_the_diff(self):
+        self.sync([record(1, "A"), record(2, "B"), record(3, "C")])
+        untouched = Shelter.objects.get(record_id=1)
+
+        summary = self.sync([
+            record(1, "A"),
+            record(2, "B（移転）", lat=28.40),
+            record(4, "D"),
+        ])
+
+        self.assertEqual(summary, {"total": 3, "added": 1, "changed": 1, "removed": 1, "unchanged": 1})
+        self.assertEqual(self.names(), {1: "A", 2: "B（移転）", 4: "D"})
+        self.assertEqual(Shelter.objects.get(record_id=2).latitude, 28.40)
+        # 変更のない行は書き換えない
+        self.assertEqual(Shelter.objects.get(record_id=1).updated_at, untouched.updated_at)
+
+    def test_unchanged_sync_writes_nothing(self):
+        records = [record(1, "A"), record(2, "B")]
+        self.sync(records)
+
+        with mock.patch("notices.shelters.rebuild_index") as rebuild:
+            summary = self.sync(records)
+
+        self.assertEqual(summary, {"total": 2, "added": 0, "changed": 0, "removed": 0, "unchanged": 2})
+        rebuild.assert_not_called()
+
+    def test_search_fields_do_not_count_as_changes(self):
+        self.sync([record(1, "A")])
+        summary = self.sync([{**record(1, "A"), "_full_text": "a", "rank": 0.5}])
+        self.assertEqual(summary["changed"], 0)
+
+    def test_empty_upstream_keeps_existing_rows(self):
+        self.sync([record(1, "A"), record(2, "B")])
+
+        with self.assertRaises(ValueError):
+            self.sync([])
+
+        self.assertEqual(self.names(), {1: "A", 2: "B"})
+        self.assertTrue(ShelterSyncState.objects.get(resource_id=RESOURCE_ID).last_error)
+
+    def test_sync_rebuilds_nearest_index(self):
+        self.sync([record(1, "A", lat=28.30), record(2, "B", lat=28.50)])
+        self.assertEqual(get_index(RESOURCE_ID).nearest(28.49, 129.49, k=1)[0]["id"], 2)
+
+        self.sync([record(1, "A", lat=28.30)])
+        self.assertEqual(get_index(RESOURCE_ID).nearest(28.49, 129.49, k=1)[0]["id"], 1)
+
+    def test_all_pages_are_fetched(self):
+        records = [record(i, f"S{i}") for i in range(1, 8)]
+
+        def fake_get(url, params=None, timeout=None):
+            page = records[params["offset"]:params["offset"] + params["limit"]]
+            response = mock.Mock()
+            response.json.return_value = {"success": True, "result": {"records": page, "total": len(records)}}
+            return response
+
+        with mock.patch("notices.http_client.get", side_effect=fake_get) as get:
+            summary = sync_shelters(RESOURCE_ID, DATASTORE_URL, page_size=3)
+
+        self.assertEqual(get.call_count, 3)
+        self.assertEqual(summary["added"], 7)
+        self.assertEqual(len(self.names()), 7)
@@ -10,4 +10,6 @@ urlpatterns = [
     path('posts/new/', views.post_create, name='post_create'),
     path('posts/<int:pk>/', views.post_detail, name='post_detail'),
     path('api/notices/', views.api_notices, name='api_notices'),
+    path('api/shelters/nearest/', views.api_shelters_nearest, name='api_shelters_nearest'),
+    path('api/shelters.geojson', views.api_shelters_geojson, name='api_shelters_geojson'),
 ]
@@ -1,114 +1,315 @@
-import requests
-import random
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+
+from django.conf import settings
 from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .adapters import Source, adapters_for, default_source, municipality_sources
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------
+# 外部データ（避難所・天気）のキャッシュと定期更新
+# -----------------------------
+# 画面表示のたびに BODIK / Open-Meteo へ問い合わせると、キャッシュが切れた瞬間のリクエストが
+# 最大10秒待たされ、同時に来たリクエストが一斉に問い合わせてしまう。
+# そこで、
+#   - 画面（get_feed）はキャッシュだけを読み、外部APIを待たない
+#   - 期限が切れる前にバックグラウンドのスケジューラが更新する（stale-while-revalidate）
+#   - 外部APIが落ちている間は、最後に取得できたデータを fresh=False 付きで返し続ける
+#   - 更新は cache.add のロックで1回に1つだけ実行する
+# フィードは「取得元（自治体）× アダプター（notices.adapters）」ごとに作り、キャッシュも自治体ごとに分ける。
+# 更新時刻になったフィードはスレッドプールで同時に取得するので、自治体が増えても更新時間はほぼ変わらない。
+# ※ 複数プロセス間でロック・データを共有するには、CACHES に Redis などの共有キャッシュを設定する
+# 接続先は settings で変更できる（テスト時は `python manage.py notices_stub_server` のスタブに向ける）
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# -----------------------------
+# フィード（キャッシュ上のデータ）
+# -----------------------------
+@dataclass(frozen=True)
+class Feed:
+    name: str
+    cache_key: str
+    loader: object
+    # 取得からこの秒数までは最新（fresh）とみなす
+    max_age: int
+    # 取得結果が空の場合は保存しない（前回のデータを使い続ける）
+    keep_empty: bool = False
+    # DBに同期するフィードの場合、最後に成功した時刻（UNIX秒）を返す関数
+    # （キャッシュではなくDBの記録で鮮度を判断するので、プロセスが再起動しても同期し直さない）
+    synced_at: object = None
 
-def fetch_amami_evacuation():
+
+def _feed_for(adapter):
+    name = f"{adapter.source.key}:{adapter.kind}"
+    return Feed(
+        name=name,
+        cache_key=f"notices_feed:{name}",
+        loader=adapter.fetch,
+        max_age=adapter.max_age,
+        synced_at=adapter.synced_at,
+    )
+
+
+def feeds_for(source):
+    """取得元のフィード（{アダプターの種類: Feed}）"""
+    return {adapter.kind: _feed_for(adapter) for adapter in adapters_for(source)}
+
+
+def source_for_user(user):
     """
-    【避難所情報】BODIK APIから奄美市の指定緊急避難場所データを取得する
+    利用者の自治体の取得元（自治体に取得できるデータが設定されていなければ、従来通り奄美市）
+    戻り値: (取得元, {アダプターの種類: Feed})
     """
-    CACHE_KEY = 'amami_evacuation_data'
-    
-    # 1. キャッシュを確認
-    full_data = cache.get(CACHE_KEY)
-    
-    if not full_data:
-        # BODIK CKAN DataStore API
-        api_url = 'https://data.bodik.jp/api/3/action/datastore_search'
-        
-        # 奄美市：指定緊急避難場所のリソースID
-        resource_id = '815306ec-66f3-4e31-9706-e0f39e3368a5'
-        
-        params = {
-            'resource_id': resource_id,
-            'limit': 100
-        }
-        
-        try:
-            res = requests.get(api_url, params=params, timeout=10)
-            res.raise_for_status()
-            result = res.json()
-            
-            if result.get('success'):
-                records = result['result']['records']
-                full_data = []
-                
-                for record in records:
-                    # 緯度経度を取得（地図リンク用）
-                    lat = record.get('緯度')
-                    lng = record.get('経度')
-                    name = record.get('名称') or '名称不明'
-                    
-                    # Googleマップへのリンクを生成
-                    map_url = f"https://www.google.com/maps/search/?api=1&query={lat},{lng}" if lat and lng else "#"
-
-                    full_data.append({
-                        'title': f"🚨 {name}",
-                        'content': f"【所在地】{record.get('所在地', '住所情報なし')}\n【対象災害】{record.get('災害種別', '全災害')}",
-                        'url': map_url,
-                        'created_at': '緊急避難場所',
-                        'prefecture': '奄美市(防災)',
-                        'is_emergency': True
-                    })
-                
-                # 24時間キャッシュ（避難場所は頻繁に変わらないため）
-                if full_data:
-                    cache.set(CACHE_KEY, full_data, 60 * 60 * 24)
-                    
-        except Exception as e:
-            print(f"Error fetching BODIK evacuation data: {e}")
-            return []
-
-    return full_data
-
-def fetch_amami_weather():
+    municipality = getattr(user, "municipality", None)
+    if hasattr(municipality, "shelter_resource_id"):
+        source = Source.from_municipality(municipality)
+        feeds = feeds_for(source)
+        if feeds:
+            return source, feeds
+    source = default_source()
+    return source, feeds_for(source)
+
+
+def all_feeds():
+    """定期更新の対象（奄美市 + 全自治体）: {フィード名: Feed}"""
+    feeds = {}
+    for source in [default_source()] + municipality_sources():
+        for feed in feeds_for(source).values():
+            feeds[feed.name] = feed
+    return feeds
+
+
+def _error_key(feed):
+    return f"{feed.cache_key}:error"
+
+
+def _lock_key(feed):
+    return f"{feed.cache_key}:lock"
+
+
+def _stale_ttl(feed):
+    """最後に取得できたデータを残しておく期間（外部APIが長く落ちていても表示を続けるため、長めにする）"""
+    return max(feed.max_age, _setting("NOTICES_FEED_KEEP_STALE", 7 * 24 * 60 * 60))
+
+
+def _fetched_at(feed, entry):
+    if feed.synced_at is not None:
+        return feed.synced_at()
+    return entry["fetched_at"] if entry is not None else None
+
+
+def refresh_due_at(feed):
+    """次に更新すべき時刻（期限の手前で更新する。失敗した直後は再試行の間隔を空ける）"""
+    fetched_at = _fetched_at(feed, cache.get(feed.cache_key))
+    due = 0.0
+    if fetched_at is not None:
+        due = fetched_at + feed.max_age * _setting("NOTICES_REFRESH_AHEAD", 0.8)
+    error = cache.get(_error_key(feed))
+    if error is not None:
+        due = max(due, error["at"] + _setting("NOTICES_REFRESH_RETRY_INTERVAL", 60))
+    return due
+
+
+def refresh_feed(feed, force=False):
     """
-    【天気予報】Open-Meteo APIから奄美市（名瀬）の現在の天気を取得する
+    フィードを外部APIから取得してキャッシュを更新する
+    - 他で更新中の場合は何もしない（cache.add によるロック）
+    - force=False の場合、更新時刻になっていなければ何もしない
+    戻り値: 更新したか
     """
-    CACHE_KEY = 'amami_weather_data'
-    weather_data = cache.get(CACHE_KEY)
-    
-    if not weather_data:
-        # 奄美市名瀬の座標
-        api_url = "https://api.open-meteo.com/v1/forecast"
-        params = {
-            "latitude": 28.37,
-            "longitude": 129.49,
-            "daily": ["weather_code", "temperature_2m_max", "temperature_2m_min"],
-            "timezone": "Asia/Tokyo"
-        }
-        
-        try:
-            res = requests.get(api_url, params=params, timeout=10)
-            res.raise_for_status()
-            data = res.json()
-            
-            daily = data['daily']
-            weather_code = daily['weather_code'][0]
-            
-            # WMOコードをアイコンと文字に変換
-            weather_map = {
-                0: "☀️ 快晴", 1: "🌤 晴れ", 2: "⛅ 曇り", 3: "☁️ 曇天",
-                45: "🌫 霧", 51: "🌦 小雨", 61: "☔ 雨", 63: "🌧 激しい雨",
-                71: "❄️ 雪", 95: "⚡ 雷雨"
-            }
-            
-            weather_data = {
-                'status': weather_map.get(weather_code, "☁️ 曇り"),
-                'max_temp': daily['temperature_2m_max'][0],
-                'min_temp': daily['temperature_2m_min'][0],
-            }
-            # 3時間キャッシュ
-            cache.set(CACHE_KEY, weather_data, 60 * 60 * 3)
-            
-        except Exception as e:
-            print(f"Error fetching weather data: {e}")
-            return None
-            
-    return weather_data
-
-# views.pyでの呼び出し互換性のために残す（必要に応じて）
-def fetch_notices_for_prefecture(prefecture):
-    # 現状は奄美市のデータのみを返す
-    if "奄美" in prefecture or "鹿児島" in prefecture:
-        return fetch_amami_evacuation()
-    return []
\ No newline at end of file
+    if not force and time.time() < refresh_due_at(feed):
+        return False
+    if not cache.add(_lock_key(feed), True, _setting("NOTICES_REFRESH_LOCK_TIMEOUT", 60)):
+        return False
+
+    started = time.perf_counter()
+    try:
+        data = feed.loader()
+        if not data and not feed.keep_empty and cache.get(feed.cache_key) is not None:
+            raise ValueError("upstream returned no data")
+        cache.set(feed.cache_key, {"data": data, "fetched_at": time.time()}, _stale_ttl(feed))
+        cache.delete(_error_key(feed))
+        print(f"[INFO] Refreshed {feed.name} in {time.perf_counter() - started:.2f}s")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to refresh {feed.name}: {e}")
+        cache.set(_error_key(feed), {"error": str(e), "at": time.time()}, _stale_ttl(feed))
+        return False
+    finally:
+        cache.delete(_lock_key(feed))
+
+
+def _refresh_and_close(feed, force=False):
+    """別スレッドで更新する場合（DB接続をスレッドに残さない）"""
+    try:
+        return refresh_feed(feed, force=force)
+    finally:
+        close_old_connections()
+
+
+# 更新用のスレッドプール（Webプロセス内のスケジューラと get_feed で共有する。最初に使うときに作る）
+_refresh_executor = None
+_refresh_executor_lock = threading.Lock()
+# get_feed から更新を頼んだ、更新待ち・更新中のフィード名（同じフィードを重ねて頼まない）
+_pending = set()
+
+
+def refresh_executor():
+    global _refresh_executor
+    if _refresh_executor is None:
+        with _refresh_executor_lock:
+            if _refresh_executor is None:
+                _refresh_executor = ThreadPoolExecutor(
+                    max_workers=_setting("NOTICES_REFRESH_WORKERS", 8), thread_name_prefix="notices-refresh"
+                )
+    return _refresh_executor
+
+
+def _refresh_pending(feed):
+    try:
+        return _refresh_and_close(feed)
+    finally:
+        with _refresh_executor_lock:
+            _pending.discard(feed.name)
+
+
+def _refresh_in_background(feed):
+    """更新をスレッドプールに渡す（このプロセスで同じフィードの更新を待っている・実行中なら何もしない）"""
+    with _refresh_executor_lock:
+        if feed.name in _pending:
+            return
+        _pending.add(feed.name)
+    refresh_executor().submit(_refresh_pending, feed)
+
+
+def get_feed(feed):
+    """
+    キャッシュ上のフィードを返す（外部APIは待たない）
+    戻り値: {"data": データ or None, "fetched_at": 取得日時 or None, "fresh": bool, "error": 直近の更新エラー or None}
+    - feed が None（その自治体では取得できないデータ）の場合は未取得として返す
+    - 期限切れ・未取得の場合はバックグラウンドで更新を始め、手元のデータをそのまま返す
+    """
+    if feed is None:
+        return {"data": None, "fetched_at": None, "fresh": False, "error": None}
+
+    entry = cache.get(feed.cache_key)
+    error = cache.get(_error_key(feed))
+    fetched_at = _fetched_at(feed, entry)
+    now = time.time()
+
+    if (fetched_at is None or now >= refresh_due_at(feed)) and cache.get(_lock_key(feed)) is None:
+        # スケジューラが動いていない・遅れている場合の保険
+        # （リクエストごとにスレッドは作らず共有のプールに渡す。ロックと再試行間隔で多重実行はしない）
+        _refresh_in_background(feed)
+
+    if fetched_at is None:
+        return {"data": None, "fetched_at": None, "fresh": False, "error": error and error["error"]}
+    return {
+        "data": entry["data"] if entry is not None else None,
+        "fetched_at": datetime.fromtimestamp(fetched_at, tz=timezone.get_current_timezone()),
+        "fresh": now - fetched_at < feed.max_age,
+        "error": error and error["error"],
+    }
+
+
+# -----------------------------
+# 定期更新（プロセス内スレッド）
+# -----------------------------
+class FeedScheduler:
+    """tick 秒ごとに全フィードの更新時刻を確認し、期限の手前のものをスレッドプールで同時に更新する"""
+
+    def __init__(self, tick, workers, executor=None):
+        self.tick = tick
+        self.workers = workers
+        # executor を渡した場合は共有のプールなので、stop で終了させない
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=workers, thread_name_prefix="notices-refresh")
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="notices-feed-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def run_once(self, force=False, names=None):
+        """
+        更新時刻になったフィード（force=True なら全フィード）を同時に更新する
+        names を指定した場合はそのフィードだけ
+        戻り値: {フィード名: 更新したか}
+        """
+        feeds = all_feeds()
+        if names:
+            feeds = {name: feed for name, feed in feeds.items() if name in names}
+        now = time.time()
+        due = [feed for feed in feeds.values() if force or now >= refresh_due_at(feed)]
+        futures = {feed.name: self._executor.submit(_refresh_and_close, feed, force) for feed in due}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logger.error(f"Feed scheduler error ({name}): {e}")
+                results[name] = False
+        return results
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                # 自治体一覧の取得に失敗した場合など（次の tick で再試行する）
+                logger.error(f"Feed scheduler error: {e}")
+            finally:
+                close_old_connections()
+            self._stop.wait(self.tick)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def create_scheduler(executor=None):
+    return FeedScheduler(
+        tick=_setting("NOTICES_REFRESH_TICK", 30),
+        workers=_setting("NOTICES_REFRESH_WORKERS", 8),
+        executor=executor,
+    )
+
+
+def start_scheduler():
+    """スケジューラを起動する（起動済みならそれを返す）"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = create_scheduler(executor=refresh_executor())
+            _scheduler.start()
+        return _scheduler
+
+
+def ensure_scheduler_started():
+    """NOTICES_REFRESH_AUTOSTART が有効なら、Webプロセス内でスケジューラを起動する"""
+    if _setting("NOTICES_REFRESH_AUTOSTART", True):
+        start_scheduler()
@@ -3,12 +3,15 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.views.generic import TemplateView
 
 from django.views.decorators.cache import never_cache
-from notices.utils import fetch_amami_evacuation, fetch_amami_weather
-from .utils import fetch_notices_for_prefecture
+from .shelters import shelter_notices
+from .spatial import DISASTER_TYPES, get_index
+from .utils import ensure_scheduler_started, get_feed, source_for_user
 # この 'Municipality' は notices.models.Municipality を指します
 from .models import News, Post, Municipality 
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
 
 app_name = 'notices'
 
@@ -73,16 +76,27 @@ def notices_list(request):
         display_prefecture = user_municipality_data.split(' ', 1)[0].strip()
 
     # --- データの取得 ---
-    # 🚨 奄美市の避難所情報をBODIKから取得
-    evacuation_info = fetch_amami_evacuation() 
+    # 外部APIは待たず、バックグラウンドで更新されたキャッシュから表示する
+    # （利用者の自治体にデータの設定がなければ奄美市のデータ）
+    ensure_scheduler_started()
+    source, feeds = source_for_user(request.user)
+
+    # 🚨 避難所情報（CKAN から同期した Shelter テーブル）
+    evacuation = get_feed(feeds.get("shelters"))
+    evacuation_info = shelter_notices(source) if "shelters" in feeds else []
     
-    # ☀️ 奄美市の天気情報をOpen-Meteoから取得
-    weather_info = fetch_amami_weather() 
+    # ☀️ 天気情報（Open-Meteo）
+    weather = get_feed(feeds.get("weather"))
     
     context = {
         'prefecture': display_prefecture,
+        'source_name': source.name,
         'evacuation_notices': evacuation_info,
-        'weather': weather_info,
+        'evacuation_feed': evacuation,
+        'has_evacuation_source': "shelters" in feeds,
+        'weather': weather["data"],
+        'weather_feed': weather,
+        'disaster_types': DISASTER_TYPES,
     }
     
     return render(request, 'notices/notices_list.html', context)
@@ -160,6 +174,55 @@ def api_posts(request):
     ]
     return JsonResponse(data, safe=False)
 
+@login_required
+def api_shelters_nearest(request):
+    """
+    指定した地点から近い避難場所をJSONで返すAPI（利用者の自治体の避難場所から）
+    GET パラメータ: lat, lng（必須）, k（件数、既定5）, type（対象災害。例: 津波）
+    """
+    try:
+        lat = float(request.GET["lat"])
+        lng = float(request.GET["lng"])
+        k = int(request.GET.get("k", 5))
+    except (KeyError, ValueError):
+        return JsonResponse({"error": "lat・lng を数値で指定してください。"}, status=400)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return JsonResponse({"error": "lat・lng の範囲が正しくありません。"}, status=400)
+
+    source, feeds = source_for_user(request.user)
+    index = get_index(source.shelter_resource_id if "shelters" in feeds else "")
+    return JsonResponse({
+        "source": source.name,
+        "results": index.nearest(lat, lng, k=k, disaster_type=request.GET.get("type") or None),
+    })
+
+
+def _etag_matches(if_none_match, etag):
+    """If-None-Match に etag が含まれるか（弱い比較: W/ の有無は区別しない）"""
+    tags = parse_etags(if_none_match)
+    return "*" in tags or etag in [tag.removeprefix("W/") for tag in tags]
+
+
+@login_required
+def api_shelters_geojson(request):
+    """利用者の自治体の全避難場所を GeoJSON で返すAPI（地図表示用。gzip 圧縮済みのものをそのまま返す）"""
+    source, feeds = source_for_user(request.user)
+    index = get_index(source.shelter_resource_id if "shelters" in feeds else "")
+    # 圧縮済み・未圧縮の表現はそれぞれ別の ETag にする
+    use_gzip = "gzip" in request.headers.get("Accept-Encoding", "")
+    etag = index.gzip_etag if use_gzip else index.etag
+    if _etag_matches(request.headers.get("If-None-Match", ""), etag):
+        response = HttpResponseNotModified()
+    elif use_gzip:
+        response = HttpResponse(index.geojson_gzip, content_type="application/geo+json")
+        response["Content-Encoding"] = "gzip"
+    else:
+        response = HttpResponse(index.geojson, content_type="application/geo+json")
+    response["ETag"] = etag
+    patch_vary_headers(response, ["Accept-Encoding"])
+    patch_cache_control(response, private=True, max_age=300)
+    return response
+
 # urls.pyから古いインポートが残っていてもエラーにならないように定義だけ残す
 class NoticeHomeView(TemplateView):
     template_name = 'notices/base.html'
\ No newline at end of file
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_municipality_api_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='municipality',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='municipality',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='municipality',
+            name='shelter_resource_id',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -8,6 +8,10 @@ class Municipality(models.Model):
     name = models.CharField(max_length=100)
     prefecture = models.CharField(max_length=50)
     api_url = models.URLField(default='https://example.com/dummy')  # 自治体のAPIエンドポイントURL
+    # 以下はお知らせ画面の外部データ（notices.adapters）の取得に使う。未設定のデータは表示しない
+    latitude = models.FloatField(null=True, blank=True)  # 天気予報の地点（緯度）
+    longitude = models.FloatField(null=True, blank=True)  # 天気予報の地点（経度）
+    shelter_resource_id = models.CharField(max_length=64, blank=True)  # api_url のCKANにある避難場所データのリソースID
 
     def __str__(self):
         return f"{self.prefecture} {self.name}"